@@ -0,0 +1,129 @@
+"""
+Administration commands for MultiSciView databases
+
+Usage:
+    >> python admin.py indexes -d <db> -c <collection> [--create]
+    >> python admin.py migrate-arrays -d <db> -c <collection>
+    >> python admin.py rebuild-samplelist -d <db> -c <collection> [--by path]
+    >> python admin.py clear-manifest -d <db> -c <collection> -p <project>
+
+author: Sungsoo Ha (sungsooha@bnl.gov)
+"""
+from model.database import DataBase, ensure_indexes, check_indexes
+from model.arraystore import migrate_arrays
+from model.samplelist import rebuild_samplelist
+from model.manifest import Manifest
+from config import CONFIG
+
+
+def _format_size(size):
+    if size is None:
+        return 'unknown'
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f} {:s}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def cmd_indexes(DB, args):
+    """Verify indexes of a collection and report their sizes"""
+    colCursor = DB.conn[args.db][args.col]
+    if args.create:
+        ensure_indexes(colCursor)
+
+    report = check_indexes(colCursor)
+    ok = True
+    for idx in report:
+        keys = ', '.join('{}:{}'.format(k, v) for k, v in idx['keys'])
+        status = 'OK' if idx['exists'] else 'MISSING'
+        ok = ok and idx['exists']
+        print('{:8s} {:20s} ({:s}) {:s}'.format(
+            status, idx['name'], keys, _format_size(idx['size'])))
+    return 0 if ok else 1
+
+
+def cmd_migrate_arrays(DB, args):
+    """Convert pickle-encoded arrays to the raw format in place"""
+    colCursor, fsCursor = DB.get_db(args.db, args.col)
+    count = migrate_arrays(colCursor, fsCursor)
+    print('Migrated {:d} arrays in {:s}.{:s}'.format(count, args.db, args.col))
+    return 0
+
+
+def cmd_rebuild_samplelist(DB, args):
+    """Recompute the sample list summary of a collection"""
+    colCursor, _ = DB.get_db(args.db, args.col)
+    sumCursor = DB.get_samplelist(args.db, args.col)
+    count = rebuild_samplelist(colCursor, sumCursor, args.by)
+    print('Rebuilt sample list of {:s}.{:s}: {:d} samples'.format(
+        args.db, args.col, count))
+    return 0
+
+
+def cmd_clear_manifest(DB, args):
+    """Clear the file manifest of a project, so its next sync is a full one"""
+    manifest = Manifest(DB.get_manifest(args.db, args.col), args.project)
+    count = manifest.load()
+    manifest.clear()
+    print('Cleared {:d} manifest entries of {:s} ({:s}.{:s})'.format(
+        count, args.project, args.db, args.col))
+    return 0
+
+
+def main():
+    import argparse
+    argparser = argparse.ArgumentParser(description="MultiSciView admin")
+    argparser.add_argument("--host",
+                           type=str,
+                           default=CONFIG['DB']['HOST'],
+                           help="MongoDB host address")
+    argparser.add_argument("--port",
+                           type=int,
+                           default=CONFIG['DB']['PORT'],
+                           help="MongoDB port number")
+    subparsers = argparser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('indexes',
+                              help='verify indexes and report their sizes')
+    p.add_argument("-d", "--db", type=str, required=True, help="database")
+    p.add_argument("-c", "--col", type=str, required=True, help="collection")
+    p.add_argument("--create", action='store_true',
+                   help="create missing indexes before verifying")
+    p.set_defaults(func=cmd_indexes)
+
+    p = subparsers.add_parser('migrate-arrays',
+                              help='convert pickle-encoded arrays in place')
+    p.add_argument("-d", "--db", type=str, required=True, help="database")
+    p.add_argument("-c", "--col", type=str, required=True, help="collection")
+    p.set_defaults(func=cmd_migrate_arrays)
+
+    p = subparsers.add_parser('rebuild-samplelist',
+                              help='recompute the sample list summary')
+    p.add_argument("-d", "--db", type=str, required=True, help="database")
+    p.add_argument("-c", "--col", type=str, required=True, help="collection")
+    p.add_argument("--by", type=str, default='project',
+                   choices=['project', 'path'],
+                   help="grouping of sample lists "
+                        "(project: app_dev.py projects, path: app.py folders)")
+    p.set_defaults(func=cmd_rebuild_samplelist)
+
+    p = subparsers.add_parser('clear-manifest',
+                              help='force a full resync of a project')
+    p.add_argument("-d", "--db", type=str, required=True, help="database")
+    p.add_argument("-c", "--col", type=str, required=True, help="collection")
+    p.add_argument("-p", "--project", type=str, required=True,
+                   help="project name")
+    p.set_defaults(func=cmd_clear_manifest)
+
+    args = argparser.parse_args()
+    if args.command is None:
+        argparser.print_help()
+        return 1
+
+    DB = DataBase(host=args.host, port=args.port)
+    return args.func(DB, args)
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -10,6 +10,12 @@ author: Sungsoo Ha (sungsooha@bnl.gov)
 import json
 from flask import Flask, Response, request, render_template
 from model.dataModel import DataHandler
+from model.imagecodec import IMAGE_MIMETYPES, MIME_RAW
+from model.imagecodec import encode_image, image_headers
+from model.httpcache import check_conditional, CACHE_IMMUTABLE, CACHE_REVALIDATE
+from model.compression import Compressor
+from model.binning import check_bins
+from model.connection import client_options
 from config import CONFIG
 
 
@@ -27,10 +33,31 @@ Data = DataHandler(
     fsMapFn=CONFIG['FSMAP'],
     db_host=CONFIG['DB']['HOST'],
     db_port=CONFIG['DB']['PORT'],
-    xml_config=CONFIG['XML']
+    xml_config=CONFIG['XML'],
+    image_cache_bytes=CONFIG['CACHE']['IMAGE_BYTES'],
+    query_cache_bytes=CONFIG['CACHE']['QUERY_BYTES'],
+    query_cache_ttl=CONFIG['CACHE']['QUERY_TTL'],
+    db_options=client_options(CONFIG['DB']),
+    walk_workers=CONFIG['SYNC']['WALK_WORKERS'],
+    fsmap_check_interval=CONFIG['FSMAP_CHECK_INTERVAL']
 )
 
 
+# compression of responses
+Compression = Compressor(
+    level=CONFIG['COMPRESSION']['LEVEL'],
+    min_bytes=CONFIG['COMPRESSION']['MIN_BYTES'],
+    encodings=CONFIG['COMPRESSION']['ENCODINGS']
+)
+
+@app.after_request
+def compress_response(response):
+    return Compression.compress_response(response, request.accept_encodings)
+
+def _bad_request(ex):
+    """`400 Bad Request` with the reason (an exception or str)"""
+    return Response(str(ex), status=400, mimetype='text/plain')
+
 # ----------------------------------------------------------------------------
 # db route
 # ----------------------------------------------------------------------------
@@ -62,7 +89,7 @@ def db_treemap():
     if len(nodeList):
         Data.set_fsmap(nodeList)
 
-    return json.dumps(Data.get_fsmap_as_list())
+    return Data.get_fsmap_json()
 
 # ----------------------------------------------------------------------------
 # syncer route
@@ -120,7 +147,15 @@ def get_db_samplelist():
     data = request.get_json()
     path = data['path']
     recursive = data['recursive']
-    return json.dumps(Data.get_samplelist(path, recursive))
+
+    etag, modified = Data.get_query_validator(path, recursive, 'samplelist')
+    not_modified, headers = check_conditional(request.headers, etag, modified)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/json')
+
+    return Response(Data.stream_samplelist(path, recursive),
+                    mimetype='application/json', headers=headers)
 
 @app.route('/api/data/sample', methods=['POST'])
 def get_sample():
@@ -128,24 +163,231 @@ def get_sample():
     sampleNames = data['sampleNames']
     path = data['path']
     recursive = data['recursive']
+    fmt = data.get('format')
+    try:
+        limit = int(data.get('limit') or 0)
+    except (TypeError, ValueError):
+        limit = -1
+    if limit < 0:
+        return _bad_request('limit must be a non-negative integer')
+
+    etag, modified = Data.get_query_validator(
+        path, recursive, 'sample', fmt, sampleNames,
+        data.get('after_item'), limit)
+    not_modified, headers = check_conditional(request.headers, etag, modified)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/x-ndjson' if fmt == 'ndjson'
+                        else 'application/json')
+
+    # columnar: a table per sample (field names + an array per field)
+    if fmt == 'columnar':
+        return Response(json.dumps({
+            'sampleList': sampleNames,
+            'format': 'columnar',
+            'sampleData': Data.get_samples_columnar(sampleNames, path, recursive)
+        }), mimetype='application/json', headers=headers)
+
+    # ndjson: a flattened document per line, ordered by item and paginated
+    # by `after_item` (item of the last document received) and `limit`
+    if fmt == 'ndjson':
+        return Response(Data.stream_samples_ndjson(sampleNames, path, recursive,
+                                                   data.get('after_item'),
+                                                   limit),
+                        mimetype='application/x-ndjson', headers=headers)
+
+    # {'sampleList': sampleNames, 'sampleData': {name: [docs]}}
+    return Response(Data.stream_samples(sampleNames, path, recursive),
+                    mimetype='application/json', headers=headers)
+
+@app.route('/api/data/sample/stats', methods=['POST'])
+def get_sample_stats():
+    """
+    count/min/max/mean/std of numeric fields (flattened keys) per sample
+    request: {'sampleNames', 'path', 'recursive', 'fields'}
+    """
+    data = request.get_json()
+    return json.dumps(Data.get_sample_stats(data['sampleNames'], data['path'],
+                                            data['recursive'], data['fields']))
 
-    data = Data.get_samples(sampleNames, path, recursive)
-
-    # for key, value in data.items():
-    #     print(key, len(value), value[0])
+@app.route('/api/data/sample/bins', methods=['POST'])
+def get_sample_bins():
+    """
+    2D histogram of two fields (flattened keys, e.g. 'protocol/result') over
+    documents of samples, with optional per-bin statistics of a third field.
+    request: {'sampleNames', 'path', 'recursive', 'x', 'y', 'z' (optional),
+              'bins': [nx, ny], 'range': [[xmin, xmax], [ymin, ymax]]}
+    (a range, or either of its elements, can be null for the data range)
+    Bad bins or range get `400 Bad Request`.
+    """
+    data = request.get_json()
+    try:
+        bins, bins_range = check_bins(data.get('bins') or [64, 64], data.get('range'))
+    except ValueError as ex:
+        return _bad_request(ex)
+    return json.dumps(Data.get_sample_bins(data['sampleNames'], data['path'],
+                                           data['recursive'],
+                                           data['x'], data['y'], bins,
+                                           bins_range, data.get('z')))
+
+def _image_request():
+    """Parameters of an image request, json body (POST) or query string (GET)"""
+    if request.method == 'GET':
+        return request.args.to_dict()
+    return request.get_json()
+
+def _int_param(data, name, default=None, required=False, minimum=None):
+    """
+    Integer parameter of an image request
+    Args:
+        data: request parameters
+        name: parameter name
+        default: value if it is missing (or null)
+        required: True if it must be given
+        minimum: the smallest valid value (None: any)
+
+    Raises:
+        ValueError: missing, not an integer or too small
+    """
+    value = data.get(name)
+    if value is None:
+        if required:
+            raise ValueError('{:s} is required'.format(name))
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('{:s} must be an integer, {!r}'.format(name, value))
+    if minimum is not None and value < minimum:
+        raise ValueError('{:s} must be at least {:d}, {:d}'.format(name, minimum, value))
+    return value
+
+def _image_validation(data, validator, negotiated=False):
+    """
+    Check a conditional image request.
+    A request with the content key (`v`) of the image is cached for long.
+    Args:
+        data: request parameters
+        validator: validator of the image
+        negotiated: True if the format is chosen by the `Accept` header
 
-    return json.dumps({
-        'sampleList': sampleNames,
-        'sampleData': data
-    })
+    Returns:
+        (True if `304 Not Modified` can be sent, response headers)
+    """
+    cache_control = CACHE_REVALIDATE
+    if data.get('v') == validator['key']:
+        cache_control = CACHE_IMMUTABLE
+    not_modified, headers = check_conditional(
+        request.headers, validator['etag'], validator['last_modified'],
+        cache_control)
+    headers['X-Image-Key'] = validator['key']
+    if negotiated:
+        # the same url (and key) is sent in different formats
+        headers['Vary'] = 'Accept'
+    return not_modified, headers
 
 @app.route('/api/data/tiff', methods=['POST'])
 def get_tiff():
     data = request.get_json()
     id = data['id']
     path = data['path']
-    return json.dumps(Data.get_tiff(id, path))
 
+    validator = Data.get_tiff_validator(id, path, 0, 'json')
+    if validator is None:
+        return json.dumps([])
+    not_modified, headers = _image_validation(data, validator)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/json')
+
+    return Response(Data.get_tiff_json(id, path),
+                    mimetype='application/json', headers=headers)
+
+
+@app.route('/api/data/tiff/binary', methods=['GET', 'POST'])
+def get_tiff_binary():
+    """
+    Binary version of /api/data/tiff.
+
+    The image is sent as a binary buffer chosen by the `Accept` header
+    (raw native dtype by default, 16-bit png or 8-bit buffer). Width,
+    height, dtype, min and max of the image are sent in X-Image-* headers.
+
+    The content key of the image is sent in X-Image-Key. A GET request with
+    the key (`v`) is cached for long, as the key changes with the image.
+    """
+    data = _image_request()
+    id = data['id']
+    path = data['path']
+    mimetype = request.accept_mimetypes.best_match(
+        IMAGE_MIMETYPES, default=MIME_RAW)
+
+    validator = Data.get_tiff_validator(id, path, 0, mimetype)
+    if validator is None:
+        return Response(status=404)
+    not_modified, cache_headers = _image_validation(data, validator, True)
+    if not_modified:
+        return Response(status=304, headers=cache_headers,
+                        mimetype=mimetype)
+
+    res = Data.get_tiff_encoded(id, path, mimetype)
+    if res is None:
+        return Response(status=404)
+
+    body, headers = res
+    headers = dict(headers, **cache_headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/api/data/tiff/region', methods=['GET', 'POST'])
+def get_tiff_region():
+    """
+    Region of interest [x0, x1) x [y0, y1) of a tiff image (in pixels of
+    the pyramid level `level`, 0 by default), sent in the same way as
+    /api/data/tiff/binary. The clipped region is sent in X-Image-Region.
+    Missing or non-integer coordinates get `400 Bad Request`.
+    """
+    data = _image_request()
+    id = data['id']
+    path = data['path']
+    try:
+        x0, y0, x1, y1 = [_int_param(data, k, required=True)
+                          for k in ('x0', 'y0', 'x1', 'y1')]
+        level = _int_param(data, 'level', 0, minimum=0)
+    except ValueError as ex:
+        return _bad_request(ex)
+
+    mimetype = request.accept_mimetypes.best_match(
+        IMAGE_MIMETYPES, default=MIME_RAW)
+    validator = Data.get_tiff_validator(
+        id, path, level, mimetype, x0, y0, x1, y1)
+    if validator is None:
+        return Response(status=404)
+    not_modified, cache_headers = _image_validation(data, validator, True)
+    if not_modified:
+        return Response(status=304, headers=cache_headers,
+                        mimetype=mimetype)
+
+    tiff = Data.get_tiff_region(id, path, x0, y0, x1, y1, level)
+    if tiff is None:
+        return Response(status=404)
+
+    body = encode_image(tiff['data'], mimetype, tiff['min'], tiff['max'])
+    headers = dict(image_headers(tiff), **cache_headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Sizes and hit rates of the image and query result caches"""
+    return json.dumps(Data.get_cache_stats())
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Server metrics: caches, response compression and database"""
+    return json.dumps({
+        'cache': Data.get_cache_stats(),
+        'compression': Compression.stats(),
+        'db': Data.get_db_stats()
+    })
 
 # ----------------------------------------------------------------------------
 # main
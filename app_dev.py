@@ -1,7 +1,13 @@
 import os
 import json
+import threading
 from flask import Flask, Response, request, render_template
 from model.dataModel_v2 import DataHandler
+from model.imagecodec import IMAGE_MIMETYPES, MIME_RAW
+from model.imagecodec import encode_image, image_headers
+from model.httpcache import check_conditional, CACHE_IMMUTABLE, CACHE_REVALIDATE
+from model.compression import Compressor
+from model.binning import check_bins
 
 # todo: deprecate config, it is only used for DB host address and port number
 from config import CONFIG
@@ -23,11 +29,43 @@ app = Flask(__name__)
 #     db_port=CONFIG['DB']['PORT'],
 #     xml_config=CONFIG['XML']
 # )
-Data = DataHandler(
-    config=CONFIG,
-    project_dir='./projects'
+# It is created on the first request (or by main()), not on import:
+# parser processes (spawned) import this module again and must not build
+# another one.
+Data = None
+_data_lock = threading.Lock()
+
+def create_data():
+    return DataHandler(
+        config=CONFIG,
+        project_dir='./projects'
+    )
+
+@app.before_request
+def ensure_data():
+    """Create the data handler once, e.g. under a WSGI server"""
+    global Data
+    if Data is None:
+        with _data_lock:
+            if Data is None:
+                Data = create_data()
+
+
+# compression of responses
+Compression = Compressor(
+    level=CONFIG['COMPRESSION']['LEVEL'],
+    min_bytes=CONFIG['COMPRESSION']['MIN_BYTES'],
+    encodings=CONFIG['COMPRESSION']['ENCODINGS']
 )
 
+@app.after_request
+def compress_response(response):
+    return Compression.compress_response(response, request.accept_encodings)
+
+def _bad_request(ex):
+    """`400 Bad Request` with the reason (an exception or str)"""
+    return Response(str(ex), status=400, mimetype='text/plain')
+
 # ----------------------------------------------------------------------------
 # Project managing route
 # ----------------------------------------------------------------------------
@@ -79,9 +117,12 @@ def parse_progress(project:dict):
 def sync_request():
     """
     Request updating DB based on a given project.
+    With `resync: true`, all files are synced again, not only new or
+    changed ones.
     """
     project = request.get_json()
-    status, project = Data.run_syncer(project)
+    resync = bool(project.pop('resync', False))
+    status, project = Data.run_syncer(project, resync=resync)
     progress = parse_progress(project)
     project['status'] = status
     project['progress'] = progress
@@ -112,21 +153,140 @@ def sync_progress():
 @app.route('/api/data/samplelist', methods=['POST'])
 def get_db_samplelist():
     project = request.get_json()
-    samplelist = Data.get_samplelist(project)
-    return json.dumps(samplelist)
+    etag, modified = Data.get_query_validator(project, 'samplelist')
+    not_modified, headers = check_conditional(request.headers, etag, modified)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/json')
+
+    return Response(Data.stream_samplelist(project),
+                    mimetype='application/json', headers=headers)
 
 @app.route('/api/data/sample', methods=['POST'])
 def get_sample():
     data = request.get_json()
     sampleNames = data['sampleNames']
     project = data['project']
+    fmt = data.get('format')
+    try:
+        limit = int(data.get('limit') or 0)
+    except (TypeError, ValueError):
+        limit = -1
+    if limit < 0:
+        return _bad_request('limit must be a non-negative integer')
 
-    data = Data.get_samples(sampleNames, project)
+    etag, modified = Data.get_query_validator(
+        project, 'sample', fmt, sampleNames,
+        data.get('after_item'), limit)
+    not_modified, headers = check_conditional(request.headers, etag, modified)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/x-ndjson' if fmt == 'ndjson'
+                        else 'application/json')
 
-    return json.dumps({
-        'sampleList': sampleNames,
-        'sampleData': data
-    })
+    # columnar: a table per sample (field names + an array per field)
+    if fmt == 'columnar':
+        return Response(json.dumps({
+            'sampleList': sampleNames,
+            'format': 'columnar',
+            'sampleData': Data.get_samples_columnar(sampleNames, project)
+        }), mimetype='application/json', headers=headers)
+
+    # ndjson: a flattened document per line, ordered by item and paginated
+    # by `after_item` (item of the last document received) and `limit`
+    if fmt == 'ndjson':
+        return Response(Data.stream_samples_ndjson(sampleNames, project,
+                                                   data.get('after_item'),
+                                                   limit),
+                        mimetype='application/x-ndjson', headers=headers)
+
+    # {'sampleList': sampleNames, 'sampleData': {name: [docs]}}
+    return Response(Data.stream_samples(sampleNames, project),
+                    mimetype='application/json', headers=headers)
+
+@app.route('/api/data/sample/stats', methods=['POST'])
+def get_sample_stats():
+    """
+    count/min/max/mean/std of numeric fields (flattened keys) per sample
+    request: {'sampleNames', 'project', 'fields'}
+    """
+    data = request.get_json()
+    return json.dumps(Data.get_sample_stats(data['sampleNames'], data['project'], data['fields']))
+
+@app.route('/api/data/sample/bins', methods=['POST'])
+def get_sample_bins():
+    """
+    2D histogram of two fields (flattened keys, e.g. 'protocol/result') over
+    documents of samples, with optional per-bin statistics of a third field.
+    request: {'sampleNames', 'project', 'x', 'y', 'z' (optional),
+              'bins': [nx, ny], 'range': [[xmin, xmax], [ymin, ymax]]}
+    (a range, or either of its elements, can be null for the data range)
+    Bad bins or range get `400 Bad Request`.
+    """
+    data = request.get_json()
+    try:
+        bins, bins_range = check_bins(data.get('bins') or [64, 64], data.get('range'))
+    except ValueError as ex:
+        return _bad_request(ex)
+    return json.dumps(Data.get_sample_bins(data['sampleNames'], data['project'],
+                                           data['x'], data['y'], bins,
+                                           bins_range, data.get('z')))
+
+def _image_request():
+    """Parameters of an image request, json body (POST) or query string (GET)"""
+    if request.method == 'GET':
+        return request.args.to_dict()
+    return request.get_json()
+
+def _int_param(data, name, default=None, required=False, minimum=None):
+    """
+    Integer parameter of an image request
+    Args:
+        data: request parameters
+        name: parameter name
+        default: value if it is missing (or null)
+        required: True if it must be given
+        minimum: the smallest valid value (None: any)
+
+    Raises:
+        ValueError: missing, not an integer or too small
+    """
+    value = data.get(name)
+    if value is None:
+        if required:
+            raise ValueError('{:s} is required'.format(name))
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('{:s} must be an integer, {!r}'.format(name, value))
+    if minimum is not None and value < minimum:
+        raise ValueError('{:s} must be at least {:d}, {:d}'.format(name, minimum, value))
+    return value
+
+def _image_validation(data, validator, negotiated=False):
+    """
+    Check a conditional image request.
+    A request with the content key (`v`) of the image is cached for long.
+    Args:
+        data: request parameters
+        validator: validator of the image
+        negotiated: True if the format is chosen by the `Accept` header
+
+    Returns:
+        (True if `304 Not Modified` can be sent, response headers)
+    """
+    cache_control = CACHE_REVALIDATE
+    if data.get('v') == validator['key']:
+        cache_control = CACHE_IMMUTABLE
+    not_modified, headers = check_conditional(
+        request.headers, validator['etag'], validator['last_modified'],
+        cache_control)
+    headers['X-Image-Key'] = validator['key']
+    if negotiated:
+        # the same url (and key) is sent in different formats
+        headers['Vary'] = 'Accept'
+    return not_modified, headers
 
 @app.route('/api/data/tiff', methods=['POST'])
 def get_tiff():
@@ -134,8 +294,119 @@ def get_tiff():
     id = data['id']
     db = data['db']
     col = data['col']
-    return json.dumps(Data.get_tiff(id, db, col))
 
+    validator = Data.get_tiff_validator(id, db, col, 0, 'json')
+    if validator is None:
+        return json.dumps([])
+    not_modified, headers = _image_validation(data, validator)
+    if not_modified:
+        return Response(status=304, headers=headers,
+                        mimetype='application/json')
+
+    return Response(Data.get_tiff_json(id, db, col),
+                    mimetype='application/json', headers=headers)
+
+
+@app.route('/api/data/tiff/binary', methods=['GET', 'POST'])
+def get_tiff_binary():
+    """
+    Binary version of /api/data/tiff.
+
+    The image is sent as a binary buffer chosen by the `Accept` header
+    (raw native dtype by default, 16-bit png or 8-bit buffer). Width,
+    height, dtype, min, max and pyramid level of the image are sent in
+    X-Image-* headers.
+
+    Optionally, `level` selects a pyramid level, or `width`/`height` (display
+    size) select the smallest level that is at least that large.
+
+    The content key of the image is sent in X-Image-Key. A GET request with
+    the key (`v`) is cached for long, as the key changes with the image.
+    """
+    data = _image_request()
+    id = data['id']
+    db = data['db']
+    col = data['col']
+    try:
+        width = _int_param(data, 'width', minimum=1)
+        height = _int_param(data, 'height', minimum=1)
+        level = _int_param(data, 'level', 0, minimum=0)
+    except ValueError as ex:
+        return _bad_request(ex)
+    if width is not None or height is not None:
+        level = Data.select_tiff_level(id, db, col, width, height)
+    if level is None:
+        return Response(status=404)
+
+    mimetype = request.accept_mimetypes.best_match(
+        IMAGE_MIMETYPES, default=MIME_RAW)
+    validator = Data.get_tiff_validator(id, db, col, level, mimetype)
+    if validator is None:
+        return Response(status=404)
+    not_modified, cache_headers = _image_validation(data, validator, True)
+    if not_modified:
+        return Response(status=304, headers=cache_headers,
+                        mimetype=mimetype)
+
+    res = Data.get_tiff_encoded(id, db, col, mimetype, level)
+    if res is None:
+        return Response(status=404)
+
+    body, headers = res
+    headers = dict(headers, **cache_headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/api/data/tiff/region', methods=['GET', 'POST'])
+def get_tiff_region():
+    """
+    Region of interest [x0, x1) x [y0, y1) of a tiff image (in pixels of
+    the pyramid level `level`, 0 by default), sent in the same way as
+    /api/data/tiff/binary. The clipped region is sent in X-Image-Region.
+    Missing or non-integer coordinates get `400 Bad Request`.
+    """
+    data = _image_request()
+    id = data['id']
+    db = data['db']
+    col = data['col']
+    try:
+        x0, y0, x1, y1 = [_int_param(data, k, required=True)
+                          for k in ('x0', 'y0', 'x1', 'y1')]
+        level = _int_param(data, 'level', 0, minimum=0)
+    except ValueError as ex:
+        return _bad_request(ex)
+
+    mimetype = request.accept_mimetypes.best_match(
+        IMAGE_MIMETYPES, default=MIME_RAW)
+    validator = Data.get_tiff_validator(
+        id, db, col, level, mimetype, x0, y0, x1, y1)
+    if validator is None:
+        return Response(status=404)
+    not_modified, cache_headers = _image_validation(data, validator, True)
+    if not_modified:
+        return Response(status=304, headers=cache_headers,
+                        mimetype=mimetype)
+
+    tiff = Data.get_tiff_region(id, db, col, x0, y0, x1, y1, level)
+    if tiff is None:
+        return Response(status=404)
+
+    body = encode_image(tiff['data'], mimetype, tiff['min'], tiff['max'])
+    headers = dict(image_headers(tiff), **cache_headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Sizes and hit rates of the image and query result caches"""
+    return json.dumps(Data.get_cache_stats())
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Server metrics: caches, response compression and database"""
+    return json.dumps({
+        'cache': Data.get_cache_stats(),
+        'compression': Compression.stats(),
+        'db': Data.get_db_stats()
+    })
 
 # ----------------------------------------------------------------------------
 # main
@@ -156,6 +427,7 @@ def finalize():
 
 
 def main(host, port):
+    ensure_data()
     try:
         app.run(host=host, port=port, threaded=True)
     except KeyboardInterrupt:
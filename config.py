@@ -6,11 +6,67 @@ CONFIG = {
     # File path web server will use to store file system information
     'FSMAP': './fsmap.json',
 
+    # seconds between full scans checking the file system information,
+    # which is otherwise updated by directory events
+    'FSMAP_CHECK_INTERVAL': 300,
+
     # mongo db set-up
     'DB': {
         #'HOST': 'visws.csi.bnl.gov',
         'HOST': 'localhost',
-        'PORT': 27017
+        'PORT': 27017,
+
+        # connection pool of the (process-wide) client
+        'MAX_POOL_SIZE': 100,
+        'MIN_POOL_SIZE': 0,
+
+        # timeouts in milliseconds (None: driver default)
+        'CONNECT_TIMEOUT_MS': 5000,
+        'SERVER_SELECTION_TIMEOUT_MS': 5000,
+        'SOCKET_TIMEOUT_MS': None,
+
+        # interval of the driver's server monitoring (None: driver default)
+        'HEARTBEAT_FREQUENCY_MS': None,
+    },
+
+    # syncing files with mongo db
+    'SYNC': {
+        # the number of parser processes (None: the number of cpus)
+        'WORKERS': None,
+
+        # the number of documents written to db at once
+        'BATCH': 100,
+
+        # maximum number of files waiting between pipeline stages
+        'QUEUE': 64,
+
+        # the number of threads listing directories when walking a tree
+        # (0: walk serially, more helps on high-latency network filesystems)
+        'WALK_WORKERS': 8,
+    },
+
+    # in-process caches of the web server
+    'CACHE': {
+        # byte budget of decoded images and encoded image responses
+        'IMAGE_BYTES': 512 * 1024 * 1024,
+
+        # byte budget of query results (sample lists and sample responses)
+        'QUERY_BYTES': 64 * 1024 * 1024,
+
+        # seconds a query result is reused at most (None: until data changes)
+        'QUERY_TTL': 300,
+    },
+
+    # compression of responses (gzip/deflate, negotiated by Accept-Encoding)
+    'COMPRESSION': {
+        # zlib compression level (1: fastest, 9: smallest)
+        'LEVEL': 6,
+
+        # responses smaller than this (bytes) are sent uncompressed
+        'MIN_BYTES': 1024,
+
+        # supported encodings in the order of preference (empty to disable)
+        'ENCODINGS': ['gzip', 'deflate'],
     },
 
     # parsing xml file
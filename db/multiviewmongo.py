@@ -1,14 +1,15 @@
-from bson.binary import Binary
 from bson.objectid import ObjectId
 import gridfs
 import pymongo
 from pymongo import ReturnDocument
 from pymongo.errors import ConnectionFailure
-import pickle
 import numpy as np
 import datetime
 
 import copy
+from model.arraystore import put_array, get_array
+from model.database import ensure_indexes
+from model.samplelist import samplelist_name, ensure_samplelist, SAMPLELIST_INDEXES
 
 
 __all__ = ['MultiViewMongo']
@@ -50,6 +51,7 @@ class MultiViewMongo(object):
         self.db = None
         self.collection = None
         self.fs = None
+        self.samplelist = None
         self.open(db_name, collection_name, fs_name)
 
     def open(self, db_name, collection_name, fs_name):
@@ -60,6 +62,11 @@ class MultiViewMongo(object):
             self.db = self.connection[self.db_name]
             self.collection = self.db[self.collection_name]
             self.fs = gridfs.GridFS(self.db, 'fs')
+            ensure_indexes(self.collection)
+            # sample list summary, built here if it doesn't exist yet
+            self.samplelist = self.db[samplelist_name(self.collection_name)]
+            ensure_indexes(self.samplelist, SAMPLELIST_INDEXES)
+            ensure_samplelist(self.collection, self.samplelist, 'path')
             print("Open DB({}).COL({}) (FS:{})".format(self.db_name, self.collection_name, self.fs_name))
             return True
         else:
@@ -238,16 +245,16 @@ class MultiViewMongo(object):
         self.collection.remove(objectId)
 
     # utility functions
-    def _npArray2Binary(self, npArray):
-        return Binary(pickle.dumps(npArray, protocol=2), subtype=128)
+    def _putNPArray(self, npArray):
+        return put_array(self.fs, npArray)
 
-    def _binary2npArray(self, binary):
-        return pickle.loads(binary)
+    def _getNPArray(self, objectId):
+        return get_array(self.fs, objectId)
 
     def _loadNPArrays(self, document):
         for (key, value) in document.items():
             if isinstance(value, ObjectId) and key != '_id':
-                document[key] = self._binary2npArray(self.fs.get(value).read())
+                document[key] = self._getNPArray(value)
             elif isinstance(value, dict):
                 document[key] = self._loadNPArrays(value)
 
@@ -257,9 +264,6 @@ class MultiViewMongo(object):
     def _stashNPArrays(self, document):
         for (key, value) in document.items():
             if isinstance(value, np.ndarray):
-                dataBSON = self._npArray2Binary(value)
-                #dataMD5 = hashlib.md5(dataBSON).hexdigest()
-
                 match = False
                 for obj in self.temp_oldNpObjectIDs:
                     match = True
@@ -268,7 +272,7 @@ class MultiViewMongo(object):
                     self.temp_newNpObjectIds.append(obj)
 
                 if not match:
-                    obj = self.fs.put(self._npArray2Binary(value))
+                    obj = self._putNPArray(value)
                     document[key] = obj
                     self.temp_newNpObjectIds.append(obj)
 
@@ -0,0 +1,294 @@
+"""
+Storing numpy arrays in gridfs
+
+Arrays are stored as raw C-contiguous bytes. Everything needed to rebuild
+an array (dtype, shape and byte order) goes to the metadata of the gridfs
+file, so that a read is a single np.frombuffer() over the file content.
+
+2D arrays can be stored in a tiled layout instead (format version 2):
+fixed-size tiles, padded at the edges, stored one after another in row
+major order of the tile grid. The gridfs chunk size is set to the size of
+a tile, so a region of interest is read by fetching only the chunks of
+the tiles covering it (from the chunks collection).
+
+Files written before this format (pickle protocol 2) have no `format` in
+their metadata. They are still readable by the compatibility reader and
+can be converted in place by `migrate_arrays()`.
+"""
+import pickle
+import numpy as np
+from model.colversion import bump_version
+
+# array format stored in gridfs file metadata
+ARRAY_FORMAT = 'ndarray'
+ARRAY_FORMAT_VERSION = 2
+
+# default tile size (height, width) for the tiled layout
+DEFAULT_TILE = (256, 256)
+
+
+class _ArrayReader(object):
+    """File-like reader over an array buffer (avoids a full bytes copy)"""
+    def __init__(self, arr:np.ndarray):
+        self.buf = memoryview(arr.reshape(-1).view(np.uint8))
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.buf) - self.pos
+        start = self.pos
+        self.pos = min(self.pos + size, len(self.buf))
+        return self.buf[start:self.pos].tobytes()
+
+
+def array_metadata(arr:np.ndarray):
+    """Metadata describing a raw array buffer"""
+    byteorder = arr.dtype.byteorder
+    if byteorder == '=':
+        byteorder = '<' if np.little_endian else '>'
+    return {
+        'format': ARRAY_FORMAT,
+        'version': 1,
+        'dtype': arr.dtype.str,
+        'shape': [int(d) for d in arr.shape],
+        'byteorder': byteorder,
+        'order': 'C'
+    }
+
+
+def tile_index(shape, tile=DEFAULT_TILE):
+    """Tile grid of a 2D array, stored in image subdocuments"""
+    th, tw = int(tile[0]), int(tile[1])
+    return {
+        'height': th,
+        'width': tw,
+        'ny': -(-int(shape[0]) // th),
+        'nx': -(-int(shape[1]) // tw)
+    }
+
+
+def _to_tiles(arr:np.ndarray, tile):
+    """Re-arrange a 2D array into tiles of (ny, nx, th, tw)"""
+    index = tile_index(arr.shape, tile)
+    th, tw, ny, nx = index['height'], index['width'], index['ny'], index['nx']
+
+    padded = np.zeros((ny * th, nx * tw), dtype=arr.dtype)
+    padded[:arr.shape[0], :arr.shape[1]] = arr
+    return np.ascontiguousarray(
+        padded.reshape(ny, th, nx, tw).transpose(0, 2, 1, 3))
+
+
+def put_array(fsCursor, arr:np.ndarray, tile=None, **kwargs):
+    """
+    Store an array in gridfs
+    Args:
+        fsCursor: gridfs cursor
+        arr: numpy array
+        tile: (height, width) to store a 2D array in the tiled layout
+        kwargs: additional fields of the gridfs file
+
+    Returns:
+        id of the gridfs file
+    """
+    arr = np.ascontiguousarray(arr)
+    metadata = array_metadata(arr)
+
+    if tile is not None and arr.ndim == 2:
+        tiles = _to_tiles(arr, tile)
+        metadata['version'] = 2
+        metadata['layout'] = 'tiled'
+        metadata['tile'] = [int(tile[0]), int(tile[1])]
+        # one tile per chunk
+        kwargs['chunkSize'] = int(tile[0]) * int(tile[1]) * arr.itemsize
+        return fsCursor.put(_ArrayReader(tiles), metadata=metadata, **kwargs)
+
+    return fsCursor.put(_ArrayReader(arr), metadata=metadata, **kwargs)
+
+
+def is_legacy(metadata):
+    """Is it stored in the pickle format?"""
+    return metadata is None or metadata.get('format') != ARRAY_FORMAT
+
+
+def is_tiled(metadata):
+    """Is it stored in the tiled layout?"""
+    return not is_legacy(metadata) and metadata.get('layout') == 'tiled'
+
+
+def decode_array(data, metadata):
+    """
+    Rebuild an array from content of a gridfs file.
+    The returned array shares memory with `data` (read-only for bytes),
+    except for the tiled layout which needs to be re-arranged.
+    """
+    if is_legacy(metadata):
+        # compatibility reader for files written by pickle protocol 2
+        return pickle.loads(data)
+
+    if metadata['version'] > ARRAY_FORMAT_VERSION:
+        raise ValueError('Unsupported array format version: {}'.format(
+            metadata['version']))
+
+    dtype = np.dtype(metadata['dtype'])
+    shape = metadata['shape']
+    if is_tiled(metadata):
+        index = tile_index(shape, metadata['tile'])
+        th, tw, ny, nx = index['height'], index['width'], index['ny'], index['nx']
+        tiles = np.frombuffer(data, dtype=dtype).reshape(ny, nx, th, tw)
+        return tiles.transpose(0, 2, 1, 3).reshape(ny * th, nx * tw)[
+               :shape[0], :shape[1]].copy()
+
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def get_array(fsCursor, id):
+    """Load an array from gridfs"""
+    f = fsCursor.get(id)
+    return decode_array(f.read(), f.metadata)
+
+
+def clip_region(shape, x0, y0, x1, y1):
+    """Clip a region [x0, x1) x [y0, y1) to a 2D array"""
+    h, w = int(shape[0]), int(shape[1])
+    x0 = min(max(int(x0), 0), w)
+    x1 = min(max(int(x1), x0), w)
+    y0 = min(max(int(y0), 0), h)
+    y1 = min(max(int(y1), y0), h)
+    return x0, y0, x1, y1
+
+
+def _find_chunks(chunksCursor, file_id, numbers):
+    """
+    Fetch chunks of a gridfs file by their numbers, in a single query
+    bounded to them (reading a GridOut after seek() fetches from the seek
+    point to the end of the file).
+
+    Returns:
+        {n: bytes}
+    """
+    query = {'files_id': file_id}
+    if isinstance(numbers, range):
+        query['n'] = {'$gte': numbers.start, '$lte': numbers.stop - 1}
+    else:
+        query['n'] = {'$in': list(numbers)}
+    chunks = {
+        c['n']: c['data']
+        for c in chunksCursor.find(query, {'_id': 0, 'n': 1, 'data': 1}).sort('n', 1)
+    }
+    missing = [n for n in numbers if n not in chunks]
+    if len(missing):
+        raise ValueError('Missing chunks {} of gridfs file {}'.format(
+            missing[:8], file_id))
+    return chunks
+
+
+def get_array_region(fsCursor, chunksCursor, id, x0, y0, x1, y1):
+    """
+    Load a region [x0, x1) x [y0, y1) of a 2D array from gridfs.
+
+    Only the chunks covering the region are read (by querying the chunks
+    collection directly): whole tiles for the tiled layout, and whole rows
+    for the raw layout. Legacy (pickle) files are loaded entirely.
+
+    Args:
+        fsCursor: gridfs cursor
+        chunksCursor: chunks collection of the gridfs (e.g. `fs.chunks`)
+
+    Returns:
+        (region array, clipped region (x0, y0, x1, y1))
+    """
+    f = fsCursor.get(id)
+    metadata = f.metadata
+
+    if is_legacy(metadata):
+        arr = decode_array(f.read(), metadata)
+        x0, y0, x1, y1 = clip_region(arr.shape, x0, y0, x1, y1)
+        return arr[y0:y1, x0:x1], (x0, y0, x1, y1)
+
+    dtype = np.dtype(metadata['dtype'])
+    shape = metadata['shape']
+    x0, y0, x1, y1 = clip_region(shape, x0, y0, x1, y1)
+    out = np.empty((y1 - y0, x1 - x0), dtype=dtype)
+    if out.size == 0:
+        return out, (x0, y0, x1, y1)
+
+    if not is_tiled(metadata):
+        row_bytes = int(shape[1]) * dtype.itemsize
+        start, end = y0 * row_bytes, y1 * row_bytes
+        first = start // f.chunk_size
+        numbers = range(first, (end - 1) // f.chunk_size + 1)
+        chunks = _find_chunks(chunksCursor, f._id, numbers)
+        data = b''.join(chunks[n] for n in numbers)
+        offset = start - first * f.chunk_size
+        rows = np.frombuffer(data, dtype=dtype,
+                             count=(y1 - y0) * int(shape[1]),
+                             offset=offset)
+        out[:] = rows.reshape(y1 - y0, shape[1])[:, x0:x1]
+        return out, (x0, y0, x1, y1)
+
+    # a tile is a chunk, numbered in row major order of the tile grid
+    index = tile_index(shape, metadata['tile'])
+    th, tw, nx = index['height'], index['width'], index['nx']
+    tx0, tx1 = x0 // tw, (x1 - 1) // tw
+    ty0, ty1 = y0 // th, (y1 - 1) // th
+    numbers = [ty * nx + tx for ty in range(ty0, ty1 + 1)
+               for tx in range(tx0, tx1 + 1)]
+    chunks = _find_chunks(chunksCursor, f._id, numbers)
+
+    for ty in range(ty0, ty1 + 1):
+        data = b''.join(chunks[ty * nx + tx] for tx in range(tx0, tx1 + 1))
+        tiles = np.frombuffer(data, dtype=dtype).reshape(-1, th, tw)
+        band = tiles.transpose(1, 0, 2).reshape(th, -1)
+
+        # copy intersection of the band and the region
+        by0 = max(y0, ty * th)
+        by1 = min(y1, (ty + 1) * th)
+        bx = tx0 * tw
+        out[by0 - y0:by1 - y0, :] = band[by0 - ty * th:by1 - ty * th,
+                                         x0 - bx:x1 - bx]
+    return out, (x0, y0, x1, y1)
+
+
+def migrate_arrays(colCursor, fsCursor, types=('tiff', 'jpg')):
+    """
+    Convert pickle-encoded arrays referenced by a collection to the raw
+    format, in place. Documents are updated to point to the new files and
+    the old files are deleted.
+
+    Args:
+        colCursor: cursor to a collection
+        fsCursor: gridfs cursor associated with the collection
+        types: image subdocuments holding array ids in `data` field
+
+    Returns:
+        the number of migrated arrays
+    """
+    count = 0
+    for t in types:
+        field = t + '.data'
+        query = {field: {'$exists': True}}
+        for doc in colCursor.find(query, {field: 1}):
+            old_id = doc[t]['data']
+            try:
+                f = fsCursor.get(old_id)
+            except Exception as ex:
+                print('Failed to read {} | {}'.format(old_id, ex))
+                continue
+            if not is_legacy(f.metadata):
+                continue
+
+            arr = decode_array(f.read(), f.metadata)
+            new_id = put_array(fsCursor, arr)
+            res = colCursor.update_one(
+                {'_id': doc['_id'], field: old_id},
+                {'$set': {field: new_id}}
+            )
+            if res.modified_count:
+                fsCursor.delete(old_id)
+                count += 1
+            else:
+                # the document is updated meanwhile, keep it as it is.
+                fsCursor.delete(new_id)
+    if count:
+        bump_version(colCursor)
+    return count
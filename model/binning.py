@@ -0,0 +1,206 @@
+"""
+2D binning of protocol fields for overview plots
+
+Fields are given as flattened keys (nested keys joined by '/'), the same as
+the keys of documents in sample responses. Only the fields in use are
+projected from the database, and documents whose x or y value is not a
+number are skipped.
+"""
+import numpy as np
+
+# the largest number of bins per axis
+MAX_BINS = 4096
+
+
+def field_path(field):
+    """Flattened key to a dotted path for mongodb queries"""
+    return field.replace('/', '.')
+
+
+def field_projection(*fields):
+    """Projection of the fields (None is ignored)"""
+    proj = {field_path(f): 1 for f in fields if f is not None}
+    proj['_id'] = 0
+    return proj
+
+
+def get_field(doc:dict, field):
+    """Value of a flattened key in a document (None if missing)"""
+    value = doc
+    for key in field.split('/'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _to_float(value):
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def collect_fields(docs, x, y, z=None):
+    """
+    Collect values of fields from documents into float arrays.
+    Non-numeric values become NaN.
+
+    Returns:
+        (x array, y array, z array or None)
+    """
+    xs, ys, zs = [], [], []
+    for doc in docs:
+        xs.append(_to_float(get_field(doc, x)))
+        ys.append(_to_float(get_field(doc, y)))
+        if z is not None:
+            zs.append(_to_float(get_field(doc, z)))
+
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    zs = np.asarray(zs, dtype=np.float64) if z is not None else None
+    return xs, ys, zs
+
+
+def _bounds(given):
+    """A range of a field from a request, (min, max) as floats or None"""
+    if given is None:
+        return None
+    try:
+        lo, hi = given
+        lo, hi = float(lo), float(hi)
+    except (TypeError, ValueError):
+        raise ValueError('a range must be [min, max] numbers, {!r}'.format(given))
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        raise ValueError('a range must be finite, {!r}'.format(given))
+    if lo > hi:
+        lo, hi = hi, lo
+    if lo == hi:
+        # histogram2d needs a non-empty range
+        lo, hi = lo - 0.5, hi + 0.5
+    return lo, hi
+
+
+def check_bins(bins, range=None):
+    """
+    Check and normalize binning parameters of a request. Bounds are
+    coerced to float, an inverted range is swapped and an empty one is
+    widened (as for the data range).
+    Args:
+        bins: [x bins, y bins]
+        range: [[xmin, xmax], [ymin, ymax]], each can be None
+
+    Returns:
+        ((x bins, y bins), ((xmin, xmax) or None, (ymin, ymax) or None))
+
+    Raises:
+        ValueError: bins or range are invalid
+    """
+    try:
+        nx, ny = bins
+        nx, ny = int(nx), int(ny)
+    except (TypeError, ValueError):
+        raise ValueError('bins must be [nx, ny] integers, {!r}'.format(bins))
+    if not (0 < nx <= MAX_BINS and 0 < ny <= MAX_BINS):
+        raise ValueError('bins must be in [1, {:d}], {!r}'.format(MAX_BINS, bins))
+
+    if range is None:
+        range = (None, None)
+    try:
+        xr, yr = range
+    except (TypeError, ValueError):
+        raise ValueError('range must be [x range, y range], {!r}'.format(range))
+    return (nx, ny), (_bounds(xr), _bounds(yr))
+
+
+def _value_range(values, given=None):
+    if given is not None:
+        return given
+    if values.size == 0:
+        return 0., 1.
+    lo, hi = float(values.min()), float(values.max())
+    if lo == hi:
+        # histogram2d needs a non-empty range
+        lo, hi = lo - 0.5, hi + 0.5
+    return lo, hi
+
+
+def bin_2d(xs, ys, bins=(64, 64), range=None, zs=None):
+    """
+    2D histogram of (x, y), with optional statistics of z per bin.
+    Args:
+        xs, ys: float arrays
+        bins: (x bins, y bins)
+        range: ((xmin, xmax), (ymin, ymax)), each can be None (data range)
+               (see check_bins())
+        zs: float array of a third field (optional)
+
+    Returns:
+        {
+            'x': {'edges': [...]}, 'y': {'edges': [...]},
+            'counts': [[...]] (x bins by y bins),
+            'total': the number of binned documents,
+            'z': {'count', 'mean', 'std'} per bin (if zs is given)
+        }
+    """
+    (nx, ny), range = check_bins(bins, range)
+
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    xs, ys = xs[valid], ys[valid]
+    xr = _value_range(xs, range[0])
+    yr = _value_range(ys, range[1])
+
+    counts, xedges, yedges = np.histogram2d(xs, ys, bins=(nx, ny), range=(xr, yr))
+    res = {
+        'x': {'edges': xedges.tolist()},
+        'y': {'edges': yedges.tolist()},
+        'counts': counts.astype(np.int64).tolist(),
+        'total': int(counts.sum())
+    }
+
+    if zs is not None:
+        zs = zs[valid]
+        finite = np.isfinite(zs)
+        xs, ys, zs = xs[finite], ys[finite], zs[finite]
+        edges = (xedges, yedges)
+        zcount, _, _ = np.histogram2d(xs, ys, bins=edges)
+        zsum, _, _ = np.histogram2d(xs, ys, bins=edges, weights=zs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = zsum / zcount
+
+        # squared deviations from the mean of each bin (two passes, since
+        # E[z^2] - mean^2 cancels out for values with a large offset)
+        ix, inx = _bin_index(xs, xedges)
+        iy, iny = _bin_index(ys, yedges)
+        inside = inx & iny
+        dev = np.zeros_like(zs)
+        dev[inside] = zs[inside] - mean[ix[inside], iy[inside]]
+        zsq, _, _ = np.histogram2d(xs, ys, bins=edges, weights=dev * dev)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = zsq / zcount
+        res['z'] = {
+            'count': zcount.astype(np.int64).tolist(),
+            # None for empty bins
+            'mean': _nan_to_none(mean),
+            'std': _nan_to_none(np.sqrt(var))
+        }
+    return res
+
+
+def _bin_index(values, edges):
+    """
+    Bins of values as histogram2d assigns them (the last bin includes its
+    right edge)
+    Returns:
+        (bin index, True if in the range)
+    """
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = len(edges) - 2
+    inside = (index >= 0) & (index < len(edges) - 1)
+    return index, inside
+
+
+def _nan_to_none(arr:np.ndarray):
+    return [[v if v == v else None for v in row] for row in arr.tolist()]
@@ -0,0 +1,341 @@
+"""
+In-process caches shared by request threads
+"""
+import threading
+import time
+import datetime
+from collections import OrderedDict
+
+# rough size of an image subdocument without its array
+_IMG_DOC_OVERHEAD = 1024
+
+
+class ImageCache(object):
+    """
+    Byte-budgeted LRU cache of decoded image arrays and encoded responses.
+
+    Keys are (db, col, id, variant) where variant identifies what is cached
+    for the image, e.g. ('array', level) or ('encoded', level, mimetype).
+    All entries of an image can be invalidated at once by (db, col, id).
+    An image invalidated while it is loaded is not cached by that load.
+    """
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        # byte budget (0 disables the cache)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key: (db, col, id, variant), value: (value, nbytes)
+        self.entries = OrderedDict()
+        # key: (db, col, id), value: set of keys
+        self.images = {}
+        # images being loaded, key: (db, col, id),
+        # value: [the number of loads, generation bumped by invalidate()]
+        self.loading = {}
+        self.nbytes = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Get a cached value (None on miss)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """Cache a value, evicting least recently used entries if needed"""
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            self._insert(key, value, nbytes)
+
+    def get_or_load(self, key, loader, sizeof):
+        """
+        Get a cached value, or load and cache it on miss.
+        Loading is done outside the lock; None is not cached, nor a value
+        of an image invalidated while loading (it can be the old one).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        image = key[:3]
+        with self.lock:
+            state = self.loading.setdefault(image, [0, 0])
+            state[0] += 1
+            generation = state[1]
+        value = None
+        try:
+            value = loader()
+            nbytes = sizeof(value) if value is not None else 0
+        finally:
+            with self.lock:
+                state = self.loading[image]
+                state[0] -= 1
+                if not state[0]:
+                    del self.loading[image]
+                if value is not None and state[1] == generation and \
+                        nbytes <= self.max_bytes:
+                    self._insert(key, value, nbytes)
+        return value
+
+    def invalidate(self, db, col, ids):
+        """Drop all entries of images (ids of documents) in a collection"""
+        with self.lock:
+            for id in ids:
+                state = self.loading.get((db, col, str(id)))
+                if state is not None:
+                    state[1] += 1
+                keys = self.images.get((db, col, str(id)))
+                if keys is None:
+                    continue
+                for key in list(keys):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.images.clear()
+            for state in self.loading.values():
+                state[1] += 1
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+    def _insert(self, key, value, nbytes):
+        """Insert an entry, lock must be held"""
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (value, nbytes)
+        self.images.setdefault(key[:3], set()).add(key)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.max_bytes:
+            old_key = next(iter(self.entries))
+            self._remove(old_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """Remove an entry, lock must be held"""
+        _, nbytes = self.entries.pop(key)
+        self.nbytes -= nbytes
+        keys = self.images.get(key[:3])
+        if keys is not None:
+            keys.discard(key)
+            if not len(keys):
+                del self.images[key[:3]]
+
+
+class QueryCache(object):
+    """
+    Versioned cache of query results, with a byte budget and a TTL.
+
+    Each collection (db, col) has a version counter that is bumped when
+    documents are written to it. A cached result is stored along with the
+    versions of the collections it is read from, so a write makes it
+    unreachable without tracking which results it affects; unreachable
+    entries are evicted by LRU or TTL.
+
+    Results are either values (get_or_load) or streams of chunks (stream),
+    e.g. JSON encoded responses.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300):
+        # byte budget (0 disables the cache)
+        self.max_bytes = max_bytes
+        # seconds an entry is valid (None: no expiration)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key: (versions, key), value: (value, nbytes, expires at)
+        self.entries = OrderedDict()
+        # key: (db, col), value: version
+        self.versions = {}
+        # key: (db, col), value: time (UTC) of the last write
+        self.modified = {}
+        # key: (db, col), value: version kept in the database (colversion)
+        self.observed = {}
+        # writes before the cache is created are unknown
+        self.created = datetime.datetime.utcnow()
+        self.nbytes = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def bump(self, db, col):
+        """A collection is written, results read from it are outdated"""
+        with self.lock:
+            self.versions[(db, col)] = self.versions.get((db, col), 0) + 1
+            self.modified[(db, col)] = datetime.datetime.utcnow()
+
+    def observe(self, db, col, version, modified=None):
+        """
+        A version of a collection kept in the database, bumped by writers
+        of any process. A change is handled as a write to the collection.
+        """
+        with self.lock:
+            if self.observed.get((db, col)) == version:
+                return
+            self.observed[(db, col)] = version
+            self.versions[(db, col)] = self.versions.get((db, col), 0) + 1
+            if modified is None:
+                modified = datetime.datetime.utcnow()
+            # never goes back
+            prev = self.modified.get((db, col))
+            self.modified[(db, col)] = modified if prev is None else max(prev, modified)
+
+    def validators(self, collections):
+        """
+        Current versions of collections [(db, col)] and the time of the
+        last write to them (UTC), to validate results read from them.
+        """
+        with self.lock:
+            versions = tuple(
+                (db, col, self.versions.get((db, col), 0))
+                for db, col in collections)
+            modified = max([self.modified.get(c, self.created)
+                            for c in collections] + [self.created])
+        return versions, modified
+
+    def _versioned(self, collections, key):
+        """Key with current versions of collections [(db, col)]"""
+        return self.validators(collections)[0], key
+
+    def get(self, vkey):
+        """Get a cached value by a versioned key (None on miss)"""
+        with self.lock:
+            entry = self.entries.get(vkey)
+            if entry is not None and self.ttl is not None and \
+                    entry[2] < time.time():
+                self._remove(vkey)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(vkey)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, vkey, value, nbytes):
+        """Cache a value, evicting least recently used entries if needed"""
+        if nbytes > self.max_bytes:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if vkey in self.entries:
+                self._remove(vkey)
+            self.entries[vkey] = (value, nbytes, expires)
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_load(self, collections, key, loader, sizeof):
+        """
+        Get a cached result, or load and cache it on miss.
+        Versions are taken before loading, so a result loaded while the
+        collections are written is never served after the write.
+        Args:
+            collections: list of (db, col) the result is read from
+            key: hashable key of the query
+            loader: function to load the result
+            sizeof: function returning approximate bytes of a result
+        """
+        vkey = self._versioned(collections, key)
+        value = self.get(vkey)
+        if value is not None:
+            return value
+        value = loader()
+        if value is not None:
+            self.put(vkey, value, sizeof(value))
+        return value
+
+    def stream(self, collections, key, make_stream):
+        """
+        Stream cached chunks, or stream from `make_stream()` and cache the
+        chunks once the stream is completed (str chunks, sized by length).
+        """
+        vkey = self._versioned(collections, key)
+        chunks = self.get(vkey)
+        if chunks is not None:
+            yield from chunks
+            return
+
+        chunks = []
+        nbytes = 0
+        for chunk in make_stream():
+            if chunks is not None:
+                nbytes += len(chunk)
+                if nbytes > self.max_bytes:
+                    # too large to cache, just stream
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.put(vkey, chunks, nbytes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _remove(self, vkey):
+        """Remove an entry, lock must be held"""
+        _, nbytes, _ = self.entries.pop(vkey)
+        self.nbytes -= nbytes
+
+
+def samplelist_nbytes(samplelist):
+    """Rough size of a sample list (a count per sample)"""
+    return 64 * len(samplelist) + 64
+
+
+def image_nbytes(img_doc:dict):
+    """Size of an image subdocument with its array to account in the cache"""
+    return img_doc['data'].nbytes + _IMG_DOC_OVERHEAD
+
+
+def freeze_image(img_doc:dict):
+    """Make array of an image subdocument read-only, as it is shared"""
+    if img_doc is not None:
+        img_doc['data'].flags.writeable = False
+    return img_doc
@@ -0,0 +1,51 @@
+"""
+Versions of collections kept in the database
+
+QueryCache versions only count writes made by this process. Writes by
+other processes (the other app, a second server on the same database,
+admin.py) are tracked by a version document per collection, kept in the
+`collection_versions` collection of its database:
+    {'_id': collection name, 'version': int, 'modified': datetime (UTC)}
+
+Every writer bumps it after writing documents (see save_documents_bulk(),
+rebuild_samplelist() and migrate_arrays()), and validators of query
+results read it, so they change with writes of any process.
+"""
+import datetime
+
+# collection of version documents in each database
+VERSIONS_COLLECTION = 'collection_versions'
+
+
+def bump_version(colCursor):
+    """A collection is written, bump its version document"""
+    colCursor.database[VERSIONS_COLLECTION].update_one(
+        {'_id': colCursor.name},
+        {'$inc': {'version': 1},
+         '$set': {'modified': datetime.datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def read_versions(conn, collections):
+    """
+    Read version documents of collections, one query per database
+    Args:
+        conn: MongoClient
+        collections: [(db, col)]
+
+    Returns:
+        {(db, col): (version, modified)}, (0, None) if never bumped
+    """
+    by_db = {}
+    for db, col in collections:
+        by_db.setdefault(db, []).append(col)
+
+    versions = {}
+    for db, cols in by_db.items():
+        for col in cols:
+            versions[(db, col)] = (0, None)
+        query = {'_id': {'$in': cols}}
+        for doc in conn[db][VERSIONS_COLLECTION].find(query):
+            versions[(db, doc['_id'])] = (doc.get('version', 0), doc.get('modified'))
+    return versions
@@ -0,0 +1,177 @@
+"""
+Negotiated response compression (gzip / deflate)
+
+Responses are compressed when the client accepts it, unless they are
+small, already compressed (e.g. png) or already encoded. Streaming
+responses are compressed chunk by chunk as they are produced: the first
+chunks are read ahead up to the size threshold to decide whether to
+compress, and the rest is compressed while streaming.
+
+Compressed responses get a weak ETag, since the bytes differ from the
+identity encoding while the content is the same. `304 Not Modified`
+responses of compressible types get the same weak ETag and Vary as the
+response they revalidate (set its mimetype to tell the type).
+"""
+import time
+import zlib
+import threading
+
+# mimetypes which are already compressed
+COMPRESSED_MIMETYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'application/gzip', 'application/zip'
+}
+
+# mimetypes never compressed (event streams must not be buffered)
+SKIP_MIMETYPES = COMPRESSED_MIMETYPES | {'text/event-stream'}
+
+# zlib window bits of encodings
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _to_bytes(chunk):
+    """Streamed chunks can be str (encoded in utf-8 as werkzeug does)"""
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def _weaken_etag(response):
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
+
+
+class Compressor(object):
+    def __init__(self, level=6, min_bytes=1024, encodings=('gzip', 'deflate')):
+        # zlib compression level (1: fastest, 9: smallest)
+        self.level = level
+        # responses smaller than this are sent as they are
+        self.min_bytes = min_bytes
+        # supported encodings, in the order of preference
+        self.encodings = [e for e in encodings if e in _WBITS]
+
+        # metrics, protected by lock
+        self.lock = threading.Lock()
+        self.responses = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.
+
+    def _record(self, bytes_in, bytes_out, cpu_time, response=False):
+        with self.lock:
+            self.responses += int(response)
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_time += cpu_time
+
+    def _skip(self):
+        with self.lock:
+            self.skipped += 1
+
+    def _compressobj(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+
+    def compress(self, data:bytes, encoding):
+        """Compress a whole body"""
+        t = time.thread_time()
+        c = self._compressobj(encoding)
+        out = c.compress(data) + c.flush()
+        self._record(len(data), len(out), time.thread_time() - t, True)
+        return out
+
+    def compress_stream(self, chunks, encoding):
+        """Compress chunks (bytes) while streaming them"""
+        c = self._compressobj(encoding)
+        self._record(0, 0, 0., True)
+        for chunk in chunks:
+            t = time.thread_time()
+            # sync flush, so that a chunk is sent as soon as it is produced
+            out = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+            self._record(len(chunk), len(out), time.thread_time() - t)
+            if len(out):
+                yield out
+        t = time.thread_time()
+        out = c.flush()
+        self._record(0, len(out), time.thread_time() - t)
+        if len(out):
+            yield out
+
+    def compress_response(self, response, accept_encodings):
+        """
+        Compress a response (werkzeug) in place, if the client accepts it
+        Args:
+            response: response to send
+            accept_encodings: accepted encodings of the request
+
+        Returns:
+            the response
+        """
+        if response.status_code == 304:
+            return self._revalidated(response, accept_encodings)
+        if response.status_code != 200 or \
+                'Content-Encoding' in response.headers or \
+                response.direct_passthrough or \
+                response.mimetype in SKIP_MIMETYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            # read ahead to find out if it is worth compressing
+            it = iter(response.response)
+            head = []
+            size = 0
+            done = False
+            while size < self.min_bytes:
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    done = True
+                    break
+                chunk = _to_bytes(chunk)
+                head.append(chunk)
+                size += len(chunk)
+
+            if done:
+                # small stream, send it as a whole
+                response.set_data(b''.join(head))
+                return self.compress_response(response, accept_encodings)
+
+            def _chunks():
+                yield from head
+                for chunk in it:
+                    yield _to_bytes(chunk)
+            response.response = self.compress_stream(_chunks(), encoding)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_bytes:
+                self._skip()
+                return response
+            response.set_data(self.compress(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        _weaken_etag(response)
+        return response
+
+    def _revalidated(self, response, accept_encodings):
+        """Headers of a 304 response as the revalidated 200 would have"""
+        if response.mimetype in SKIP_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if accept_encodings.best_match(self.encodings) is not None:
+            _weaken_etag(response)
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                'responses': self.responses,
+                'skipped': self.skipped,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.bytes_in / self.bytes_out if self.bytes_out else 0.,
+                'cpu_time': self.cpu_time
+            }
@@ -0,0 +1,134 @@
+"""
+Process-wide registry of MongoDB clients and handles
+
+A MongoClient holds a connection pool and is safe to share between
+threads, so one client per (host, port) is kept for the whole process.
+Handles built on top of it (collections with their indexes ensured,
+GridFS objects, wrappers) are cached by key, so that they are set up once
+instead of on every request.
+"""
+import time
+import threading
+import pymongo
+import pymongo.errors
+
+# CONFIG['DB'] keys to MongoClient options
+_CLIENT_OPTIONS = {
+    'MAX_POOL_SIZE': 'maxPoolSize',
+    'MIN_POOL_SIZE': 'minPoolSize',
+    'CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'HEARTBEAT_FREQUENCY_MS': 'heartbeatFrequencyMS',
+}
+
+
+def client_options(db_config:dict):
+    """MongoClient options from db config (CONFIG['DB']), None is ignored"""
+    return {
+        option: db_config[key]
+        for key, option in _CLIENT_OPTIONS.items()
+        if db_config.get(key) is not None
+    }
+
+
+class HandleRegistry(object):
+    def __init__(self, health_interval=30):
+        self.lock = threading.Lock()
+        # key: (host, port), value: MongoClient
+        self.clients = {}
+        # key: tuple, value: handle
+        self.handles = {}
+        # key: tuple, value: lock held while the handle is created
+        self.creating = {}
+        # seconds a health check result is reused
+        self.health_interval = health_interval
+        # key: (host, port), value: (checked at, result)
+        self.health = {}
+
+    def client(self, host='localhost', port=27017, **options):
+        """
+        Get the shared client of a server. Options only apply when the
+        client is created (the first caller wins).
+        """
+        key = (host, port)
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                client = pymongo.MongoClient(host, port, **options)
+                self.clients[key] = client
+            return client
+
+    def handle(self, key:tuple, factory):
+        """
+        Get a cached handle, or create it by `factory()`.
+        The factory runs outside the registry lock (e.g. it may create
+        indexes), under a lock of the key, so it runs once per key while
+        concurrent callers of the key wait for its handle.
+        """
+        with self.lock:
+            h = self.handles.get(key)
+            if h is not None:
+                return h
+            key_lock = self.creating.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                h = self.handles.get(key)
+            if h is None:
+                h = factory()
+                with self.lock:
+                    self.handles[key] = h
+                    self.creating.pop(key, None)
+        return h
+
+    def check_health(self, host='localhost', port=27017, force=False):
+        """
+        Ping a server (results are reused for `health_interval` seconds)
+        Returns:
+            {'ok': bool, 'latency_ms': float, 'error': str or None}
+        """
+        key = (host, port)
+        with self.lock:
+            checked = self.health.get(key)
+        if not force and checked is not None and \
+                time.time() - checked[0] < self.health_interval:
+            return checked[1]
+
+        client = self.client(host, port)
+        t = time.time()
+        try:
+            client.admin.command('ping')
+            result = {'ok': True, 'error': None}
+        except pymongo.errors.PyMongoError as ex:
+            result = {'ok': False, 'error': str(ex)}
+        result['latency_ms'] = (time.time() - t) * 1000.
+
+        with self.lock:
+            self.health[key] = (time.time(), result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'clients': ['{}:{}'.format(h, p) for h, p in self.clients],
+                'handles': len(self.handles),
+                'health': {
+                    '{}:{}'.format(h, p): result
+                    for (h, p), (_, result) in self.health.items()
+                }
+            }
+
+    def close(self):
+        """Close all clients (at exit)"""
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+            self.handles.clear()
+            self.creating.clear()
+            self.health.clear()
+
+
+# the registry of this process
+registry = HandleRegistry()
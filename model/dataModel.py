@@ -1,8 +1,9 @@
 import os
 import threading
 import time
-import pymongo
 import json
+import atexit
+import numpy as np
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 from threading import get_ident
@@ -10,11 +11,38 @@ from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 from db.multiviewmongo import MultiViewMongo
 from model.syncer import Syncer
-from queue import Queue
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 from model.parser import Parser
+from model.database import save_documents_bulk, load_image_region
+from model.database import load_xml_samples, group_by_sample
+from model.database import sample_stats_pipeline, merge_sample_stats
+from model.database import find_image_file
+from model.imagecodec import encode_image, image_headers
+from model.cache import ImageCache, image_nbytes, freeze_image
+from model.cache import QueryCache, samplelist_nbytes
+from model.httpcache import EPOCH, make_etag
+from model.colversion import read_versions
+from model.connection import registry
+from model.serializer import ColumnarBuilder, stream_samples, stream_json
+from model.serializer import merge_by_sample, merge_by_item, stream_ndjson
+from model.binning import bin_2d, collect_fields, field_projection
+from model.samplelist import inc_samplelist, read_samplelist
+from model.walker import walk_dirs
+from model.fsmapstore import FsmapStore
+from model.fsmap import FsMap, FsNode
 import datetime
 
 
+def _copy_settings(src:FsNode, dst:FsNode):
+    """Copy fsmap fields set by clients (or manually) to a new node"""
+    dst.db = src.db
+    dst.fixed = src.fixed
+    dst.file = src.file
+    dst.sep = src.sep
+    dst.group = src.group
+    dst.last_sync = src.last_sync
+
 def replace_objid_to_str(doc):
     if not isinstance(doc, dict):
         return doc
@@ -187,7 +215,13 @@ class DBHandler(object):
             fsmapFn,
             db_host='localhost',
             db_port=27017,
-            xml_config=None
+            xml_config=None,
+            image_cache_bytes=512 * 1024 * 1024,
+            query_cache_bytes=64 * 1024 * 1024,
+            query_cache_ttl=300,
+            db_options=None,
+            walk_workers=8,
+            fsmap_check_interval=300
     ):
         self.rootDir = os.path.realpath(os.path.abspath(rootDir))
         self.fsmapFn = fsmapFn
@@ -198,166 +232,310 @@ class DBHandler(object):
 
         self.extensions = ['.xml', '.jpg', '.tiff']
 
+        # the number of threads listing directories in a traversal
+        self.walk_workers = walk_workers
+
+        # the number of syncing events stored in db at once
+        self.sync_batch_size = 100
+
         # to ensure safe operation on fsmap
         self.fsmap_lock = threading.Lock()
 
+        # seconds between consistency checks of the fsmap (full traversal)
+        self.fsmap_check_interval = fsmap_check_interval
+        self.fsmap_checked = 0
+        # bumped by every change of the fsmap (see `_save()`)
+        self.fsmap_version = 0
+        # (fsmap version, list, json) of the last fsmap response
+        self.fsmap_response = (-1, None, None)
+        # (fsmap version, nested) of the last snapshot
+        self.fsmap_nested = (-1, None)
+
+        # snapshot and journal of the fsmap
+        self.fsmap_store = FsmapStore(self.fsmapFn, self._fsmap_snapshot)
         self.fsMap = self._load()
         self._traverse()
-        self._save() # for debuggin...
+        self.fsmap_store.start()
+        self._save()
 
-        # lazy connection to MongoDB server
+        # lazy connection to MongoDB server, shared by the process
+        # (db_options: MongoClient options, see client_options())
         # Must ensure mongod is running!
-        self.client = pymongo.MongoClient(self.db_host, self.db_port)
-        self.clientPool = {}
+        self.client = registry.client(self.db_host, self.db_port,
+                                      **(db_options or {}))
+
+        # cache of decoded images and encoded responses
+        self.image_cache = ImageCache(max_bytes=image_cache_bytes)
+        # cache of query results, versioned per collection
+        self.query_cache = QueryCache(max_bytes=query_cache_bytes,
+                                      ttl=query_cache_ttl)
+
+        # thread pool to query multiple collections concurrently
+        self.query_pool = ThreadPoolExecutor(max_workers=4)
+        atexit.register(self.close)
 
         # streaming queues
         self.fs_event_q = Queue()
         self.stream_q = Queue()
 
-        # old map
-        # This keeps old fsmap information when file system changes manually
-        # e.g. folder move, rename, etc
-        # If it is not empty dictionary, there is a bug....
-        self._old_fsmap = {}
 
-    def __del__(self):
-        for _, h in self.clientPool.items():
-            h.close()
-        self.client.close()
+    def close(self):
+        """
+        Stop background work (at exit). The client and handles are shared
+        by the process (registry).
+        """
+        self.query_pool.shutdown(wait=False)
 
     def _load(self):
-        if not os.path.exists(self.fsmapFn): return {}
+        """Load the fsmap (snapshot and journal)"""
+        return FsMap.from_items(self.fsmap_store.load())
 
-        try:
-            with open(self.fsmapFn) as f:
-                data = json.load(f)
-        except (FileNotFoundError, TypeError, json.decoder.JSONDecodeError):
-            print('[WARN] Failed to load saved fsmap, {}!!!'.format(self.fsmapFn))
-            print('[WARN] Previous fsmap will be ignored, if there is.')
-            return {}
+    def _save(self, paths=None):
+        """
+        Queue changes of the fsmap to save, written by the flusher thread
+        Args:
+            paths: changed paths (None: the whole fsmap as a snapshot)
+        """
+        self.fsmap_version += 1
+        if paths is None:
+            self.fsmap_store.save()
+        else:
+            self.fsmap_store.save({
+                path: self.fsMap.to_item(path) if path in self.fsMap else None
+                for path in paths
+            })
 
-        def __recursive_flatten(fsmap:dict, flattened:dict):
-            item = dict(fsmap)
-            item['children'] = [__recursive_flatten(child, flattened) for child in item['children']]
-            flattened[item['path']] = item
+    def _fsmap_snapshot(self):
+        """
+        The whole fsmap in the nested format (called by the flusher),
+        converted once per version of the fsmap
+        """
+        with self.fsmap_lock:
+            version, nested = self.fsmap_nested
+            if version != self.fsmap_version:
+                nested = self.fsMap.to_nested()
+                self.fsmap_nested = (self.fsmap_version, nested)
+            return nested
+
+    def _scan(self):
+        """A new fsmap of the root directory, without settings"""
+        fsmap = FsMap()
+        for dirpath in walk_dirs(self.rootDir, self.walk_workers):
+            if dirpath == self.rootDir:
+                fsmap.add(dirpath)
+            else:
+                fsmap.add(dirpath, os.path.dirname(dirpath))
 
-        t = {}
-        for key, value in data.items():
-            __recursive_flatten(value, t)
-        return t
+        # update for symlink
+        for key, value in fsmap.items():
+            if value.realpath is not None and value.realpath in fsmap:
+                fsmap[value.realpath].link = key
+                value.link = value.realpath
+        return fsmap
+
+    def _replace_fsmap(self, fsmap):
+        """Replace the fsmap by a scanned one, keeping settings"""
+        for _path, _srcItem in self.fsMap.items():
+            if _path in fsmap:
+                # Is parent same? yes, it must be same as key is the absolute path.
+                # But children could be different. For example, one might delete/move/add
+                # sub-directories. But, we do not care, here.
+                _copy_settings(_srcItem, fsmap[_path])
+            else:
+                # This branch can happen when one delete/move/add subdirectories.
+                # Keep it, so that one can fix it manually in the json file.
+                _dstItem = fsmap.add(_path, realpath=self.fsMap.realpath(_path),
+                                     name=_srcItem.name)
+                _copy_settings(_srcItem, _dstItem)
+                _dstItem.valid = False
+        self.fsMap = fsmap
+        self.fsmap_version += 1
 
-    def _save(self):
-        def __convert_to_hierarchical_format(key: str, fsmap: dict):
-            item = dict(fsmap[key])
-            item['children'] = [__convert_to_hierarchical_format(c, fsmap) for c in item['children']]
-            return item
+    def _traverse(self):
+        """Traverse root directory"""
+        self.fsmap_checked = time.time()
+        self._replace_fsmap(self._scan())
 
-        t = {}
-        p_keys = [key for key, value in self.fsMap.items() if value['parent'] is None]
+    def _fsmap_present(self, path):
+        """True if a directory is in the fsmap (not a left-over invalid item)"""
+        return path in self.fsMap and self.fsMap[path].valid
 
-        for key in p_keys: t[key] = __convert_to_hierarchical_format(key, self.fsMap)
-        with open(self.fsmapFn, 'w') as f:
-            json.dump(t, f, indent=2, sort_keys=True)
+    def _link_fsmap(self, paths):
+        """
+        Update links of symlinked directories among `paths`
+        Returns:
+            paths of the linked directories
+        """
+        linked = set()
+        for key in paths:
+            value = self.fsMap[key]
+            if value.realpath is not None and self._fsmap_present(value.realpath):
+                self.fsMap[value.realpath].link = key
+                value.link = value.realpath
+                linked.add(value.realpath)
+        return linked
+
+    def _unlink_fsmap(self, path):
+        """
+        Clear the link to a directory being removed or moved
+        Returns:
+            paths of the unlinked directories
+        """
+        node = self.fsMap[path]
+        link = node.link
+        node.link = None
+        if link is not None and link in self.fsMap and \
+                self.fsMap[link].link == path:
+            self.fsMap[link].link = None
+            return {link}
+        return set()
+
+    def _insert_fsmap(self, path):
+        """
+        Insert a (created or moved in) directory and its sub-directories
+        Returns:
+            changed paths
+        """
+        if self._fsmap_present(path):
+            return set()
+        if not path.startswith(self.rootDir + os.sep):
+            return set()
+        parent = os.path.dirname(path)
+        if not self._fsmap_present(parent):
+            # events can arrive before the event of its parent
+            return self._insert_fsmap(parent)
+
+        changed = set()
+        inserted = []
+        for dirpath in walk_dirs(path, self.walk_workers):
+            if self._fsmap_present(dirpath):
+                continue
+            old = self.fsMap.get(dirpath)
+            if old is not None:
+                self.fsMap.remove(dirpath)
+            dir_parent = os.path.dirname(dirpath)
+            node = self.fsMap.add(dirpath, dir_parent)
+            if old is not None:
+                # left-over of a directory which comes back, restore settings
+                _copy_settings(old, node)
+            changed.add(dir_parent)
+            inserted.append(dirpath)
+
+        changed.update(inserted)
+        changed.update(self._link_fsmap(inserted))
+        return changed
+
+    def _remove_fsmap(self, path, keep_settings=True):
+        """
+        Remove a (deleted or moved out) directory and its sub-directories.
+        Items with db settings are kept as invalid, so that one can fix it
+        manually in the json file (as a full traversal does).
 
-    def _traverse(self, save_old=False):
-        """Traverse root directory"""
-        fsmap = {}
-        for dirpath, _, _ in os.walk(self.rootDir, followlinks=True):
-            path = dirpath.replace(self.rootDir, '')
-            tokens = path.split(os.sep)[1:]
-            parent_path = os.path.join(self.rootDir, *tokens[:-1])
-
-            real_path = os.path.realpath(dirpath)
-            if len(path) == 0:
-                name = dirpath
-                parent = None
+        Returns:
+            changed paths
+        """
+        if not self._fsmap_present(path):
+            return set()
+        parent = self.fsMap.parent_path(path)
+        if parent is None:
+            return set()
+
+        changed = {parent}
+        for p in self.fsMap.subtree(path):
+            changed.add(p)
+            changed.update(self._unlink_fsmap(p))
+            if keep_settings and self.fsMap[p].db is not None:
+                self.fsMap.detach(p)
             else:
-                name = os.path.basename(path)
-                fsmap[parent_path]['children'].append(dirpath)
-                parent = fsmap[parent_path]['path']
-
-            fsmap[dirpath] = {
-                'path': dirpath,        # absolute path to current directory
-                'realpath': real_path,  # realpath for symlink
-                'name': name,           # name of current directory for display
-                'children': [],         # list of absolute pathes of direct children directories
-                'parent': parent,       # absolute path to direct parent directory
-                'link': None,           # linked path
-
-                # valid path flag
-                # It will turn into False, if the given path doesn't exist by
-                #  comparing with fsmap in the file.
-                'valid': True,          # valid path flag
-
-                # This set to Ture, once a client set the `db` field.
-                # Then, `db` filed can be modified only manually via fsmap file.
-                # Such modification requires to re-run the web server.
-                'db': None,  # related database (db, collection)
-                'fixed': False,         # can modify?
-
-                # used for syncing
-                'file': None,  # sample file name used to determine group name
-                'sep': None,   # separator used to parse group name from the file
-                'group': None, # group name in this folder
-                'last_sync': None, # the last date and time sync is applied
-            }
+                self.fsMap.remove(p)
+        return changed
 
-        # update for symlink
-        for key, value in fsmap.items():
-            if not (key == value['realpath']):
-                if value['realpath'] in fsmap:
-                    fsmap[value['realpath']]['link'] = key
-                    value['link'] = fsmap[value['realpath']]['path']
-
-        # save unregistered fsmap from old one
-        if save_old:
-            for key, value in self.fsMap.items():
-                if key not in fsmap:
-                    self._old_fsmap[key] = dict(value)
-
-        _keys_to_copy = ['valid', 'db', 'fixed', 'file', 'sep', 'group',
-                         'last_sync']
-        def __merge_fsmap(dstMap:dict, srcMap:dict):
-            for _path, _srcItem in srcMap.items():
-                if _path in dstMap:
-                    # Is parent same? yes, it must be same as key is the absolute path.
-                    # But children could be different. For example, one might delete/move/add
-                    # sub-directories. But, we do not care, here.
-                    _dstItem = dstMap[_path]
-                    for _k in _keys_to_copy:
-                        _dstItem[_k] = _srcItem[_k]
-                else:
-                    # This branch can happen when one delete/move/add subdirectories.
-                    # Keep it, so that one can fix it manually in the json file.
-                    _srcItem['children'] = []
-                    _srcItem['parent'] = None
-                    _srcItem['valid'] = False
-                    #srcItem['inSync'] = False
-                    dstMap[key] = _srcItem
-        __merge_fsmap(fsmap, self.fsMap)
-        self.fsMap = fsmap
+    def _move_fsmap(self, src_path, dst_path):
+        """
+        Move a directory and its sub-directories, keeping their settings
+        Returns:
+            changed paths
+        """
+        if not self._fsmap_present(src_path):
+            # e.g. moved events of sub-directories after their parent's
+            return self._insert_fsmap(dst_path)
+        dst_parent = os.path.dirname(dst_path)
+        if not self._fsmap_present(dst_parent):
+            # moved out of the root (or under an unknown directory)
+            return self._remove_fsmap(src_path) | self._insert_fsmap(dst_path)
+
+        changed = set()
+        if dst_path in self.fsMap:
+            # replaced, or a left-over of the same path
+            if self._fsmap_present(dst_path):
+                changed.update(self._remove_fsmap(dst_path, keep_settings=False))
+            else:
+                self.fsMap.remove(dst_path)
+
+        changed.update([self.fsMap.parent_path(src_path), dst_parent])
+        # links by path break, moved symlinks are linked again below
+        for p in self.fsMap.subtree(src_path):
+            changed.update(self._unlink_fsmap(p))
+
+        moved = self.fsMap.move(src_path, dst_path, dst_parent)
+        changed.update(old_p for old_p, _ in moved)
+        changed.update(new_p for _, new_p in moved)
+        changed.update(self._link_fsmap([new_p for _, new_p in moved]))
+        return changed
 
     def _update_fsmap(self, event_type, src_path, dst_path):
-        """Invoked when filesystem changes (only for directory changes)"""
+        """
+        Invoked when filesystem changes (only for directory changes)
+        Events are applied as patches of the fsmap, while a full traversal
+        only runs as a periodic check (see `_check_fsmap()`).
+        """
+        src_path = os.path.normpath(src_path)
         with self.fsmap_lock:
-            if event_type in ['created', 'deleted']:
-                # on create and delete operation, refresh entire fsmap
-                self._traverse()
-                self._save()
+            changed = set()
+            if event_type == 'created':
+                changed = self._insert_fsmap(src_path)
+            elif event_type == 'deleted':
+                changed = self._remove_fsmap(src_path)
             elif event_type in ['moved'] and dst_path is not None:
                 # moved event includes 'rename' and 'relocate a folder'
-                cp_key = ['db', 'file', 'fixed', 'group', 'last_sync', 'sep']
-
-                self._traverse(True)
-                if src_path in self._old_fsmap and dst_path in self.fsMap:
-                    old_item = self._old_fsmap[src_path]
-                    new_item = self.fsMap[dst_path]
-                    for k, v in old_item.items():
-                        if k in cp_key:
-                            new_item[k] = v
-                    del self._old_fsmap[src_path]
-                else:
-                    print('Error in handling DirMovedEvent: ', src_path, dst_path)
+                changed = self._move_fsmap(src_path, os.path.normpath(dst_path))
+            if len(changed):
+                self._save(changed)
+
+    def _check_fsmap(self, force=False):
+        """
+        Consistency check of the fsmap by a full traversal (e.g. changes
+        missed by the observer on network filesystems), at most once in
+        `fsmap_check_interval` seconds. A scan is dropped if the fsmap is
+        changed while walking, and retried at the next check (not sooner,
+        as the time of a check is taken before walking).
+
+        Returns:
+            True if it is checked
+        """
+        if not force and \
+                time.time() - self.fsmap_checked < self.fsmap_check_interval:
+            return False
+        self.fsmap_checked = time.time()
+
+        def _structure():
+            return {k: (v.valid, self.fsMap.parent_path(k))
+                    for k, v in self.fsMap.items()}
+
+        # walk without the lock, which only protects the replacement
+        with self.fsmap_lock:
+            version = self.fsmap_version
+        fsmap = self._scan()
+        with self.fsmap_lock:
+            if version != self.fsmap_version:
+                # changed while walking, the scan can be older than it
+                return False
+            before = _structure()
+            self._replace_fsmap(fsmap)
+            if before != _structure():
+                print('fsmap is updated by the consistency check')
+                self._save()
+        return True
 
     def _db_key(self, _db, _col, _fs):
         _key = '{:s}::{:s}::{:s}'.format(_db, _col, _fs)
@@ -368,7 +546,7 @@ class DBHandler(object):
         def __recursive_db(_path, fsmap):
             if _path not in fsmap: return
 
-            _db = fsmap[_path]['db']
+            _db = fsmap[_path].db
             if _db is None: return
 
             _key = self._db_key(_db[0], _db[1], _db[2])
@@ -379,44 +557,33 @@ class DBHandler(object):
                     _key_list.append(_key)
 
             if recursive:
-                for _c_path in fsmap[_path]['children']:
+                for _c_path in fsmap.children_paths(_path):
                     __recursive_db(_c_path, fsmap)
         __recursive_db(path, self.fsMap)
         return _key_list
 
     def _get_db_handler(self, db_col_fs):
         _db, _col, _fs = db_col_fs
-        _key = self._db_key(_db, _col, _fs)
-        if _key in self.clientPool:
-            return self.clientPool[_key]
-        else:
-            _h = MultiViewMongo(
-                connection=self.client,
-                db_name=_db,
-                collection_name=_col,
-                fs_name=_fs
-            )
-            self.clientPool[_key] = _h
-            return _h
+        return self._get_db_handler_by_key(self._db_key(_db, _col, _fs))
 
     def _get_db_handler_by_key(self, key:str):
-        if key in self.clientPool:
-            return self.clientPool[key]
-        else:
+        """Get a (shared) MultiViewMongo handle of a db key"""
+        def _create():
             tokens = key.split('::')
-            _h = MultiViewMongo(
+            return MultiViewMongo(
                 connection=self.client,
                 db_name=tokens[0],
                 collection_name=tokens[1],
                 fs_name=tokens[2]
             )
-            self.clientPool[key] = _h
-            return _h
+        return registry.handle((self.db_host, self.db_port, 'multiview', key),
+                               _create)
 
-    def _update_file(self, event_type, src_path, dst_path):
-        """Invoked when files change
-            By watchdog:
-            By syncer:
+    def _resolve_file(self, src_path, dst_path):
+        """
+        Validate a changed file and find where to store it
+        Returns:
+            (path to file, extension, db, group) or None
         """
         if self.parser is None:
             print('parser is not set.')
@@ -440,23 +607,37 @@ class DBHandler(object):
         if path not in self.fsMap:
             print("Path is not in fsmap. {:s}".format(path))
             return None
-        if self.fsMap[path]['db'] is None:
+        if self.fsMap[path].db is None:
             print("DB is not set on this path. {:s}".format(path))
             return None
-        if self.fsMap[path]['group'] is None:
+        if self.fsMap[path].group is None:
             print("Group name is not set to this path. {:s}".format(path))
             return None
-        db = self.fsMap[path]['db']
-        group = self.fsMap[path]['group']
+        db = self.fsMap[path].db
+        group = self.fsMap[path].group
+        return _path, ext, db, group
+
+    def _parse_file(self, path, ext, group):
+        """Parse a file, `ext` comes with the leading dot"""
+        return self.parser.run(path, ext[1:], group, None)
+
+    def _update_file(self, event_type, src_path, dst_path):
+        """Invoked when files change
+            By watchdog:
+            By syncer:
+        """
+        resolved = self._resolve_file(src_path, dst_path)
+        if resolved is None:
+            return None
+        _path, ext, db, group = resolved
 
         if event_type in ['created', 'modified', 'syncing', 'moved']:
-            doc = self.parser.run(_path, ext, group)
+            doc = self._parse_file(_path, ext, group)
             if doc is None:
                 return None
 
             h = self._get_db_handler(db)
-            if h.save_one(doc, ext) == 0:
-                return None
+            self._save_documents(h, db, [doc])
 
             if ext == '.xml':
                 query = {"sample": group, "item": doc['item']}
@@ -473,6 +654,67 @@ class DBHandler(object):
 
         return None
 
+    def _save_documents(self, h, db, docs):
+        """
+        Store documents with bulk writes, dropping cached images of
+        overwritten documents and cached query results of the collection,
+        and updating the sample list summary.
+        """
+        _db, _col = db[0], db[1]
+        try:
+            return save_documents_bulk(
+                h.collection, h.fs, docs,
+                batch_size=self.sync_batch_size, fs=h.fs_name,
+                on_overwrite=lambda ids: self.image_cache.invalidate(_db, _col, ids),
+                count_by='path',
+                on_count=lambda deltas: inc_samplelist(h.samplelist, deltas)
+            )
+        finally:
+            # cached query results of the collection are outdated
+            self.query_cache.bump(_db, _col)
+
+    def _update_files_bulk(self, events):
+        """
+        Invoked with a batch of syncing events
+        Documents are stored with a bulk write per database.
+
+        Returns:
+            list of responses to stream (one per xml document)
+        """
+        docs = {}
+        xml_items = {}
+        for _, event_type, src_path, dst_path in events:
+            if event_type not in ['created', 'modified', 'syncing', 'moved']:
+                continue
+            resolved = self._resolve_file(src_path, dst_path)
+            if resolved is None:
+                continue
+            _path, ext, db, group = resolved
+
+            doc = self._parse_file(_path, ext, group)
+            if doc is None:
+                continue
+
+            key = self._db_key(db[0], db[1], db[2])
+            docs.setdefault(key, []).append(doc)
+            if ext == '.xml':
+                xml_items.setdefault(key, []).append(doc['item'])
+
+        resps = []
+        for key, _docs in docs.items():
+            h = self._get_db_handler_by_key(key)
+            self._save_documents(h, key.split('::'), _docs)
+
+            if key not in xml_items:
+                continue
+            query = {"item": {"$in": xml_items[key]}}
+            res = h.load(query=query, fields={}, getarrays=False)
+            if res is None:
+                continue
+            resps += [json.dumps(doc) for doc in self.after_query(res)]
+
+        return resps
+
     def _add_fs_event(self, what, event_type, src_path, dst_path):
         """Invoked by observer and syncers"""
         self.fs_event_q.put((what, event_type, src_path, dst_path))
@@ -480,17 +722,38 @@ class DBHandler(object):
     def get_fsmap_as_list(self):
         """
         Used to return the lastes file system information.
-        Always, first scan file system itself to detect any changes made in
-        the file system by someone else.
+        The fsmap is kept up to date by directory events and the periodic
+        consistency check (see `_check_fsmap()`).
+        The list is converted once per version of the fsmap and shared by
+        requests, so it must not be modified.
         """
         with self.fsmap_lock:
-            self._traverse()
-            fsmap_list = [[key, value] for key, value in self.fsMap.items() if value['valid']]
+            version, fsmap_list, _ = self.fsmap_response
+            if version != self.fsmap_version:
+                fsmap_list = self.fsMap.as_list()
+                self.fsmap_response = (self.fsmap_version, fsmap_list, None)
         return fsmap_list
 
+    def get_fsmap_json(self):
+        """get_fsmap_as_list() encoded in json, once per version of the fsmap"""
+        fsmap_list = self.get_fsmap_as_list()
+        with self.fsmap_lock:
+            _, cached_list, encoded = self.fsmap_response
+        if cached_list is fsmap_list and encoded is not None:
+            return encoded
+
+        # encode without the lock
+        encoded = json.dumps(fsmap_list)
+        with self.fsmap_lock:
+            version, cached_list, _ = self.fsmap_response
+            if cached_list is fsmap_list:
+                self.fsmap_response = (version, fsmap_list, encoded)
+        return encoded
+
     def set_fsmap(self, fsmap_list):
         """Used to set db config by a client"""
         with self.fsmap_lock:
+            changed = []
             for path, value in fsmap_list:
                 # path is not found
                 # (can happen when file system is manually changed)
@@ -498,7 +761,7 @@ class DBHandler(object):
 
                 # db is already set by other clients, ignore this.
                 # Only administrator can change this manually.
-                if self.fsMap[path]['fixed']: continue
+                if self.fsMap[path].fixed: continue
 
                 # check db config a client set
                 if value['db'] is None: continue         # db is not set
@@ -511,10 +774,12 @@ class DBHandler(object):
 
                 # update db config
                 item = self.fsMap[path]
-                item['db'] = [new_db, new_col, 'fs']
-                item['fixed'] = True
+                item.db = [new_db, new_col, 'fs']
+                item.fixed = True
+                changed.append(path)
 
-            self._save()
+            if len(changed):
+                self._save(changed)
 
 
 
@@ -660,33 +925,34 @@ class DBHandler(object):
 
         return res
 
+    def _collections(self, path, recursive):
+        """Collections [(db, col)] of a path, for versioned query results"""
+        return [tuple(_key.split('::')[:2])
+                for _key in self._db_key_list(path, recursive, True)]
+
     def get_samplelist(self, path, recursive):
+        """
+        Number of documents per sample, read from the sample list summary of
+        each collection (without aggregating the collections).
+        """
         if path not in self.fsMap:
             return []
 
-        samplelist = {}
-
-        db_key_list = self._db_key_list(path, recursive)
-        _db_list = self.client.list_database_names()
-        for _path, _key in db_key_list:
-            _db, _col, _fs = _key.split("::")
-
-            if _db not in _db_list:
-                continue
+        return self.query_cache.get_or_load(
+            self._collections(path, recursive),
+            ('samplelist', path, recursive),
+            lambda: self._load_samplelist(path, recursive),
+            samplelist_nbytes)
 
-            _col_list = self.client[_db].collection_names()
-            if _col not in _col_list:
-                continue
+    def _load_samplelist(self, path, recursive):
+        paths = {}
+        for _path, _key in self._db_key_list(path, recursive):
+            paths.setdefault(_key, []).append(_path)
 
+        samplelist = {}
+        for _key, _paths in paths.items():
             h = self._get_db_handler_by_key(_key)
-            pipeline = [
-                {"$match": {"path": _path}},
-                {"$match": {"sample": {"$exists": True, "$ne": None}}},
-                {"$group": {"_id": "$sample", "count": {"$sum": 1}}}
-            ]
-            res = list(h.collection.aggregate(pipeline))
-
-            for r in res:
+            for r in read_samplelist(h.samplelist, _paths):
                 _id = r['_id']
                 _count = r['count']
 
@@ -697,11 +963,9 @@ class DBHandler(object):
 
         return samplelist
 
-    def get_samples(self, names, path, recursive):
-        if path not in self.fsMap:
-            return {}
-
-        sampleData = {}
+    def _sample_paths(self, path, recursive):
+        """Paths to query per collection (key: db key), for sample queries"""
+        paths = {}
         db_key_list = self._db_key_list(path, recursive, False)
         _db_list = self.client.list_database_names()
         for _path, _key in db_key_list:
@@ -714,47 +978,280 @@ class DBHandler(object):
             if _col not in _col_list:
                 continue
 
-            h = self._get_db_handler_by_key(_key)
-            for name in names:
-                query = {"sample": name, "path": _path}
-                res = h.load(query=query, fields={}, getarrays=False)
+            paths.setdefault(_key, []).append(_path)
+        return paths
 
-                if res is None:
-                    continue
+    def _query_samples(self, names, path, recursive, build, fields=None):
+        """
+        Query samples with a single query per collection. Collections are
+        queried concurrently and `build` is applied to each cursor.
+        """
+        def _query(_h, _paths):
+            docs = load_xml_samples(_h.collection, names, path=_paths, fields=fields)
+            return build(docs)
 
-                res = self.after_query(res)
+        return [
+            self.query_pool.submit(_query, self._get_db_handler_by_key(_key), _paths)
+            for _key, _paths in self._sample_paths(path, recursive).items()
+        ]
+
+    def get_samples(self, names, path, recursive):
+        if path not in self.fsMap:
+            return {}
 
+        sampleData = {}
+        for future in self._query_samples(names, path, recursive, group_by_sample):
+            for name, res in future.result().items():
                 if name in sampleData:
-                    sampleData[name].append(res)
+                    sampleData[name] += res
                 else:
                     sampleData[name] = res
         return sampleData
 
-    def get_tiff(self, id, path):
+    def stream_samples(self, names, path, recursive):
+        """
+        get_samples() as a stream of json chunks, including sampleList:
+        {'sampleList': names, 'sampleData': {name: [docs]}}
+        Cursors of collections are merged by sample while streaming.
+        """
         if path not in self.fsMap:
-            return []
+            return stream_samples(iter([]), names, fill_missing=False)
+
+        def _stream():
+            cursors = [
+                load_xml_samples(self._get_db_handler_by_key(_key).collection,
+                                 names, path=_paths, fields=None,
+                                 sort_by_sample=True)
+                for _key, _paths in self._sample_paths(path, recursive).items()
+            ]
+            return stream_samples(merge_by_sample(cursors), names,
+                                  fill_missing=False)
 
-        if self.fsMap[path]['db'] is None:
-            return []
+        return self.query_cache.stream(
+            self._collections(path, recursive),
+            ('samples', path, recursive, tuple(names)),
+            _stream)
 
-        db = self.fsMap[path]['db']
-        h = self._get_db_handler(db)
+    def stream_samples_ndjson(self, names, path, recursive, after_item=None, limit=0):
+        """
+        Stream documents of samples as NDJSON, ordered by item.
+        Each collection returns at most `limit` documents after `after_item`,
+        and the sorted cursors are merged up to `limit`.
+        """
+        if path not in self.fsMap:
+            return stream_ndjson(iter([]))
+
+        cursors = [
+            load_xml_samples(self._get_db_handler_by_key(_key).collection,
+                             names, path=_paths, fields=None, sort_by_item=True,
+                             after_item=after_item, limit=limit)
+            for _key, _paths in self._sample_paths(path, recursive).items()
+        ]
+        return stream_ndjson(merge_by_item(cursors, limit))
+
+    def stream_samplelist(self, path, recursive):
+        """get_samplelist() as a stream of json chunks"""
+        return stream_json(self.get_samplelist(path, recursive))
+
+    def get_samples_columnar(self, names, path, recursive):
+        """Same as get_samples(), but a columnar table per sample"""
+        if path not in self.fsMap:
+            return {}
 
-        try:
-            _id = ObjectId(id)
-        except InvalidId:
-            return []
+        # rows of a sample can come from more than one collection
+        def _build(docs):
+            return [doc for doc in docs]
+
+        builders = {}
+        for future in self._query_samples(names, path, recursive, _build):
+            for doc in future.result():
+                name = doc.get('sample')
+                if name not in builders:
+                    builders[name] = ColumnarBuilder()
+                builders[name].add(doc)
+        return {name: b.result() for name, b in builders.items()}
+
+    def get_sample_stats(self, names, path, recursive, fields):
+        """
+        count/min/max/mean/std of numeric fields (flattened keys) per sample,
+        aggregated in the database (see merge_sample_stats()).
+        """
+        if path not in self.fsMap:
+            return merge_sample_stats([], fields, names)
+
+        def _query(_h, _paths):
+            pipeline = sample_stats_pipeline(names, fields, path=_paths)
+            return list(_h.collection.aggregate(pipeline))
+
+        futures = [
+            self.query_pool.submit(_query, self._get_db_handler_by_key(_key), _paths)
+            for _key, _paths in self._sample_paths(path, recursive).items()
+        ]
+        groups = [g for future in futures for g in future.result()]
+        return merge_sample_stats(groups, fields, names)
+
+    def get_sample_bins(self, names, path, recursive, x, y, bins, range=None, z=None):
+        """
+        2D histogram of two fields (flattened keys) over documents of samples
+        with optional statistics of a third field per bin (see bin_2d()).
+        """
+        if path not in self.fsMap:
+            return bin_2d(np.empty(0), np.empty(0), bins, range,
+                          np.empty(0) if z is not None else None)
+
+        def _build(docs):
+            return collect_fields(docs, x, y, z)
 
-        query = {'_id': _id, 'tiff': {'$exists': True}}
-        fields = {'tiff': 1, '_id': 0}
-        res = h.load(query, fields, getarrays=True)
+        parts = [future.result() for future in self._query_samples(
+            names, path, recursive, _build, field_projection(x, y, z))]
 
-        if res is None:
+        xs = np.concatenate([p[0] for p in parts]) if len(parts) else np.empty(0)
+        ys = np.concatenate([p[1] for p in parts]) if len(parts) else np.empty(0)
+        zs = None
+        if z is not None:
+            zs = np.concatenate([p[2] for p in parts]) if len(parts) else np.empty(0)
+        return bin_2d(xs, ys, bins, range, zs)
+
+    def _image_key(self, db, id, *variant):
+        """Key of image cache, `db` is [db, col, fs] from fsmap"""
+        return (db[0], db[1], str(id), variant)
+
+    def get_tiff_array(self, id, path):
+        """
+        Get tiff subdocument with the image as numpy array (None if not found).
+        The array is shared (read-only).
+        """
+        if path not in self.fsMap:
+            return None
+
+        if self.fsMap[path].db is None:
+            return None
+
+        db = self.fsMap[path].db
+
+        def _load():
+            h = self._get_db_handler(db)
+
+            try:
+                _id = ObjectId(id)
+            except InvalidId:
+                return None
+
+            query = {'_id': _id, 'tiff': {'$exists': True}}
+            fields = {'tiff': 1, '_id': 0}
+            res = h.load(query, fields, getarrays=True)
+
+            if res is None:
+                return None
+
+            # pyramid levels are not loaded here
+            res['tiff'].pop('pyramid', None)
+            return freeze_image(res['tiff'])
+
+        tiff = self.image_cache.get_or_load(
+            self._image_key(db, id, 'array', 0), _load, image_nbytes)
+        return dict(tiff) if tiff is not None else None
+
+    def get_tiff_encoded(self, id, path, mimetype):
+        """
+        Get tiff image encoded in `mimetype`
+        Returns:
+            (encoded bytes, response headers) or None if not found
+        """
+        if path not in self.fsMap or self.fsMap[path].db is None:
+            return None
+
+        def _load():
+            tiff = self.get_tiff_array(id, path)
+            if tiff is None:
+                return None
+            body = encode_image(tiff['data'], mimetype, tiff['min'], tiff['max'])
+            return body, image_headers(tiff)
+
+        return self.image_cache.get_or_load(
+            self._image_key(self.fsMap[path].db, id, 'encoded', 0, mimetype),
+            _load, lambda v: len(v[0]))
+
+    def get_tiff_region(self, id, path, x0, y0, x1, y1, level=0):
+        """
+        Get tiff subdocument with a region [x0, x1) x [y0, y1) of the image
+        in a pyramid level as numpy array (None if not found)
+        """
+        if path not in self.fsMap:
+            return None
+
+        if self.fsMap[path].db is None:
+            return None
+
+        h = self._get_db_handler(self.fsMap[path].db)
+        return load_image_region(
+            h.collection, h.fs, id, 'tiff', x0, y0, x1, y1, level)
+
+    def get_tiff(self, id, path):
+        tiff = self.get_tiff_array(id, path)
+        if tiff is None:
             return []
 
-        data = res['tiff']['data']
-        res['tiff']['data'] = data.tolist()
-        return res['tiff']
+        tiff['data'] = tiff['data'].tolist()
+        return tiff
+
+    def get_tiff_json(self, id, path):
+        """get_tiff() encoded in json"""
+        if path not in self.fsMap or self.fsMap[path].db is None:
+            return json.dumps([])
+
+        def _load():
+            tiff = self.get_tiff(id, path)
+            return json.dumps(tiff) if len(tiff) else None
+
+        res = self.image_cache.get_or_load(
+            self._image_key(self.fsMap[path].db, id, 'json', 0), _load, len)
+        return res if res is not None else json.dumps([])
+
+    def get_query_validator(self, path, recursive, *key):
+        """
+        Validators of a query result under a path, (etag, last modified).
+        They change whenever documents are written to the collections,
+        by this process or others (versions kept in the database).
+        """
+        collections = self._collections(path, recursive) if path in self.fsMap else []
+        for (db, col), (version, modified) in read_versions(
+                self.client, collections).items():
+            self.query_cache.observe(db, col, version, modified)
+        versions, modified = self.query_cache.validators(collections)
+        return make_etag(EPOCH, versions, path, recursive, key), modified
+
+    def get_tiff_validator(self, id, path, level=0, *variant):
+        """
+        Validators of a tiff image response, from the gridfs file of the
+        pyramid level and the variant of the response (e.g. mimetype).
+        Returns:
+            {'key': content key, 'etag', 'last_modified'} or None if not found
+        """
+        if path not in self.fsMap or self.fsMap[path].db is None:
+            return None
+
+        h = self._get_db_handler(self.fsMap[path].db)
+        f = find_image_file(h.collection, id, 'tiff', level, h.fs_name)
+        if f is None:
+            return None
+        return {
+            'key': str(f['_id']),
+            'etag': make_etag(str(f['_id']), f.get('md5'), level, variant),
+            'last_modified': f.get('uploadDate')
+        }
+
+    def get_db_stats(self):
+        """Health of the database server and shared handles"""
+        stats = registry.stats()
+        stats['health'] = registry.check_health(self.db_host, self.db_port)
+        return stats
+
+    def get_cache_stats(self):
+        return {
+            'image': self.image_cache.stats(),
+            'query': self.query_cache.stats()
+        }
 
 class DBHandlerWithSyncer(DBHandler):
     """
@@ -778,13 +1275,15 @@ class DBHandlerWithSyncer(DBHandler):
     """
 
     def __init__(self, rootDir, fsmapFn,
-                 db_host='localhost', db_port=27017, xml_config=None):
-        super().__init__(rootDir, fsmapFn, db_host, db_port, xml_config)
+                 db_host='localhost', db_port=27017, xml_config=None,
+                 image_cache_bytes=512 * 1024 * 1024,
+                 query_cache_bytes=64 * 1024 * 1024, query_cache_ttl=300,
+                 db_options=None, walk_workers=8, fsmap_check_interval=300):
+        super().__init__(rootDir, fsmapFn, db_host, db_port, xml_config,
+                         image_cache_bytes, query_cache_bytes, query_cache_ttl,
+                         db_options, walk_workers, fsmap_check_interval)
         self.syncerPool = {}
 
-    def __del__(self):
-        super().__del__()
-
     def _sync_files(self, path):
         """Return list of filenames under `path` (not recursive)"""
         if not os.path.exists(path):
@@ -811,8 +1310,8 @@ class DBHandlerWithSyncer(DBHandler):
         """Invoked as upon finishing syncing to update timestamp in fsmap"""
         with self.fsmap_lock:
             if path in self.fsMap:
-                self.fsMap[path]['last_sync'] = timestamp
-                self._save()
+                self.fsMap[path].last_sync = timestamp
+                self._save([path])
 
     def _sync_on_finished(self, path, info):
         """Call back function to update timestamp by a syncer"""
@@ -832,10 +1331,10 @@ class DBHandlerWithSyncer(DBHandler):
         # before starting the syncer, update fsmap
         with self.fsmap_lock:
             fs = self.fsMap[path]
-            fs['file'] = item['file_name']
-            fs['sep'] = item['sep']
-            fs['group'] = item['group_name']
-            self._save()
+            fs.file = item['file_name']
+            fs.sep = item['sep']
+            fs.group = item['group_name']
+            self._save([path])
         h.start()
         item['total'] = h.get_total()
         item['processed'] = h.get_processed()
@@ -886,24 +1385,24 @@ class DBHandlerWithSyncer(DBHandler):
             if _path in self.syncerPool:
                 syncInfo[_path] = self.syncerPool[_path].get_info()
             else:
-                db = _fs['db']
-                file = _fs['file']
+                db = _fs.db
+                file = _fs.file
                 if file is None: file = self._sync_file_sample(_path)
 
                 if db is not None and file is not None:
                     syncInfo[_path] = {
                         'status': 'INIT',
-                        'path_name': _fs['name'],
+                        'path_name': _fs.name,
                         'file_name': file,
-                        'group_name': _fs['group'],
-                        'sep': _fs['sep'],
+                        'group_name': _fs.group,
+                        'sep': _fs.sep,
                         'total': 0,
                         'processed': 0,
-                        'timestamp': _fs['last_sync']
+                        'timestamp': _fs.last_sync
                     }
 
             if recursive:
-                for c_path in _fs['children']:
+                for c_path in self.fsMap.children_paths(_path):
                     q.put(c_path)
 
         return syncInfo
@@ -923,14 +1422,26 @@ class DataHandler(DBHandlerWithSyncer):
             fsMapFn='./fsmap.json',
             db_host='localhost',
             db_port=27017,
-            xml_config=None
+            xml_config=None,
+            image_cache_bytes=512 * 1024 * 1024,
+            query_cache_bytes=64 * 1024 * 1024,
+            query_cache_ttl=300,
+            db_options=None,
+            walk_workers=8,
+            fsmap_check_interval=300
     ):
         super().__init__(
             os.path.realpath(os.path.abspath(rootDir)),
             os.path.abspath(fsMapFn),
             db_host,
             db_port,
-            xml_config
+            xml_config,
+            image_cache_bytes,
+            query_cache_bytes,
+            query_cache_ttl,
+            db_options,
+            walk_workers,
+            fsmap_check_interval
         )
 
         # watchdog
@@ -950,29 +1461,65 @@ class DataHandler(DBHandlerWithSyncer):
         self.fs_thread.daemon = True
         self.fs_thread.start()
 
+        # thread to check the fsmap periodically, so that a long walk does
+        # not block handling fs events
+        self.fsmap_check_stopped = threading.Event()
+        self.fsmap_check_thread = threading.Thread(
+            target=self._fsmap_check_process, name='fsmap_check_thread')
+        self.fsmap_check_thread.daemon = True
+        self.fsmap_check_thread.start()
 
-    def __del__(self):
-        super().__del__()
+
+    def close(self):
+        self.fsmap_check_stopped.set()
         self.observer.stop()
         self.observer.join()
+        super().close()
+
+    def _fsmap_check_process(self):
+        """target function of self.fsmap_check_thread (daemon)"""
+        while not self.fsmap_check_stopped.wait(self.fsmap_check_interval):
+            try:
+                self._check_fsmap()
+            except Exception as ex:
+                print('[WARN] Failed to check fsmap | {}'.format(ex))
 
     def _fs_process(self):
         """target function of self.fs_thread (daemon, background thread)"""
+        e = None
         while True:
-            e = self.fs_event_q.get()
+            if e is None:
+                e = self.fs_event_q.get()
             what, event_type, src_path, dst_path = e
+            e = None
 
             # based on the event,
             if what == 'dir':
                 # If directory event... update fsmap...
                 # No need for streaming...
                 self._update_fsmap(event_type, src_path, dst_path)
-            elif what == 'file' or what == 'sync':
+            elif what == 'file':
                 # If file event... update database...
                 # add to streaming queue
                 resp = self._update_file(event_type, src_path, dst_path)
                 if resp is not None and len(resp):
                     self.stream_q.put(resp)
+            elif what == 'sync':
+                # collect queued syncing events to store them in bulk.
+                # A non-syncing event stops collecting and is handled next.
+                events = [(what, event_type, src_path, dst_path)]
+                while len(events) < self.sync_batch_size:
+                    try:
+                        _e = self.fs_event_q.get_nowait()
+                    except Empty:
+                        break
+                    if _e[0] != 'sync':
+                        e = _e
+                        break
+                    events.append(_e)
+
+                for resp in self._update_files_bulk(events):
+                    self.stream_q.put(resp)
             else:
                 pass
             # if file event... update database...
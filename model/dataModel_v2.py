@@ -3,9 +3,25 @@ import glob
 import json
 import copy
 import time
+import threading
 from model.parser import Parser
-from model.database import DataBase, load_xml, load_image, after_query
+from model.database import DataBase, load_xml_samples, group_by_sample
+from model.database import find_image, load_image_level, load_image_region
+from model.database import load_sample_stats, find_image_file
+from model.pyramid import select_level
+from model.serializer import columnar_by_sample, stream_samples
+from model.serializer import stream_json_array, stream_ndjson
+from model.binning import bin_2d, collect_fields, field_projection
+from model.imagecodec import encode_image, image_headers
+from model.cache import ImageCache, image_nbytes, freeze_image
+from model.utils import count_files
+from model.cache import QueryCache, samplelist_nbytes
+from model.httpcache import EPOCH, make_etag
+from model.colversion import read_versions
 from model.syncer_v2 import Syncer
+from model.manifest import Manifest
+from model.connection import registry, client_options
+from model.samplelist import read_samplelist, ensure_samplelist
 from model.utils import load_json
 
 
@@ -17,7 +33,8 @@ class DataHandler(object):
         self.parser = Parser(config=config['XML'])
         self.DB = DataBase(
             host=config['DB']['HOST'],
-            port=config['DB']['PORT']
+            port=config['DB']['PORT'],
+            **client_options(config['DB'])
         )
         # full path to a directories where project information (*.json) resides.
         self.project_dir = project_dir
@@ -38,6 +55,19 @@ class DataHandler(object):
         # syncer pool, key: project file name, value: syncer
         self.syncer_pool = {}
 
+        # collections whose sample list summary is checked, key: (db, col)
+        self.samplelist_checked = set()
+        self.samplelist_lock = threading.Lock()
+
+        # cache of decoded images and encoded responses
+        cache_config = config.get('CACHE', {})
+        self.image_cache = ImageCache(
+            max_bytes=cache_config.get('IMAGE_BYTES', 512 * 1024 * 1024))
+        # cache of query results, versioned per collection
+        self.query_cache = QueryCache(
+            max_bytes=cache_config.get('QUERY_BYTES', 64 * 1024 * 1024),
+            ttl=cache_config.get('QUERY_TTL', 300))
+
     def get_projects(self):
         """Get information of all projects"""
         return json.dumps(self.projects)
@@ -57,8 +87,14 @@ class DataHandler(object):
         with open(os.path.join(self.project_dir, filename), 'w') as f:
             json.dump(project, f, indent=2, sort_keys=True)
 
-    def run_syncer(self, project):
-        """Initialize syncer, if it is available"""
+    def run_syncer(self, project, resync=False):
+        """
+        Initialize syncer, if it is available
+        Args:
+            project: project information
+            resync: clear the file manifest first to sync all files again
+                (e.g. after a parser fix)
+        """
         syncer_key = project['name']
         # check if the project is running (possibly by another clients)
         # if it is running, returns the project information currently used
@@ -79,10 +115,26 @@ class DataHandler(object):
             db=project['db'],
             col=project['col']
         )
+        # sample list summary, updated while writing documents
+        samplelist = self._get_samplelist(colCursor, project['db'], project['col'])
+        # file manifest to sync only new or changed files
+        manifest = Manifest(
+            colCursor=self.DB.get_manifest(project['db'], project['col']),
+            project_name=project['name']
+        )
+        if resync:
+            manifest.clear()
         # initiate a worker
+        sync_config = self.config.get('SYNC', {})
         def _onFinished():
             self.num_syncers -= 1
 
+        def _onOverwrite(ids):
+            self.image_cache.invalidate(project['db'], project['col'], ids)
+
+        def _onWritten():
+            self.query_cache.bump(project['db'], project['col'])
+
         worker = Syncer(
             name='syncer_{:s}'.format(project['name']),
             project=project,
@@ -91,7 +143,15 @@ class DataHandler(object):
             fsCursor=fsCursor,
             extensions=['xml', 'jpg', 'tiff'],
             interval=500,
-            onFinished=_onFinished
+            onFinished=_onFinished,
+            manifest=manifest,
+            num_workers=sync_config.get('WORKERS'),
+            batch_size=sync_config.get('BATCH', 100),
+            queue_size=sync_config.get('QUEUE', 64),
+            onOverwrite=_onOverwrite,
+            samplelist=samplelist,
+            walk_workers=sync_config.get('WALK_WORKERS', 8),
+            onWritten=_onWritten
         )
         # start updateing
         worker.start()
@@ -126,14 +186,30 @@ class DataHandler(object):
         db = project['db']
         col = project['col']
 
-        h, _ = self.DB.get_db(db, col)
-        pipeline = [
-            {"$match": {"project": project['name']}},
-            {"$match": {"sample": {"$exists": True, "$ne": None}}},
-            {"$group": {"_id": "$sample", "count": {"$sum": 1}}}
-        ]
-        res = list(h.aggregate(pipeline))
-        return res
+        def _load():
+            h, _ = self.DB.get_db(db, col)
+            return read_samplelist(self._get_samplelist(h, db, col),
+                                   project['name'])
+
+        return self.query_cache.get_or_load(
+            [(db, col)], ('samplelist', project['name']), _load,
+            samplelist_nbytes)
+
+    def _get_samplelist(self, colCursor, db, col):
+        """
+        Get cursor to the sample list summary of a collection. It is built
+        from the collection when it is opened first, if it is empty.
+        """
+        sumCursor = self.DB.get_samplelist(db, col)
+        with self.samplelist_lock:
+            if (db, col) not in self.samplelist_checked:
+                ensure_samplelist(colCursor, sumCursor, 'project')
+                self.samplelist_checked.add((db, col))
+        return sumCursor
+
+    def stream_samplelist(self, project):
+        """get_samplelist() as a stream of json chunks"""
+        return stream_json_array(self.get_samplelist(project))
 
     def get_samples(self, sampleNames, project):
         db = project['db']
@@ -141,31 +217,183 @@ class DataHandler(object):
 
         h, _ = self.DB.get_db(db, col)
 
-        sampleData = {}
-        for name in sampleNames:
-            res = load_xml(h, name, project['name'])
-            res = after_query(res)
-
-            sampleData[name] = res
-
-        return sampleData
-
-    def get_tiff(self, id, db, col):
+        # single query for all samples
+        docs = load_xml_samples(h, sampleNames, project['name'])
+        return group_by_sample(docs, sampleNames)
+
+    def stream_samples(self, sampleNames, project):
+        """
+        get_samples() as a stream of json chunks, including sampleList:
+        {'sampleList': sampleNames, 'sampleData': {name: [docs]}}
+        """
+        def _stream():
+            h, _ = self.DB.get_db(project['db'], project['col'])
+            docs = load_xml_samples(h, sampleNames, project['name'],
+                                    sort_by_sample=True)
+            return stream_samples(docs, sampleNames)
+
+        return self.query_cache.stream(
+            [(project['db'], project['col'])],
+            ('samples', project['name'], tuple(sampleNames)),
+            _stream)
+
+    def stream_samples_ndjson(self, sampleNames, project, after_item=None, limit=0):
+        """
+        Stream documents of samples as NDJSON, ordered by item.
+        Args:
+            sampleNames: list of sample names
+            project: project
+            after_item: item of the last document of the previous page
+            limit: page size (0 for all documents)
+        """
+        h, _ = self.DB.get_db(project['db'], project['col'])
+
+        docs = load_xml_samples(h, sampleNames, project['name'],
+                                sort_by_item=True,
+                                after_item=after_item, limit=limit)
+        return stream_ndjson(docs)
+
+    def get_sample_stats(self, sampleNames, project, fields):
+        """
+        count/min/max/mean/std of numeric fields (flattened keys) per sample,
+        aggregated in the database (see merge_sample_stats()).
+        """
+        h, _ = self.DB.get_db(project['db'], project['col'])
+        return load_sample_stats(h, sampleNames, fields, project['name'])
+
+    def get_sample_bins(self, sampleNames, project, x, y, bins, range=None, z=None):
+        """
+        2D histogram of two fields (flattened keys) over documents of samples
+        with optional statistics of a third field per bin (see bin_2d()).
+        """
+        h, _ = self.DB.get_db(project['db'], project['col'])
+
+        docs = load_xml_samples(h, sampleNames, project['name'],
+                                fields=field_projection(x, y, z))
+        xs, ys, zs = collect_fields(docs, x, y, z)
+        return bin_2d(xs, ys, bins, range, zs)
+
+    def get_samples_columnar(self, sampleNames, project):
+        """Same as get_samples(), but a columnar table per sample"""
+        h, _ = self.DB.get_db(project['db'], project['col'])
+
+        docs = load_xml_samples(h, sampleNames, project['name'])
+        return columnar_by_sample(docs, sampleNames)
+
+    def _image_key(self, db, col, id, *variant):
+        """Key of image cache"""
+        return (db, col, str(id), variant)
+
+    def get_tiff_array(self, id, db, col, level=0):
+        """
+        Get tiff subdocument with the image of a pyramid level (0: base) as
+        numpy array (None if not found). The array is shared (read-only).
+        """
+        def _load():
+            colCursor, fsCursor = self.DB.get_db(db, col)
+            return freeze_image(
+                load_image_level(colCursor, fsCursor, id, 'tiff', level))
+
+        tiff = self.image_cache.get_or_load(
+            self._image_key(db, col, id, 'array', level), _load, image_nbytes)
+        return dict(tiff) if tiff is not None else None
+
+    def select_tiff_level(self, id, db, col, width=None, height=None):
+        """
+        Smallest pyramid level of a tiff image that is at least
+        `width` x `height` (None if not found)
+        """
+        colCursor, _ = self.DB.get_db(db, col)
+        tiff = find_image(colCursor, id, 'tiff')
+        if tiff is None:
+            return None
+        return select_level(tiff, width, height)
+
+    def get_tiff_encoded(self, id, db, col, mimetype, level=0):
+        """
+        Get tiff image of a pyramid level encoded in `mimetype`
+        Returns:
+            (encoded bytes, response headers) or None if not found
+        """
+        def _load():
+            tiff = self.get_tiff_array(id, db, col, level)
+            if tiff is None:
+                return None
+            body = encode_image(tiff['data'], mimetype, tiff['min'], tiff['max'])
+            return body, image_headers(tiff)
+
+        return self.image_cache.get_or_load(
+            self._image_key(db, col, id, 'encoded', level, mimetype),
+            _load, lambda v: len(v[0]))
+
+    def get_tiff_region(self, id, db, col, x0, y0, x1, y1, level=0):
+        """
+        Get tiff subdocument with a region [x0, x1) x [y0, y1) of the image
+        in a pyramid level as numpy array (None if not found)
+        """
         colCursor, fsCursor = self.DB.get_db(db, col)
+        return load_image_region(
+            colCursor, fsCursor, id, 'tiff', x0, y0, x1, y1, level)
 
-        res = load_image(colCursor, fsCursor, id, 'tiff')
-        if res is None:
+    def get_tiff(self, id, db, col):
+        tiff = self.get_tiff_array(id, db, col)
+        if tiff is None:
             return []
 
-        if isinstance(res, list):
-            res = res[0]
-
-        data = res['tiff']['data']
-        res['tiff']['data'] = data.tolist()
-        return res['tiff']
-
-
-
+        tiff['data'] = tiff['data'].tolist()
+        return tiff
+
+    def get_tiff_json(self, id, db, col):
+        """get_tiff() encoded in json"""
+        def _load():
+            tiff = self.get_tiff(id, db, col)
+            return json.dumps(tiff) if len(tiff) else None
+
+        res = self.image_cache.get_or_load(
+            self._image_key(db, col, id, 'json', 0), _load, len)
+        return res if res is not None else json.dumps([])
+
+    def get_query_validator(self, project, *key):
+        """
+        Validators of a query result of a project, (etag, last modified).
+        They change whenever documents are written to the project collection,
+        by this process or others (versions kept in the database).
+        """
+        collections = [(project['db'], project['col'])]
+        for (db, col), (version, modified) in read_versions(
+                self.DB.conn, collections).items():
+            self.query_cache.observe(db, col, version, modified)
+        versions, modified = self.query_cache.validators(collections)
+        return make_etag(EPOCH, versions, project['name'], key), modified
+
+    def get_tiff_validator(self, id, db, col, level=0, *variant):
+        """
+        Validators of a tiff image response, from the gridfs file of the
+        pyramid level and the variant of the response (e.g. mimetype).
+        Returns:
+            {'key': content key, 'etag', 'last_modified'} or None if not found
+        """
+        colCursor, _ = self.DB.get_db(db, col)
+        f = find_image_file(colCursor, id, 'tiff', level)
+        if f is None:
+            return None
+        return {
+            'key': str(f['_id']),
+            'etag': make_etag(str(f['_id']), f.get('md5'), level, variant),
+            'last_modified': f.get('uploadDate')
+        }
+
+    def get_db_stats(self):
+        """Health of the database server and shared handles"""
+        stats = registry.stats()
+        stats['health'] = self.DB.check_health()
+        return stats
+
+    def get_cache_stats(self):
+        return {
+            'image': self.image_cache.stats(),
+            'query': self.query_cache.stats()
+        }
 
     def check_syncer(self, syncer_key):
         if syncer_key not in self.syncer_pool:
@@ -189,16 +417,14 @@ class DataHandler(object):
 
         bPath = os.path.exists(path)
         if bPath:
-            check_ext = ['*.xml', '*.jpg', '*.tiff']
-            def _get_num_of_files(_path):
-                return len(glob.glob(_path, recursive=True))
-
-            nFiles = [_get_num_of_files(os.path.join(path, '**', ext))
-                      for ext in check_ext]
-
-            project['xml'] = nFiles[0]
-            project['jpg'] = nFiles[1]
-            project['tif'] = nFiles[2]
+            # count all kinds of files in a single walk
+            nFiles = count_files(
+                path, ['xml', 'jpg', 'tiff'],
+                self.config.get('SYNC', {}).get('WALK_WORKERS', 8))
+
+            project['xml'] = nFiles['xml']
+            project['jpg'] = nFiles['jpg']
+            project['tif'] = nFiles['tiff']
             project['path'] = path
         else:
             if "INVALID" not in path:
@@ -1,30 +1,123 @@
 import pymongo
+import pymongo.errors
 import gridfs
 import numpy as np
-import pickle
 from bson.errors import InvalidId
-from bson.binary import Binary
 from bson.objectid import ObjectId
+from model.manifest import manifest_name
+from model.samplelist import samplelist_name, SAMPLELIST_INDEXES
+from model.arraystore import put_array, get_array, get_array_region
+from model.connection import registry
+from model.colversion import bump_version
+
+# indexes of a project collection, [(keys, options)]
+# - item: upserts
+# - project/path + sample: sample list and sample queries
+COLLECTION_INDEXES = [
+    ([('item', pymongo.ASCENDING)], {'name': 'item', 'unique': True}),
+    ([('project', pymongo.ASCENDING), ('sample', pymongo.ASCENDING)],
+     {'name': 'project_sample'}),
+    ([('path', pymongo.ASCENDING), ('sample', pymongo.ASCENDING)],
+     {'name': 'path_sample'}),
+]
+
+# indexes of a file manifest collection
+MANIFEST_INDEXES = [
+    ([('project', pymongo.ASCENDING), ('path', pymongo.ASCENDING)],
+     {'name': 'project_path', 'unique': True}),
+]
+
+def ensure_indexes(colCursor, indexes=COLLECTION_INDEXES):
+    """
+    Create indexes, if they don't exist.
+    A failure (e.g. duplicated items for a unique index) is reported, but
+    doesn't stop creating the other indexes.
+
+    Returns:
+        names of indexes failed to create
+    """
+    failed = []
+    for keys, options in indexes:
+        try:
+            colCursor.create_index(keys, **options)
+        except pymongo.errors.OperationFailure as ex:
+            print('Failed to create index {:s} on {:s} | {}'.format(
+                options['name'], colCursor.full_name, ex))
+            failed.append(options['name'])
+    return failed
+
+def check_indexes(colCursor, indexes=COLLECTION_INDEXES):
+    """
+    Verify indexes of a collection and report their sizes.
+
+    Returns:
+        list of {'name', 'keys', 'exists', 'size'} for declared indexes and
+        any other index in the collection (size in bytes, None if unknown)
+    """
+    existing = colCursor.index_information()
+    try:
+        stats = colCursor.database.command('collStats', colCursor.name)
+        sizes = stats.get('indexSizes', {})
+    except pymongo.errors.OperationFailure:
+        sizes = {}
+
+    report = []
+    for keys, options in indexes:
+        name = options['name']
+        report.append({
+            'name': name,
+            'keys': keys,
+            'exists': name in existing and existing[name]['key'] == keys,
+            'size': sizes.get(name)
+        })
+    declared = [options['name'] for _, options in indexes]
+    for name, info in existing.items():
+        if name not in declared:
+            report.append({
+                'name': name,
+                'keys': info['key'],
+                'exists': True,
+                'size': sizes.get(name)
+            })
+    return report
 
 class DataBase(object):
-    def __init__(self, host='localhost', port=27017):
+    def __init__(self, host='localhost', port=27017, **options):
         # MongoDB host name
         self.host = host
         # MongoDB port number
         self.port = port
-        # MongoDB connection
-        self.conn = pymongo.MongoClient(host, port)
-
-    def __del__(self):
-        self.conn.close()
+        # MongoDB connection, shared by the process (options: MongoClient
+        # options such as pool size and timeouts, see client_options())
+        self.conn = registry.client(host, port, **options)
+
+    def _open(self, db, col, indexes):
+        """Get a collection, creating its indexes when it is first opened"""
+        def _create():
+            _col = self.conn[db][col]
+            ensure_indexes(_col, indexes)
+            return _col
+        return registry.handle((self.host, self.port, 'col', db, col), _create)
 
     def get_db(self, db, col, fs='fs'):
         """Get collection cursor and associated gridfs cursor"""
-        _db = self.conn[db]
-        _col = _db[col]
-        _fs = gridfs.GridFS(_db, fs)
+        _col = self._open(db, col, COLLECTION_INDEXES)
+        _fs = registry.handle((self.host, self.port, 'fs', db, fs),
+                              lambda: gridfs.GridFS(self.conn[db], fs))
         return _col, _fs
 
+    def check_health(self):
+        """Ping the server (see HandleRegistry.check_health())"""
+        return registry.check_health(self.host, self.port)
+
+    def get_manifest(self, db, col):
+        """Get cursor to the file manifest collection next to a collection"""
+        return self._open(db, manifest_name(col), MANIFEST_INDEXES)
+
+    def get_samplelist(self, db, col):
+        """Get cursor to the sample list summary next to a collection"""
+        return self._open(db, samplelist_name(col), SAMPLELIST_INDEXES)
+
 def save_document(colCursor, doc:dict):
     """
     Insert new document.
@@ -45,47 +138,177 @@ def save_document(colCursor, doc:dict):
     )
     return res
 
-def save_image_document(colCursor, fsCursor, doc:dict, type:str):
-    def _npArray2Binary(_arr):
-        return Binary(pickle.dumps(_arr, protocol=2), subtype=128)
-
-    def _stashNPArrays(_doc:dict):
-        """stash np array, in-place modification"""
-        for (key, value) in _doc.items():
-            if isinstance(value, np.ndarray):
-                id = fsCursor.put(_npArray2Binary(value))
-                _doc[key] = id
-
-            elif isinstance(value, dict):
-                _doc[key] = _stashNPArrays(value)
+def _stash_arrays(fsCursor, doc:dict, ids:list=None):
+    """
+    Stash np arrays in gridfs, in-place modification.
+    Arrays in nested dictionaries and in lists of dictionaries (e.g. pyramid
+    levels) are stashed, too. Ids of the new gridfs files are added to `ids`.
+    `data` of an image subdocument with a `tile` index is stored in the
+    tiled layout.
+    """
+    for (key, value) in doc.items():
+        if isinstance(value, np.ndarray):
+            tile = None
+            if key == 'data' and isinstance(doc.get('tile'), dict):
+                tile = (doc['tile']['height'], doc['tile']['width'])
+            doc[key] = put_array(fsCursor, value, tile=tile)
+            if ids is not None:
+                ids.append(doc[key])
+        elif isinstance(value, dict):
+            doc[key] = _stash_arrays(fsCursor, value, ids)
+        elif isinstance(value, list):
+            for v in value:
+                if isinstance(v, dict):
+                    _stash_arrays(fsCursor, v, ids)
+    return doc
 
-        return _doc
+def image_file_ids(img_doc:dict):
+    """Ids of all gridfs files referenced by an image subdocument"""
+    if not isinstance(img_doc, dict) or 'data' not in img_doc:
+        return []
+    ids = [img_doc['data']]
+    pyramid = img_doc.get('pyramid')
+    if isinstance(pyramid, dict):
+        ids += [l['data'] for l in pyramid.get('levels', []) if 'data' in l]
+    return ids
 
+def save_image_document(colCursor, fsCursor, doc:dict, type:str):
     # stash np arrays
-    _stashNPArrays(doc)
+    _stash_arrays(fsCursor, doc)
 
     # add to db
     prev = save_document(colCursor, doc)
 
     # delete old image data, if any
     if prev is not None:
-        try:
-            old_img_doc = prev[type]
-        except KeyError:
-            old_img_doc = None
-        if old_img_doc is not None:
-            fsCursor.delete(old_img_doc['data'])
+        for id in image_file_ids(prev.get(type)):
+            fsCursor.delete(id)
 
     return prev
 
-def load(colCursor, query, fields=None, fsCursor=None):
-    def _binary2NPArray(_binary):
-        return pickle.loads(_binary)
+def delete_files_bulk(colCursor, ids, fs='fs'):
+    """
+    Delete gridfs files at once (instead of one GridFS.delete() per file).
+    Args:
+        colCursor: cursor to a collection in the database of gridfs
+        ids: list of gridfs file ids
+        fs: gridfs root collection name
+
+    Returns:
+        the number of deleted files
+    """
+    if not len(ids):
+        return 0
+
+    db = colCursor.database
+    res = db['{:s}.files'.format(fs)].delete_many({'_id': {'$in': ids}})
+    db['{:s}.chunks'.format(fs)].delete_many({'files_id': {'$in': ids}})
+    return res.deleted_count
+
+def _count_changes(batch:dict, prev_samples:dict, count_by):
+    """Changes of the number of documents per (count_by, sample) by upserts"""
+    deltas = {}
+    for item, doc in batch.items():
+        prev = prev_samples.get(item, (None, None))
+        # $set keeps fields that are not in the new document
+        cur = (doc.get(count_by, prev[0]), doc.get('sample', prev[1]))
+        if cur == prev:
+            continue
+        if prev[0] is not None and prev[1] is not None:
+            deltas[prev] = deltas.get(prev, 0) - 1
+        if cur[0] is not None and cur[1] is not None:
+            deltas[cur] = deltas.get(cur, 0) + 1
+    return deltas
+
+def save_documents_bulk(colCursor, fsCursor, docs:list, batch_size=500, fs='fs',
+                        on_overwrite=None, count_by=None, on_count=None):
+    """
+    Insert new documents or replace existing fields, in batches.
+
+    Per batch, it makes one bulk_write with upserts keyed by `item`. Image
+    arrays are stashed in gridfs, and ids of the superseded gridfs files are
+    fetched by a single projected `$in` query before the write and then
+    deleted at once.
+
+    Args:
+        colCursor: cursor to a collection
+        fsCursor: gridfs cursor associated with the collection
+        docs: list of documents (None is ignored)
+        batch_size: the number of upserts per bulk_write
+        fs: gridfs root collection name
+        on_overwrite: callback invoked with ids (str) of existing documents
+            whose image data is replaced (e.g. to invalidate caches)
+        count_by: field a sample list is grouped by (e.g. 'project')
+        on_count: callback invoked with changes of the number of documents
+            per sample, {(value of count_by, sample): change}
 
+    Returns:
+        the number of written documents
+    """
+    def _image_ids(_doc:dict, _types):
+        return [id for t in _types for id in image_file_ids(_doc.get(t))]
+
+    docs = [doc for doc in docs if doc is not None]
+    count = 0
+    for b_start in range(0, len(docs), batch_size):
+        # merge documents for the same item like consecutive $set do
+        batch = {}
+        superseded = []
+        img_types = set()
+        for doc in docs[b_start:b_start + batch_size]:
+            new_ids = []
+            _stash_arrays(fsCursor, doc, new_ids)
+            types = [k for k, v in doc.items()
+                     if isinstance(v, dict) and 'data' in v and v['data'] in new_ids]
+            img_types.update(types)
+
+            item = doc['item']
+            if item in batch:
+                superseded += _image_ids(batch[item], types)
+                batch[item].update(doc)
+            else:
+                batch[item] = doc
+
+        # old image ids (and sample) of items in this batch
+        overwritten = []
+        prev_samples = {}
+        if len(img_types) or on_count is not None:
+            fields = {t + '.data': 1 for t in img_types}
+            fields.update({t + '.pyramid.levels.data': 1 for t in img_types})
+            fields['item'] = 1
+            if on_count is not None:
+                fields.update({'sample': 1, count_by: 1})
+            query = {'item': {'$in': list(batch.keys())}}
+            for prev in colCursor.find(query, fields):
+                prev_samples[prev['item']] = (prev.get(count_by), prev.get('sample'))
+                types = [t for t in img_types if t in batch[prev['item']]]
+                prev_ids = _image_ids(prev, types)
+                if len(prev_ids):
+                    superseded += prev_ids
+                    overwritten.append(str(prev['_id']))
+
+        requests = [
+            pymongo.UpdateOne({'item': item}, {'$set': doc}, upsert=True)
+            for item, doc in batch.items()
+        ]
+        colCursor.bulk_write(requests, ordered=False)
+        count += len(requests)
+        # for validators of other processes
+        bump_version(colCursor)
+
+        delete_files_bulk(colCursor, superseded, fs)
+        if on_overwrite is not None and len(overwritten):
+            on_overwrite(overwritten)
+        if on_count is not None:
+            on_count(_count_changes(batch, prev_samples, count_by))
+
+    return count
+
+def load(colCursor, query, fields=None, fsCursor=None):
     def _loadNPArrays(_doc:dict):
         for (key, value) in _doc.items():
             if isinstance(value, ObjectId) and key != '_id':
-                _doc[key] = _binary2NPArray(fsCursor.get(value).read())
+                _doc[key] = get_array(fsCursor, value)
             elif isinstance(value, dict):
                 _doc[key] = _loadNPArrays(value)
         return _doc
@@ -112,6 +335,175 @@ def load_xml(colCursor, sample_name, project_name=None):
     results = load(colCursor, query, fields)
     return results
 
+# fields of xml documents (excluding image subdocuments)
+XML_FIELDS = {'tiff': 0, 'jpg': 0}
+
+def load_xml_samples(colCursor, sample_names:list, project_name=None, path=None,
+                     fields=XML_FIELDS, sort_by_sample=False, sort_by_item=False,
+                     after_item=None, limit=0):
+    """
+    Load xml documents of many samples with a single `$in` query.
+    Args:
+        colCursor: cursor to a collection
+        sample_names: list of sample names
+        project_name: project name (optional)
+        path: a path or list of paths (optional)
+        fields: projection (None for all fields)
+        sort_by_sample: sort documents by sample (to stream them by sample)
+        sort_by_item: sort documents by item (implied by after_item and limit)
+        after_item: return documents after this item (sorted by item)
+        limit: maximum number of documents (0 for no limit, sorted by item)
+
+    Returns:
+        generator of documents, as the cursor iterates
+    """
+    query = {"sample": {"$in": list(sample_names)}}
+    if project_name is not None:
+        query["project"] = project_name
+    if isinstance(path, (list, tuple)):
+        query["path"] = {"$in": list(path)}
+    elif path is not None:
+        query["path"] = path
+    if after_item is not None:
+        query["item"] = {"$gt": after_item}
+
+    cursor = colCursor.find(query, fields)
+    if sort_by_sample:
+        cursor = cursor.sort('sample', pymongo.ASCENDING)
+    elif sort_by_item or after_item is not None or limit:
+        # pages are ordered by item (unique index)
+        cursor = cursor.sort('item', pymongo.ASCENDING)
+    if limit:
+        cursor = cursor.limit(int(limit))
+    for doc in cursor:
+        yield doc
+
+def group_by_sample(docs, sample_names=None):
+    """
+    Group documents by sample, after_query() is applied to each group.
+    If sample_names is given, every name is in the result (in the order).
+    """
+    grouped = {}
+    if sample_names is not None:
+        for name in sample_names:
+            grouped[name] = []
+    for doc in docs:
+        grouped.setdefault(doc.get('sample'), []).append(doc)
+
+    for name, res in grouped.items():
+        grouped[name] = after_query(res) if len(res) else []
+    return grouped
+
+# bson types counted as numbers in sample statistics
+_NUMBER_TYPES = ['double', 'int', 'long', 'decimal']
+
+def sample_stats_pipeline(sample_names:list, fields:list, project_name=None, path=None):
+    """
+    Aggregation pipeline of per-sample statistics of numeric fields.
+    Fields are flattened keys (nested keys joined by '/'). Non-numeric
+    values are ignored, and numbers (including decimal) are converted to
+    double. The group of a sample has `count` (the number of documents)
+    and for i-th field, `f{i}_n`, `f{i}_min`, `f{i}_max`, `f{i}_mean` and
+    `f{i}_std` (population standard deviation).
+    """
+    match = {"sample": {"$in": list(sample_names)}}
+    if project_name is not None:
+        match["project"] = project_name
+    if isinstance(path, (list, tuple)):
+        match["path"] = {"$in": list(path)}
+    elif path is not None:
+        match["path"] = path
+
+    group = {"_id": "$sample", "count": {"$sum": 1}}
+    for i, field in enumerate(fields):
+        value = '$' + field.replace('/', '.')
+        is_number = {"$in": [{"$type": value}, _NUMBER_TYPES]}
+        number = {"$cond": [is_number, {"$toDouble": value}, None]}
+        group['f{}_n'.format(i)] = {"$sum": {"$cond": [is_number, 1, 0]}}
+        group['f{}_min'.format(i)] = {"$min": number}
+        group['f{}_max'.format(i)] = {"$max": number}
+        # null is ignored by both
+        group['f{}_mean'.format(i)] = {"$avg": number}
+        group['f{}_std'.format(i)] = {"$stdDevPop": number}
+
+    return [{"$match": match}, {"$group": group}]
+
+def _merge_moments(a, b):
+    """
+    Merge (count, mean, sum of squared deviations) of two sets of values
+    (parallel algorithm of Chan et al., without cancellation of E[x^2]-mean^2)
+    """
+    n = a[0] + b[0]
+    if not b[0]:
+        return a
+    if not a[0]:
+        return b
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / n
+    m2 = a[2] + b[2] + delta * delta * a[0] * b[0] / n
+    return n, mean, m2
+
+def merge_sample_stats(groups, fields:list, sample_names=None):
+    """
+    Merge groups of sample_stats_pipeline() (from one or more collections)
+    into {sample: {'count': int, 'fields': {field: {count, min, max, mean, std}}}}.
+    If sample_names is given, every name is in the result (in the order).
+    """
+    acc = {}
+    if sample_names is not None:
+        for name in sample_names:
+            acc[name] = None
+    for g in groups:
+        cur = {'count': g['count'], 'fields': []}
+        for i in range(len(fields)):
+            n = g['f{}_n'.format(i)]
+            # mean and std are null without numbers
+            mean = g['f{}_mean'.format(i)] if n else 0.
+            std = g['f{}_std'.format(i)] if n else 0.
+            cur['fields'].append({
+                # (count, mean, sum of squared deviations)
+                'moments': (n, mean, std * std * n),
+                'min': g['f{}_min'.format(i)],
+                'max': g['f{}_max'.format(i)],
+            })
+
+        prev = acc.get(g['_id'])
+        if prev is None:
+            acc[g['_id']] = cur
+            continue
+        prev['count'] += cur['count']
+        for p, c in zip(prev['fields'], cur['fields']):
+            p['moments'] = _merge_moments(p['moments'], c['moments'])
+            for key, pick in [('min', min), ('max', max)]:
+                values = [v for v in [p[key], c[key]] if v is not None]
+                p[key] = pick(values) if len(values) else None
+
+    stats = {}
+    for name, g in acc.items():
+        if g is None:
+            stats[name] = {'count': 0, 'fields': {
+                f: {'count': 0, 'min': None, 'max': None, 'mean': None, 'std': None}
+                for f in fields}}
+            continue
+        res = {}
+        for field, f in zip(fields, g['fields']):
+            n, mean, m2 = f['moments']
+            res[field] = {
+                'count': n,
+                'min': f['min'],
+                'max': f['max'],
+                'mean': mean if n else None,
+                'std': (m2 / n) ** 0.5 if n else None
+            }
+        stats[name] = {'count': g['count'], 'fields': res}
+    return stats
+
+def load_sample_stats(colCursor, sample_names:list, fields:list, project_name=None,
+                      path=None):
+    """Per-sample statistics of numeric fields in a single aggregation"""
+    pipeline = sample_stats_pipeline(sample_names, fields, project_name, path)
+    return merge_sample_stats(colCursor.aggregate(pipeline), fields, sample_names)
+
 def load_image(colCursor, fsCursor, id, type):
     try:
         _id = ObjectId(id)
@@ -124,6 +516,110 @@ def load_image(colCursor, fsCursor, id, type):
 
     return result
 
+def find_image(colCursor, id, type):
+    """Get an image subdocument without loading arrays (None if not found)"""
+    try:
+        _id = ObjectId(id)
+    except InvalidId:
+        return None
+
+    query = {'_id': _id, type: {'$exists': True}}
+    fields = {type: 1, '_id': 0}
+    doc = colCursor.find_one(query, fields)
+    if doc is None:
+        return None
+    return doc[type]
+
+def image_level_file(img_doc:dict, level=0):
+    """Id of the gridfs file of a pyramid level (None if it doesn't exist)"""
+    if level == 0:
+        return img_doc.get('data')
+    pyramid = img_doc.get('pyramid')
+    if pyramid is None:
+        return None
+    for l in pyramid['levels']:
+        if l['level'] == level:
+            return l.get('data')
+    return None
+
+def find_image_file(colCursor, id, type, level=0, fs='fs'):
+    """
+    Get the gridfs file document (without content) of a pyramid level of an
+    image, to validate responses of the image.
+    Returns:
+        {'_id', 'uploadDate', 'md5' (if any)} or None if not found
+    """
+    img_doc = find_image(colCursor, id, type)
+    if img_doc is None:
+        return None
+    file_id = image_level_file(img_doc, level)
+    if file_id is None:
+        return None
+    files = colCursor.database['{:s}.files'.format(fs)]
+    return files.find_one({'_id': file_id}, {'uploadDate': 1, 'md5': 1})
+
+def load_image_data(fsCursor, img_doc:dict, level=0):
+    """
+    Load array of a pyramid level into an image subdocument from find_image.
+    Width and height are replaced by those of the level. Returns None if the
+    level doesn't exist.
+    """
+    pyramid = img_doc.pop('pyramid', None)
+    img_doc['levels'] = 1 + (len(pyramid['levels']) if pyramid else 0)
+    img_doc['level'] = level
+
+    if level == 0:
+        img_doc['data'] = get_array(fsCursor, img_doc['data'])
+        return img_doc
+
+    if pyramid is None:
+        return None
+    for l in pyramid['levels']:
+        if l['level'] == level:
+            img_doc['data'] = get_array(fsCursor, l['data'])
+            img_doc['width'] = l['width']
+            img_doc['height'] = l['height']
+            return img_doc
+    return None
+
+def load_image_level(colCursor, fsCursor, id, type, level=0):
+    """Load image subdocument with array of a pyramid level (0: base)"""
+    img_doc = find_image(colCursor, id, type)
+    if img_doc is None:
+        return None
+    return load_image_data(fsCursor, img_doc, level)
+
+def load_image_region(colCursor, fsCursor, id, type, x0, y0, x1, y1, level=0,
+                      fs='fs'):
+    """
+    Load image subdocument with a region [x0, x1) x [y0, y1) of a pyramid
+    level (0: base). Coordinates are in pixels of the level. Only the gridfs
+    chunks covering the region are read (from the `<fs>.chunks` collection).
+    Returns None if the image or the level doesn't exist.
+    """
+    img_doc = find_image(colCursor, id, type)
+    if img_doc is None:
+        return None
+
+    pyramid = img_doc.pop('pyramid', None)
+    img_doc['levels'] = 1 + (len(pyramid['levels']) if pyramid else 0)
+    img_doc['level'] = level
+    if level != 0:
+        levels = [l for l in pyramid['levels'] if l['level'] == level] \
+            if pyramid else []
+        if not len(levels):
+            return None
+        img_doc.update(levels[0])
+
+    chunksCursor = colCursor.database['{:s}.chunks'.format(fs)]
+    data, region = get_array_region(
+        fsCursor, chunksCursor, img_doc['data'], x0, y0, x1, y1)
+    img_doc['data'] = data
+    img_doc['region'] = list(region)
+    img_doc['width'] = int(data.shape[1])
+    img_doc['height'] = int(data.shape[0])
+    return img_doc
+
 def replace_objid_to_str(doc):
     if not isinstance(doc, dict):
         return doc
@@ -0,0 +1,355 @@
+"""
+Compact in-memory fsmap
+
+An fsmap item used to be a dict of 14 keys whose `children` and `parent`
+held full absolute paths, so every path was repeated up to four times
+(after loading from json, as separate strings). Here an item is an
+`FsNode` with __slots__: tree links are integer ids, names are interned,
+and `realpath` is only kept for symbolic links. A path string is kept
+once, as the key of its node.
+
+`FsMap.to_item()` is the single converter to the dict format of fsmap
+items (used in responses and in the saved json). Moving a directory only
+re-keys the paths of its sub-tree, since ids do not change.
+
+Run this module to compare memory and traversal time with the dict layout:
+    python -m model.fsmap [the number of directories]
+"""
+import os
+import sys
+
+
+class FsNode(object):
+    __slots__ = (
+        'id',           # id of this node in its FsMap
+        'name',         # name of the directory for display (interned)
+        'parent',       # id of the parent node (None: top or left-over)
+        'children',     # ids of direct children
+        'realpath',     # realpath if it differs from the path (symlink)
+        'link',         # linked path
+        'valid',        # False for a left-over of a removed directory
+        'db',           # related database [db, collection, fs]
+        'fixed',        # True once a client set `db` (then only set manually)
+        'file',         # sample file name used to determine group name
+        'sep',          # separator used to parse group name from the file
+        'group',        # group name in this folder
+        'last_sync',    # the last date and time sync is applied
+    )
+
+    def __init__(self, id, name, parent=None):
+        self.id = id
+        self.name = sys.intern(name)
+        self.parent = parent
+        self.children = []
+        self.realpath = None
+        self.link = None
+        self.valid = True
+        self.db = None
+        self.fixed = False
+        self.file = None
+        self.sep = None
+        self.group = None
+        self.last_sync = None
+
+
+class FsMap(object):
+    def __init__(self):
+        # key: path, value: node
+        self.nodes = {}
+        # key: id, value: path
+        self.paths = {}
+        self.next_id = 0
+
+    def __contains__(self, path):
+        return path in self.nodes
+
+    def __getitem__(self, path) -> FsNode:
+        return self.nodes[path]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, path, default=None):
+        return self.nodes.get(path, default)
+
+    def items(self):
+        return self.nodes.items()
+
+    def parent_path(self, path):
+        """Path of the parent (None for a top or left-over node)"""
+        parent = self.nodes[path].parent
+        return None if parent is None else self.paths[parent]
+
+    def children_paths(self, path):
+        return [self.paths[c] for c in self.nodes[path].children]
+
+    def realpath(self, path):
+        node = self.nodes[path]
+        return path if node.realpath is None else node.realpath
+
+    def add(self, path, parent_path=None, realpath=None, name=None):
+        """
+        Add a node of a directory under its parent (None: a top node)
+        Args:
+            path: path to the directory
+            parent_path: path to the parent
+            realpath: realpath of the directory (None: resolved here)
+            name: name for display (None: the path for a top node,
+                  otherwise the base name)
+
+        Returns:
+            the new node
+        """
+        if parent_path is None:
+            node = FsNode(self.next_id, path if name is None else name)
+        else:
+            parent = self.nodes[parent_path]
+            if name is None:
+                name = os.path.basename(path)
+            node = FsNode(self.next_id, name, parent.id)
+            parent.children.append(node.id)
+        self.next_id += 1
+
+        if realpath is None:
+            realpath = os.path.realpath(path)
+        if realpath != path:
+            node.realpath = realpath
+        self.nodes[path] = node
+        self.paths[node.id] = path
+        return node
+
+    def _unlink_parent(self, node):
+        if node.parent is None or node.parent not in self.paths:
+            return
+        siblings = self.nodes[self.paths[node.parent]].children
+        if node.id in siblings:
+            siblings.remove(node.id)
+
+    def remove(self, path):
+        """
+        Remove a node (not its children)
+        Returns:
+            the removed node
+        """
+        node = self.nodes.pop(path)
+        del self.paths[node.id]
+        self._unlink_parent(node)
+        return node
+
+    def detach(self, path):
+        """Turn a node into a left-over (kept to be fixed manually)"""
+        node = self.nodes[path]
+        self._unlink_parent(node)
+        node.parent = None
+        node.children = []
+        node.valid = False
+        node.link = None
+        return node
+
+    def subtree(self, path):
+        """Paths of a node and its descendants (parents first)"""
+        paths = []
+        stack = [self.nodes[path].id]
+        while len(stack):
+            i = stack.pop()
+            paths.append(self.paths[i])
+            stack.extend(reversed(self.nodes[self.paths[i]].children))
+        return paths
+
+    def move(self, src_path, dst_path, dst_parent_path):
+        """
+        Move a node and its descendants under a new parent
+        Returns:
+            [(old path, new path)]
+        """
+        node = self.nodes[src_path]
+        self._unlink_parent(node)
+        parent = self.nodes[dst_parent_path]
+        parent.children.append(node.id)
+        node.parent = parent.id
+        node.name = sys.intern(os.path.basename(dst_path))
+
+        moved = []
+        for p in self.subtree(src_path):
+            moved.append((p, dst_path + p[len(src_path):]))
+        # re-key after all are collected (a new path can be an old one)
+        sub_nodes = [self.nodes.pop(p) for p, _ in moved]
+        for (_, new_p), n in zip(moved, sub_nodes):
+            self.nodes[new_p] = n
+            self.paths[n.id] = new_p
+            realpath = os.path.realpath(new_p)
+            n.realpath = realpath if realpath != new_p else None
+        return moved
+
+    def to_item(self, path):
+        """A node in the dict format of fsmap items"""
+        node = self.nodes[path]
+        paths = self.paths
+        item = {
+            'path': path,
+            'realpath': path if node.realpath is None else node.realpath,
+            'name': node.name,
+            'children': [paths[c] for c in node.children],
+            'parent': None if node.parent is None else paths[node.parent],
+        }
+        item['link'] = node.link
+        item['valid'] = node.valid
+        item['db'] = node.db
+        item['fixed'] = node.fixed
+        item['file'] = node.file
+        item['sep'] = node.sep
+        item['group'] = node.group
+        item['last_sync'] = node.last_sync
+        return item
+
+    def as_list(self):
+        """[[path, item]] of valid nodes (e.g. responses of the fsmap)"""
+        return [[path, self.to_item(path)]
+                for path, node in self.nodes.items() if node.valid]
+
+    def to_nested(self):
+        """Nested format, where children are items (e.g. saved json)"""
+        def __convert_to_hierarchical_format(path):
+            item = self.to_item(path)
+            item['children'] = [__convert_to_hierarchical_format(c)
+                                for c in item['children']]
+            return item
+
+        return {path: __convert_to_hierarchical_format(path)
+                for path, node in self.nodes.items() if node.parent is None}
+
+    @staticmethod
+    def from_items(items:dict):
+        """FsMap from a flat dict of fsmap items, key: path"""
+        fsmap = FsMap()
+        # parents first, so that children are linked in order
+        for path in _parents_first(items):
+            item = items[path]
+            parent = item.get('parent')
+            if parent is not None and parent not in fsmap:
+                parent = None
+            node = fsmap.add(path, parent, item.get('realpath', path),
+                             item.get('name'))
+            node.link = item.get('link')
+            node.valid = item.get('valid', True)
+            node.db = item.get('db')
+            node.fixed = item.get('fixed', False)
+            node.file = item.get('file')
+            node.sep = item.get('sep')
+            node.group = item.get('group')
+            node.last_sync = item.get('last_sync')
+        return fsmap
+
+
+def _parents_first(items:dict):
+    """Paths of items where a parent comes before its children"""
+    order = []
+    stack = [p for p, item in items.items()
+             if item.get('parent') is None or item['parent'] not in items]
+    visited = set()
+    while len(stack):
+        path = stack.pop()
+        if path in visited:
+            continue
+        visited.add(path)
+        order.append(path)
+        stack.extend(reversed([c for c in items[path]['children']
+                               if c in items and c not in visited]))
+    # items unreachable from a top (broken links in a saved file)
+    order.extend(p for p in items if p not in visited)
+    return order
+
+
+if __name__ == '__main__':
+    import json
+    import time
+    import tracemalloc
+
+    def _dict_item(path, parent):
+        # the layout of fsmap items before FsNode
+        return {
+            'path': path, 'realpath': path,
+            'name': path if parent is None else os.path.basename(path),
+            'children': [], 'parent': parent, 'link': None, 'valid': True,
+            'db': None, 'fixed': False, 'file': None, 'sep': None,
+            'group': None, 'last_sync': None,
+        }
+
+    def _synthetic_paths(n, fanout=10, root='/data/root'):
+        """Paths of n directories in a tree, parents first"""
+        paths = [root]
+        i = 0
+        while len(paths) < n:
+            for k in range(fanout):
+                if len(paths) >= n: break
+                paths.append(os.path.join(paths[i], 'scan_{:04d}'.format(k)))
+            i += 1
+        return paths
+
+    def _measure(build):
+        # time without tracing, which slows down allocations
+        t = time.perf_counter()
+        build()
+        elapsed = time.perf_counter() - t
+        tracemalloc.start()
+        obj = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return obj, size, elapsed
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    paths = _synthetic_paths(n)
+
+    def _dict_layout():
+        fsmap = {}
+        for p in paths:
+            parent = None if p == paths[0] else os.path.dirname(p)
+            if parent is not None:
+                fsmap[parent]['children'].append(p)
+            fsmap[p] = _dict_item(p, parent)
+        return json.dumps(fsmap)
+
+    # both are built from the saved json, as they are on load
+    saved = _dict_layout()
+
+    def _build_dict():
+        return json.loads(saved)
+
+    def _build_node():
+        return FsMap.from_items(json.loads(saved))
+
+    dict_map, dict_bytes, dict_t = _measure(_build_dict)
+    node_map, node_bytes, node_t = _measure(_build_node)
+    print('{:d} directories'.format(n))
+    print('memory    dict: {:8.1f} MB, node: {:8.1f} MB'.format(
+        dict_bytes / 2**20, node_bytes / 2**20))
+    print('build     dict: {:8.3f} sec, node: {:8.3f} sec'.format(dict_t, node_t))
+
+    def _walk_dict():
+        count = 0
+        stack = [paths[0]]
+        while len(stack):
+            item = dict_map[stack.pop()]
+            count += 1
+            stack.extend(item['children'])
+        return count
+
+    def _walk_node():
+        return len(node_map.subtree(paths[0]))
+
+    t = time.perf_counter()
+    _walk_dict()
+    dt = time.perf_counter() - t
+    t = time.perf_counter()
+    _walk_node()
+    nt = time.perf_counter() - t
+    print('{:9s} dict: {:8.3f} sec, node: {:8.3f} sec'.format('traverse', dt, nt))
+
+    # response of the fsmap (get_fsmap_as_list + json)
+    t = time.perf_counter()
+    json.dumps([[k, v] for k, v in dict_map.items() if v['valid']])
+    dt = time.perf_counter() - t
+    t = time.perf_counter()
+    json.dumps(node_map.as_list())
+    nt = time.perf_counter() - t
+    print('{:9s} dict: {:8.3f} sec, node: {:8.3f} sec'.format('response', dt, nt))
@@ -0,0 +1,214 @@
+"""
+Journaled persistence of the fsmap
+
+The fsmap is stored as a snapshot (the nested json file, e.g. fsmap.json)
+and an append-only journal next to it (fsmap.json.journal). A change of
+the fsmap appends the changed items to the journal, instead of rewriting
+the whole snapshot; the journal is compacted into a new snapshot once it
+grows long.
+
+Changes are only queued by the caller (under its lock), as items of the
+changed paths. Files are written by a background flusher thread, so
+writing never blocks the caller; only a snapshot is taken from the caller
+(`snapshot()`) to compact. On load, the snapshot is read and the journal
+is replayed on top of it. Changes queued while a snapshot is taken can be
+in both; since the caller queues a change in the same lock as it makes it,
+the journal line is never older than the snapshot.
+
+Compaction is crash safe: the new snapshot is written to a temp file
+(fsync'ed), the journal is rotated to `.old`, then the temp file replaces
+the snapshot and `.old` is removed. On load, a left-over temp file means
+the snapshot was not replaced (replay `.old`), otherwise `.old` is
+already in the snapshot (discard it).
+
+A journal line is {"path": str, "item": dict} for a changed item, or
+{"path": str, "item": null} for a removed one.
+"""
+import os
+import json
+import atexit
+import threading
+
+
+def flatten_fsmap(data:dict):
+    """Nested (snapshot) format to the flat fsmap"""
+    flat = {}
+    stack = list(data.values())
+    while len(stack):
+        node = stack.pop()
+        item = dict(node)
+        item['children'] = [child['path'] for child in node['children']]
+        flat[item['path']] = item
+        stack.extend(node['children'])
+    return flat
+
+
+class FsmapStore(object):
+    def __init__(self, filename, snapshot, compact_lines=1000, flush_interval=1.0):
+        # snapshot file
+        self.filename = filename
+        # function returning the whole fsmap in the nested format
+        self.snapshot = snapshot
+        # journal file
+        self.journal_fn = filename + '.journal'
+        # journal rotated while a snapshot is replacing the old one
+        self.old_journal_fn = self.journal_fn + '.old'
+        # new snapshot before it replaces the old one
+        self.tmp_fn = filename + '.tmp'
+        # compact the journal when it has this many lines
+        self.compact_lines = compact_lines
+        # seconds changes are collected before they are written
+        self.flush_interval = flush_interval
+
+        # protects pending, full and journal_lines
+        self.lock = threading.Lock()
+        # changes to append, key: path, value: item (None: removed)
+        self.pending = {}
+        # True if a new snapshot is requested
+        self.full = False
+        # the number of lines in the journal
+        self.journal_lines = 0
+
+        # flusher thread
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.t = None
+
+    def load(self):
+        """
+        Load the snapshot and replay the journal
+        Returns:
+            the flat fsmap
+        """
+        fsmap = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    fsmap = flatten_fsmap(json.load(f))
+            except (TypeError, KeyError, json.decoder.JSONDecodeError):
+                print('[WARN] Failed to load saved fsmap, {}!!!'.format(self.filename))
+                print('[WARN] Previous fsmap will be ignored, if there is.')
+                fsmap = {}
+
+        # recover from a crash while compacting
+        if os.path.exists(self.old_journal_fn):
+            if os.path.exists(self.tmp_fn):
+                # the snapshot is not replaced, the rotated journal is needed
+                self._merge_journals()
+            else:
+                os.remove(self.old_journal_fn)
+        if os.path.exists(self.tmp_fn):
+            os.remove(self.tmp_fn)
+
+        lines = 0
+        if os.path.exists(self.journal_fn):
+            with open(self.journal_fn) as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # a line cut by a crash
+                        print('[WARN] Ignored a broken line of {}'.format(self.journal_fn))
+                        continue
+                    if change['item'] is None:
+                        fsmap.pop(change['path'], None)
+                    else:
+                        fsmap[change['path']] = change['item']
+                    lines += 1
+
+        with self.lock:
+            self.journal_lines = lines
+        return fsmap
+
+    def _merge_journals(self):
+        """Put the rotated journal back in front of the journal"""
+        with open(self.old_journal_fn, 'a') as f:
+            if os.path.exists(self.journal_fn):
+                with open(self.journal_fn) as j:
+                    f.write(j.read())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.old_journal_fn, self.journal_fn)
+
+    def start(self):
+        self.t = threading.Thread(target=self._process, name='fsmap_flusher')
+        self.t.daemon = True
+        self.t.start()
+        atexit.register(self.close)
+
+    def save(self, items=None):
+        """
+        Queue changes of the fsmap to write
+        Args:
+            items: key: changed path, value: its item (None: removed)
+                   (None: save the whole fsmap as a snapshot)
+        """
+        with self.lock:
+            if items is None:
+                self.full = True
+            else:
+                self.pending.update(items)
+        self.wakeup.set()
+
+    def flush(self):
+        """Write queued changes (called by the flusher)"""
+        with self.lock:
+            compact = self.full or \
+                self.journal_lines + len(self.pending) >= self.compact_lines
+            changes = self.pending
+            self.pending = {}
+            if compact:
+                self.full = False
+                self.journal_lines = 0
+            else:
+                self.journal_lines += len(changes)
+
+        try:
+            if compact:
+                # taken after the changes, so it has all of them
+                self._write_snapshot(self.snapshot())
+            elif len(changes):
+                self._append(changes)
+        except OSError:
+            # write a whole snapshot next time
+            with self.lock:
+                self.full = True
+            raise
+
+    def _write_snapshot(self, snapshot):
+        with open(self.tmp_fn, 'w') as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        # the snapshot has all the changes in the journal
+        if os.path.exists(self.journal_fn):
+            os.replace(self.journal_fn, self.old_journal_fn)
+        os.replace(self.tmp_fn, self.filename)
+        if os.path.exists(self.old_journal_fn):
+            os.remove(self.old_journal_fn)
+
+    def _append(self, changes:dict):
+        with open(self.journal_fn, 'a') as f:
+            for path, item in changes.items():
+                f.write(json.dumps({'path': path, 'item': item}) + '\n')
+            f.flush()
+
+    def _process(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # collect changes made at nearly the same time
+            self.stopped.wait(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as ex:
+                print('[WARN] Failed to save fsmap, {} | {}'.format(self.filename, ex))
+
+    def close(self):
+        """Stop the flusher and write what is left (at exit)"""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
+        self.flush()
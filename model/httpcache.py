@@ -0,0 +1,90 @@
+"""
+Validators for HTTP conditional requests (ETag / Last-Modified)
+
+ETags of query results are derived from versions of the collections they
+read (see QueryCache, and colversion for writes by other processes), and
+ETags of images from their gridfs files. Since versions restart from 0
+with the server, ETags of query results include EPOCH which is different
+for every server process.
+
+ETags are made strong; compressed responses (and their 304s) send them
+weak (W/), see Compressor. Conditional requests use the weak comparison,
+so either form matches.
+
+A gridfs file is never modified in place (a new file is written when an
+image changes), so an image response keyed by its file is immutable: it
+can be cached for long when a client asks for it by that key (`v`).
+"""
+import os
+import time
+import hashlib
+import datetime
+from email.utils import format_datetime, parsedate_to_datetime
+
+# unique per server process
+EPOCH = '{:x}.{:x}'.format(int(time.time() * 1000), os.getpid())
+
+# Cache-Control of responses requested by a content key
+CACHE_IMMUTABLE = 'private, max-age=31536000, immutable'
+# Cache-Control of the others (cached, but always revalidated)
+CACHE_REVALIDATE = 'no-cache'
+
+
+def make_etag(*parts):
+    """
+    ETag from parts identifying a response (strong, weakened by
+    Compressor when the response is compressed)
+    """
+    h = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=12)
+    return '"{:s}"'.format(h.hexdigest())
+
+
+def http_date(dt:datetime.datetime):
+    """Format a datetime (naive: UTC) as an HTTP date"""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return format_datetime(dt.astimezone(datetime.timezone.utc), usegmt=True)
+
+
+def validator_headers(etag, last_modified=None, cache_control=CACHE_REVALIDATE):
+    """Response headers with validators"""
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def is_not_modified(req_headers, etag, last_modified=None):
+    """
+    Check conditional request headers against validators of a response.
+    If-None-Match takes precedence over If-Modified-Since.
+    """
+    inm = req_headers.get('If-None-Match')
+    if inm is not None:
+        tags = [t.strip() for t in inm.split(',')]
+        # weak comparison
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+
+    ims = req_headers.get('If-Modified-Since')
+    if ims is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(ims)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    # HTTP dates have a resolution of a second
+    return last_modified.replace(microsecond=0) <= since
+
+
+def check_conditional(req_headers, etag, last_modified=None,
+                      cache_control=CACHE_REVALIDATE):
+    """
+    Returns:
+        (True if `304 Not Modified` can be sent, response headers)
+    """
+    headers = validator_headers(etag, last_modified, cache_control)
+    return is_not_modified(req_headers, etag, last_modified), headers
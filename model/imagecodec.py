@@ -0,0 +1,79 @@
+"""
+Encoding image arrays for binary responses
+
+Supported output formats (selected by the `Accept` request header):
+    - raw: native dtype buffer as stored (C order)
+    - png16: 16-bit grayscale PNG
+    - uint8: raw 8-bit buffer
+
+For png16 and uint8, values are linearly mapped from [min, max] of the
+image to the full range of the output type. Clients can map them back with
+the min/max response headers.
+"""
+import io
+import numpy as np
+from PIL import Image
+
+MIME_RAW = 'application/octet-stream'
+MIME_PNG16 = 'image/png'
+MIME_UINT8 = 'application/vnd.multiview.uint8'
+
+# the first one is the default
+IMAGE_MIMETYPES = [MIME_RAW, MIME_PNG16, MIME_UINT8]
+
+
+def quantize(arr:np.ndarray, vmin, vmax, dtype):
+    """Linearly map [vmin, vmax] to the full range of an unsigned int dtype"""
+    maxval = np.iinfo(dtype).max
+    scale = maxval / (vmax - vmin) if vmax > vmin else 0.
+
+    out = np.empty(arr.shape, dtype=np.float32)
+    np.subtract(arr, vmin, out=out, casting='unsafe')
+    np.multiply(out, scale, out=out)
+    np.clip(out, 0, maxval, out=out)
+    np.rint(out, out=out)
+    return out.astype(dtype)
+
+
+def encode_image(arr:np.ndarray, mimetype, vmin=None, vmax=None):
+    """
+    Encode an image array
+    Args:
+        arr: 2D image array
+        mimetype: one of IMAGE_MIMETYPES
+        vmin, vmax: value range of the image (computed if not given)
+
+    Returns:
+        encoded bytes
+    """
+    if mimetype == MIME_RAW:
+        return np.ascontiguousarray(arr).tobytes()
+
+    if vmin is None: vmin = float(np.nanmin(arr))
+    if vmax is None: vmax = float(np.nanmax(arr))
+
+    if mimetype == MIME_PNG16:
+        im = Image.fromarray(quantize(arr, vmin, vmax, np.uint16))
+        buf = io.BytesIO()
+        im.save(buf, format='PNG')
+        return buf.getvalue()
+    elif mimetype == MIME_UINT8:
+        return quantize(arr, vmin, vmax, np.uint8).tobytes()
+
+    raise ValueError('Unsupported image format: {}'.format(mimetype))
+
+
+def image_headers(img_doc:dict):
+    """Response headers describing an image subdocument with array data"""
+    arr = img_doc['data']
+    headers = {
+        'X-Image-Width': str(img_doc['width']),
+        'X-Image-Height': str(img_doc['height']),
+        'X-Image-Dtype': arr.dtype.str,
+        'X-Image-Min': repr(float(img_doc['min'])),
+        'X-Image-Max': repr(float(img_doc['max'])),
+        'X-Image-Level': str(img_doc.get('level', 0))
+    }
+    if 'region' in img_doc:
+        headers['X-Image-Region'] = ','.join(str(v) for v in img_doc['region'])
+    return headers
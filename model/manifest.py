@@ -0,0 +1,127 @@
+"""
+Persistent file manifest for incremental syncing
+
+For each synced file, the manifest keeps its size, modification time and a
+content fingerprint. It is stored per project in a collection next to the
+project collection (e.g. `test_col.manifest`), so that a resync only needs
+to parse and write files that are new or have changed since the last sync.
+"""
+import os
+import hashlib
+import pymongo
+
+
+def manifest_name(col):
+    """Name of the manifest collection associated with a collection"""
+    return '{:s}.manifest'.format(col)
+
+
+def fingerprint(path, block_size=1 << 20):
+    """Content fingerprint (blake2b hex digest) of a file"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, colCursor, project_name, flush_size=500):
+        # cursor to the manifest collection
+        self.colCursor = colCursor
+        # project name (a manifest collection can be shared by projects)
+        self.project_name = project_name
+        # the number of pending updates before writing them to db
+        self.flush_size = flush_size
+        # key: path, value: {'size', 'mtime', 'fingerprint'}
+        self.entries = {}
+        # pending entries to write
+        self.pending = []
+
+    def load(self):
+        """Load all entries of the project into memory (single query)"""
+        self.entries = {}
+        fields = {'_id': 0, 'path': 1, 'size': 1, 'mtime': 1, 'fingerprint': 1}
+        for doc in self.colCursor.find({'project': self.project_name}, fields):
+            self.entries[doc['path']] = doc
+        return len(self.entries)
+
+    def check(self, path, st=None):
+        """
+        Check if a file is new or changed since it was recorded.
+
+        Size and mtime are compared first. The fingerprint is computed only
+        when one of them differs, so that touched-but-identical files are
+        still skipped.
+
+        Args:
+            path: full path to a file
+            st: os.stat_result of the file, if it is already available
+
+        Returns:
+            (changed, entry) where entry is the up-to-date manifest entry
+            to pass to `update()` once the file is synced.
+        """
+        if st is None:
+            st = os.stat(path)
+        entry = {
+            'path': path,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'fingerprint': None
+        }
+
+        prev = self.entries.get(path)
+        if prev is not None and \
+                prev['size'] == entry['size'] and \
+                prev['mtime'] == entry['mtime']:
+            entry['fingerprint'] = prev['fingerprint']
+            return False, entry
+
+        entry['fingerprint'] = fingerprint(path)
+        if prev is not None and \
+                prev['size'] == entry['size'] and \
+                prev['fingerprint'] == entry['fingerprint']:
+            # only mtime changed, record it without re-syncing
+            self.update(entry)
+            return False, entry
+
+        return True, entry
+
+    def update(self, entry):
+        """Record a synced file. Writes are batched."""
+        self.entries[entry['path']] = entry
+        self.pending.append(entry)
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write pending entries to db"""
+        if not len(self.pending):
+            return 0
+
+        requests = [
+            pymongo.UpdateOne(
+                {'project': self.project_name, 'path': entry['path']},
+                {'$set': {
+                    'size': entry['size'],
+                    'mtime': entry['mtime'],
+                    'fingerprint': entry['fingerprint']
+                }},
+                upsert=True
+            )
+            for entry in self.pending
+        ]
+        self.colCursor.bulk_write(requests, ordered=False)
+        n = len(self.pending)
+        self.pending = []
+        return n
+
+    def clear(self):
+        """Drop all entries of the project to force a full resync"""
+        self.colCursor.delete_many({'project': self.project_name})
+        self.entries = {}
+        self.pending = []
@@ -0,0 +1,76 @@
+"""
+Multi-resolution image pyramid
+
+Level 0 is the base image. Level k is the base image downsampled by 2^k
+in each dimension using block reduction (mean or max over 2x2 blocks of
+the previous level). Odd last rows/columns are dropped.
+"""
+import numpy as np
+
+PYRAMID_MODES = ['mean', 'max']
+
+
+def reduce_2x2(arr:np.ndarray, mode='mean'):
+    """Downsample a 2D array by 2 with a vectorized 2x2 block reduction"""
+    h, w = arr.shape[0] // 2, arr.shape[1] // 2
+    blocks = arr[:2*h, :2*w].reshape(h, 2, w, 2)
+
+    if mode == 'max':
+        return blocks.max(axis=(1, 3))
+    elif mode == 'mean':
+        out = blocks.mean(axis=(1, 3), dtype=np.float32)
+        if np.issubdtype(arr.dtype, np.integer):
+            np.rint(out, out=out)
+        return out.astype(arr.dtype, copy=False)
+
+    raise ValueError('Unsupported pyramid mode: {}'.format(mode))
+
+
+def build_pyramid(arr:np.ndarray, mode='mean', min_size=128):
+    """
+    Build pyramid levels (excluding the base image).
+    Args:
+        arr: 2D base image
+        mode: block reduction, one of PYRAMID_MODES
+        min_size: stop when the larger dimension is not bigger than this
+
+    Returns:
+        list of level documents:
+        {'level': int, 'width': int, 'height': int, 'data': np.ndarray}
+    """
+    levels = []
+    level = 0
+    cur = arr
+    while max(cur.shape[0], cur.shape[1]) > min_size and \
+            min(cur.shape[0], cur.shape[1]) >= 2:
+        cur = reduce_2x2(cur, mode)
+        level += 1
+        levels.append({
+            'level': level,
+            'width': int(cur.shape[1]),
+            'height': int(cur.shape[0]),
+            'data': cur
+        })
+    return levels
+
+
+def select_level(img_doc:dict, width, height):
+    """
+    Select the smallest level that is at least `width` x `height`
+    Args:
+        img_doc: image subdocument (with optional `pyramid`)
+        width, height: requested display size (None is ignored)
+
+    Returns:
+        level (0 for the base image)
+    """
+    pyramid = img_doc.get('pyramid')
+    if pyramid is None:
+        return 0
+
+    selected = 0
+    for l in sorted(pyramid['levels'], key=lambda l: l['level']):
+        if width is not None and l['width'] < width: break
+        if height is not None and l['height'] < height: break
+        selected = l['level']
+    return selected
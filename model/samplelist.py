@@ -0,0 +1,129 @@
+"""
+Materialized sample list
+
+The number of documents per sample is kept in a small summary collection
+next to the project collection (e.g. `test_col.samples`), so that a sample
+list is read without aggregating the project collection.
+
+A summary document is {'key', 'sample', 'count', 'last_updated'}, where
+`key` is the value of the field a sample list is grouped by (project name
+for projects, directory path for watched folders). Counts are updated with
+`$inc` upserts as documents are written; `rebuild_samplelist()` recomputes
+them from the project collection for repairs.
+"""
+import datetime
+import pymongo
+from model.colversion import bump_version
+
+# indexes of a summary collection
+SAMPLELIST_INDEXES = [
+    ([('key', pymongo.ASCENDING), ('sample', pymongo.ASCENDING)],
+     {'name': 'key_sample', 'unique': True}),
+]
+
+
+def samplelist_name(col):
+    """Name of the summary collection associated with a collection"""
+    return '{:s}.samples'.format(col)
+
+
+def inc_samplelist(sumCursor, deltas:dict):
+    """
+    Apply count changes to a summary collection
+    Args:
+        sumCursor: cursor to the summary collection
+        deltas: key: (key, sample), value: change of the count
+
+    Returns:
+        the number of updated samples
+    """
+    now = datetime.datetime.now()
+    requests = [
+        pymongo.UpdateOne(
+            {'key': key, 'sample': sample},
+            {'$inc': {'count': n}, '$set': {'last_updated': now}},
+            upsert=True
+        )
+        for (key, sample), n in deltas.items() if n != 0
+    ]
+    if not len(requests):
+        return 0
+    sumCursor.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def read_samplelist(sumCursor, keys):
+    """
+    Read a sample list
+    Args:
+        sumCursor: cursor to the summary collection
+        keys: a key or list of keys (counts of the same sample are summed)
+
+    Returns:
+        [{'_id': sample, 'count': int}] like the $group of samples
+    """
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    query = {'key': {'$in': list(keys)}, 'count': {'$gt': 0}}
+    fields = {'_id': 0, 'sample': 1, 'count': 1}
+
+    samples = {}
+    for doc in sumCursor.find(query, fields):
+        name = doc['sample']
+        samples[name] = samples.get(name, 0) + doc['count']
+    return [{'_id': name, 'count': count} for name, count in samples.items()]
+
+
+def rebuild_samplelist(colCursor, sumCursor, by):
+    """
+    Recompute a summary collection from its project collection.
+    It is built in a temporary collection which then replaces the summary
+    at once (rename), so readers never see a partial sample list.
+    Args:
+        colCursor: cursor to the project collection
+        sumCursor: cursor to the summary collection
+        by: field a sample list is grouped by ('project' or 'path')
+
+    Returns:
+        the number of samples
+    """
+    pipeline = [
+        {"$match": {by: {"$exists": True, "$ne": None}}},
+        {"$match": {"sample": {"$exists": True, "$ne": None}}},
+        {"$group": {"_id": {"key": "$" + by, "sample": "$sample"},
+                    "count": {"$sum": 1}}}
+    ]
+    now = datetime.datetime.now()
+    docs = [
+        {'key': g['_id']['key'], 'sample': g['_id']['sample'],
+         'count': g['count'], 'last_updated': now}
+        for g in colCursor.aggregate(pipeline)
+    ]
+
+    if len(docs):
+        tmpCursor = sumCursor.database['{:s}.rebuild'.format(sumCursor.name)]
+        tmpCursor.drop()
+        for keys, options in SAMPLELIST_INDEXES:
+            tmpCursor.create_index(keys, **options)
+        tmpCursor.insert_many(docs)
+        tmpCursor.rename(sumCursor.name, dropTarget=True)
+    else:
+        sumCursor.delete_many({})
+    bump_version(colCursor)
+    return len(docs)
+
+
+def ensure_samplelist(colCursor, sumCursor, by):
+    """
+    Build a summary collection if it is empty while the project collection
+    has samples (e.g. data synced before the summary existed).
+
+    Returns:
+        True if it is rebuilt
+    """
+    if sumCursor.find_one({}, {'_id': 1}) is not None:
+        return False
+    if colCursor.find_one({'sample': {'$exists': True, '$ne': None}}, {'_id': 1}) is None:
+        return False
+    rebuild_samplelist(colCursor, sumCursor, by)
+    return True
@@ -0,0 +1,281 @@
+"""
+Serializing queried documents for responses
+
+Documents are flattened (nested keys joined by '/'), ObjectIds are
+converted to str and the result is encoded to JSON in a single walk over
+each raw document. Streaming encoders write into a chunked buffer and yield
+the chunks, so that memory doesn't grow with the size of a response.
+
+NDJSON responses put one flattened document per line, ordered by `item`.
+They are paginated by a cursor: a request with `after_item` (the item of
+the last document received) and `limit` returns the next page. A page
+with less than `limit` documents is the last one.
+"""
+import json
+import heapq
+import itertools
+from bson.objectid import ObjectId
+
+# size of a chunk yielded by streaming encoders (characters)
+CHUNK_SIZE = 64 * 1024
+
+try:
+    from json.encoder import c_encode_basestring_ascii as _encode_str
+except ImportError:
+    from json.encoder import py_encode_basestring_ascii as _encode_str
+if _encode_str is None:
+    from json.encoder import py_encode_basestring_ascii as _encode_str
+
+_fallback_encoder = json.JSONEncoder(default=str)
+
+
+def iter_flat(doc:dict, prefix=''):
+    """
+    Walk a document once, yielding (flattened key, value).
+    Nested keys are joined by '/' and ObjectIds are converted to str, the
+    same as flatten_dict(replace_objid_to_str(doc)) without copying.
+    """
+    for key, value in doc.items():
+        if prefix:
+            key = prefix + '/' + key
+        if isinstance(value, dict):
+            yield from iter_flat(value, key)
+        elif isinstance(value, ObjectId):
+            yield key, str(value)
+        else:
+            yield key, value
+
+
+def _value_type(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    return 'mixed'
+
+
+class ColumnarBuilder(object):
+    """
+    Build a columnar table from documents in a single pass.
+
+    The table is
+        {
+            'count': the number of rows,
+            'fields': ordered list of flattened field names,
+            'types': type of each field ('number', 'string', 'bool', 'mixed'),
+            'columns': list of value arrays (one per field, None if missing)
+        }
+    """
+    def __init__(self):
+        self.count = 0
+        # key: field name, value: column index
+        self.index = {}
+        self.fields = []
+        self.types = []
+        self.columns = []
+
+    def add(self, doc:dict):
+        row = self.count
+        for key, value in iter_flat(doc):
+            i = self.index.get(key)
+            if i is None:
+                # new field, fill previous rows with None
+                i = len(self.fields)
+                self.index[key] = i
+                self.fields.append(key)
+                self.types.append(None)
+                self.columns.append([None] * row)
+            column = self.columns[i]
+            if len(column) > row:
+                # duplicated key after flattening, keep the last one
+                column[row] = value
+            else:
+                column.append(value)
+
+            t = _value_type(value)
+            if t is not None and self.types[i] != t:
+                self.types[i] = t if self.types[i] is None else 'mixed'
+
+        self.count = row + 1
+        # fill missing fields of this row
+        for column in self.columns:
+            if len(column) < self.count:
+                column.append(None)
+
+    def result(self):
+        return {
+            'count': self.count,
+            'fields': self.fields,
+            'types': [t if t is not None else 'mixed' for t in self.types],
+            'columns': self.columns
+        }
+
+
+def columnar_by_sample(docs, sample_names=None):
+    """
+    Build a columnar table per sample in a single pass over documents.
+    If sample_names is given, every name is in the result (in the order).
+    """
+    builders = {}
+    if sample_names is not None:
+        for name in sample_names:
+            builders[name] = ColumnarBuilder()
+    for doc in docs:
+        name = doc.get('sample')
+        if name not in builders:
+            builders[name] = ColumnarBuilder()
+        builders[name].add(doc)
+    return {name: b.result() for name, b in builders.items()}
+
+
+def encode_value(value):
+    """Encode a value in JSON (the same as json.dumps for common types)"""
+    if isinstance(value, str):
+        return _encode_str(value)
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value == float('inf'):
+            return 'Infinity'
+        if value == -float('inf'):
+            return '-Infinity'
+        return float.__repr__(value)
+    if isinstance(value, ObjectId):
+        return '"' + str(value) + '"'
+    return _fallback_encoder.encode(value)
+
+
+def _encode_key(name):
+    """Encode an object key in JSON, coerced to a string as json.dumps does"""
+    if isinstance(name, str):
+        return _encode_str(name)
+    if name is None or isinstance(name, (int, float)):
+        # null, true, false and numbers have no characters to escape
+        return '"' + encode_value(name) + '"'
+    return _encode_str(str(name))
+
+
+def encode_flat(doc:dict):
+    """Flatten a document and encode it in JSON in a single walk"""
+    return '{' + ','.join(
+        _encode_str(key) + ':' + encode_value(value)
+        for key, value in iter_flat(doc)
+    ) + '}'
+
+
+class ChunkedBuffer(object):
+    """Output buffer that hands out chunks of about `chunk_size`"""
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, s):
+        """Write a string, returns a chunk if the buffer is full"""
+        self.parts.append(s)
+        self.size += len(s)
+        if self.size >= self.chunk_size:
+            return self.flush()
+        return None
+
+    def close(self, s=''):
+        """Write the last string, returns everything left in the buffer"""
+        self.parts.append(s)
+        return self.flush()
+
+    def flush(self):
+        chunk = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return chunk
+
+
+def stream_samples(docs, sample_names, fill_missing=True, chunk_size=CHUNK_SIZE):
+    """
+    Stream {'sampleList': [...], 'sampleData': {name: [flattened docs]}}.
+    `docs` must be sorted (grouped) by sample. If fill_missing, names in
+    sample_names without any documents are sent with an empty list.
+    """
+    buf = ChunkedBuffer(chunk_size)
+    yield '{"sampleList":' + json.dumps(sample_names) + ',"sampleData":{'
+
+    current = None
+    # encoded keys of samples sent
+    sent = set()
+    for doc in docs:
+        key = _encode_key(doc.get('sample'))
+        if not (key == current and len(sent)):
+            head = '],' if len(sent) else ''
+            head += key + ':['
+            current = key
+            sent.add(key)
+        else:
+            head = ','
+        chunk = buf.write(head + encode_flat(doc))
+        if chunk is not None:
+            yield chunk
+
+    tail = [']'] if len(sent) else []
+    for name in (sample_names if fill_missing else []):
+        key = _encode_key(name)
+        if key not in sent:
+            tail.append((',' if len(sent) else '') + key + ':[]')
+            sent.add(key)
+    yield buf.close(''.join(tail) + '}}')
+
+
+def stream_ndjson(docs, chunk_size=CHUNK_SIZE):
+    """Stream flattened documents as NDJSON (one document per line)"""
+    buf = ChunkedBuffer(chunk_size)
+    for doc in docs:
+        chunk = buf.write(encode_flat(doc) + '\n')
+        if chunk is not None:
+            yield chunk
+    yield buf.close()
+
+
+def merge_by_item(cursors, limit=0):
+    """Merge cursors sorted by item into one stream sorted by item"""
+    docs = heapq.merge(*cursors, key=lambda doc: doc.get('item') or '')
+    if limit:
+        docs = itertools.islice(docs, int(limit))
+    return docs
+
+
+def merge_by_sample(cursors):
+    """Merge cursors sorted by sample into one stream sorted by sample"""
+    return heapq.merge(*cursors, key=lambda doc: doc.get('sample') or '')
+
+
+def stream_json_array(items, encode=encode_value, chunk_size=CHUNK_SIZE):
+    """Stream a JSON array of items (e.g. a cursor) encoded by `encode`"""
+    buf = ChunkedBuffer(chunk_size)
+    sep = '['
+    for item in items:
+        chunk = buf.write(sep + encode(item))
+        sep = ','
+        if chunk is not None:
+            yield chunk
+    yield buf.close('[]' if sep == '[' else ']')
+
+
+def stream_json(obj, chunk_size=CHUNK_SIZE):
+    """Stream an object in memory encoded in JSON"""
+    buf = ChunkedBuffer(chunk_size)
+    for part in _fallback_encoder.iterencode(obj):
+        chunk = buf.write(part)
+        if chunk is not None:
+            yield chunk
+    yield buf.close()
@@ -1,15 +1,76 @@
 import os
 import threading
-import glob
 import time
 import copy
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Empty
 from datetime import datetime
 from model.parser import Parser
 from model.database import DataBase
-from model.database import save_image_document, save_document
+from model.database import save_documents_bulk
+from model.manifest import Manifest
+from model.utils import scan_files
+from model.samplelist import inc_samplelist
+from model.pyramid import PYRAMID_MODES, build_pyramid
+from model.arraystore import DEFAULT_TILE, tile_index
+
+
+# parser used by each process in the parser pool
+_worker_parser = None
+
+def _init_worker(parser:Parser):
+    """Initializer of a process in the parser pool"""
+    global _worker_parser
+    _worker_parser = parser
+
+def _run_parser(parser:Parser, path, ext, sample_name, project_name, pyramid):
+    """
+    Parse a file. For tiff, pyramid levels and tile indices are built here
+    as well so that they are computed in parallel with parsing.
+    """
+    doc = parser.run(
+        path,
+        kind=ext,
+        sample_name=sample_name,
+        project_name=project_name
+    )
+    if doc is None or ext != 'tiff':
+        return doc
+
+    tiff = doc['tiff']
+    if pyramid in PYRAMID_MODES:
+        tiff['pyramid'] = {
+            'mode': pyramid,
+            'levels': build_pyramid(tiff['data'], pyramid)
+        }
+
+    # store images larger than a tile in the tiled layout for region access
+    images = [tiff] + (tiff['pyramid']['levels'] if 'pyramid' in tiff else [])
+    for img in images:
+        shape = img['data'].shape
+        if len(shape) == 2 and \
+                (shape[0] > DEFAULT_TILE[0] or shape[1] > DEFAULT_TILE[1]):
+            img['tile'] = tile_index(shape, DEFAULT_TILE)
+    return doc
+
+def _parse_file(path, ext, sample_name, project_name, pyramid):
+    """Parse a file in a process of the parser pool"""
+    return _run_parser(
+        _worker_parser, path, ext, sample_name, project_name, pyramid)
 
 
 class Syncer(object):
+    """
+    Sync files under a project root with DB
+
+    Syncing runs as a three-stage pipeline connected by bounded queues:
+        1. discovery: walk the project root once and queue files to sync
+           as they are found (skip unchanged ones)
+        2. parsing: parse files on a process pool
+        3. writing: a single writer that stores documents in batches
+    """
     def __init__(self,
                  name:str,
                  project:dict,
@@ -17,7 +78,15 @@ class Syncer(object):
                  colCursor, fsCursor,
                  extensions:list,
                  interval:int,
-                 onFinished = None
+                 onFinished = None,
+                 manifest:Manifest = None,
+                 num_workers:int = None,
+                 batch_size:int = 100,
+                 queue_size:int = 64,
+                 onOverwrite = None,
+                 samplelist = None,
+                 onWritten = None,
+                 walk_workers:int = 8
     ):
         # thread name
         self.name = name
@@ -34,10 +103,36 @@ class Syncer(object):
         self.interval = interval
         # callback on finished
         self.onFinished = onFinished
+        # file manifest for incremental syncing (None: sync all files)
+        self.manifest = manifest
+        # the number of parser processes
+        # (None: the number of cpus, 0: parse in the syncer thread)
+        self.num_workers = num_workers if num_workers is not None \
+            else os.cpu_count()
+        # the number of documents written at once
+        self.batch_size = batch_size
+        # maximum number of items in each queue between stages
+        self.queue_size = queue_size
+        # callback with ids of documents whose images are overwritten
+        self.onOverwrite = onOverwrite
+        # cursor to the sample list summary collection (None: not maintained)
+        self.samplelist = samplelist
+        # callback after each batch of documents is written
+        self.onWritten = onWritten
+        # the number of threads listing directories
+        self.walk_workers = walk_workers
         # start & end time
         self.start_t = 0
         self.end_t = 0
 
+        # progress per extension, protected by progress_lock
+        self.progress_lock = threading.Lock()
+        self.total = {}
+        self.count = {}
+        self.skipped = {}
+        # True while files are being discovered (totals are not final)
+        self.discovering = False
+
         # thread
         self.t = None
 
@@ -47,78 +142,240 @@ class Syncer(object):
         self.t.start()
 
     def get_progress(self):
-        return copy.deepcopy(self.project)
+        with self.progress_lock:
+            return copy.deepcopy(self.project)
 
-    def _process(self):
-        self.start_t = time.time()
+    def _update_progress(self, ext, skipped=False):
+        """Count a synced (or skipped) file"""
+        with self.progress_lock:
+            self.count[ext] += 1
+            if skipped:
+                self.skipped[ext] += 1
+            count = self.count[ext]
+            total = self.total[ext]
+            if count%self.interval == 0 or count == total:
+                self.project[ext] = '{:d}/{:d}'.format(count, total)
+                self.project['skipped'][ext] = self.skipped[ext]
+                if count == total and not self.discovering:
+                    self._print_completed(ext)
+
+    def _print_completed(self, ext):
+        print('{:s} completed syncing *.{:s} files [{:s}, skipped: {:d}]'.format(
+            self.name, ext, self.project[ext], self.skipped[ext]
+        ))
+
+    def _sample_name(self, path, separator):
+        """Get sample name from the file name"""
+        basename = os.path.basename(path)
+        sample_name = basename
+        for sep in separator:
+            if len(sep) == 0: continue
+            tmp = basename.split(sep)[0]
+            if len(tmp) < len(sample_name):
+                sample_name = tmp
+        return sample_name
+
+    def _discover(self, task_q:Queue):
+        """Stage 1: collect files to sync and queue them for parsing"""
+        try:
+            self._discover_files(task_q)
+        finally:
+            # always let the next stage know the end of files
+            task_q.put(None)
 
+    def _discover_files(self, task_q:Queue):
         data_root = self.project['path']
         # separator could be single or multiple with ';' delimiter
         separator = self.project['separator'].split(';')
-        project_name = self.project['name']
-        print('{:s} starts syncing under {:s}'.format(self.name, data_root))
 
-        # collect file names to sync with DB
-        # this approach might be slow, but not bad (~ 0.5 sec for around 5000)
+        # totals grow as files are found, so that parsing starts with the
+        # first file instead of after listing the whole tree
+        # skipped: the number of files unchanged since the last sync
+        with self.progress_lock:
+            self.discovering = True
+            self.project['skipped'] = {}
+            for ext in self.extensions:
+                self.total[ext] = 0
+                self.count[ext] = 0
+                self.skipped[ext] = 0
+                self.project[ext] = '0/0'
+                self.project['skipped'][ext] = 0
+        if self.manifest is not None:
+            self.manifest.load()
+
         start_t = time.time()
-        all_pathes = [
-            os.path.join(data_root, '**', '*.' + ext)
-            for ext in self.extensions
-        ]
-        all_files = [glob.glob(path, recursive=True) for path in all_pathes]
-
-        # count the number of files to be updated
-        for ext, files in zip(self.extensions, all_files):
-            self.project[ext] = '{:d}/{:d}'.format(0,len(files))
+        try:
+            for ext, f, entry in scan_files(data_root, self.extensions,
+                                          self.walk_workers):
+                with self.progress_lock:
+                    self.total[ext] += 1
+                    total = self.total[ext]
+                    if total%self.interval == 0:
+                        self.project[ext] = '{:d}/{:d}'.format(self.count[ext], total)
+
+                # skip files unchanged since the last sync
+                m_entry = None
+                if self.manifest is not None:
+                    try:
+                        changed, m_entry = self.manifest.check(f, entry.stat())
+                    except OSError:
+                        # file is removed while syncing
+                        changed, m_entry = False, None
+                    if not changed:
+                        self._update_progress(ext, skipped=True)
+                        continue
+
+                task_q.put((ext, f, self._sample_name(f, separator), m_entry))
+        finally:
+            # totals are final, report extensions already done
+            with self.progress_lock:
+                self.discovering = False
+                for ext in self.extensions:
+                    count, total = self.count[ext], self.total[ext]
+                    self.project[ext] = '{:d}/{:d}'.format(count, total)
+                    self.project['skipped'][ext] = self.skipped[ext]
+                    if total > 0 and count == total:
+                        self._print_completed(ext)
         end_t = time.time()
 
-        count_info = ['{:s}: {:s}'.format(ext, self.project[ext])
+        count_info = ['{:s}: {:d}'.format(ext, self.total[ext])
                       for ext in self.extensions]
         print('{:s} retrived all files to update, {}, [{:.3f} sec]'.format(
             self.name, count_info, end_t - start_t))
 
-        # process on the files
+    def _parse(self, task_q:Queue, doc_q:Queue):
+        """Stage 2: parse queued files on a process pool"""
+        project_name = self.project['name']
+        # block reduction for tiff pyramid, 'mean' or 'max' ('none' to skip)
+        pyramid = self.project.get('pyramid', 'mean')
+
+        if self.num_workers <= 0:
+            while True:
+                task = task_q.get()
+                if task is None: break
+                ext, f, sample_name, entry = task
+                doc = _run_parser(
+                    self.parser, f, ext, sample_name, project_name, pyramid)
+                doc_q.put((ext, doc, entry))
+            doc_q.put(None)
+            return
+
+        def _result(_future):
+            try:
+                return _future.result()
+            except Exception as ex:
+                print('{:s} failed to parse a file | {}'.format(self.name, ex))
+                return None
+
+        # spawn (not fork) workers as this process runs other threads
+        executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.parser,)
+        )
+        # in-flight parsing jobs, bounded to keep memory flat
+        pending = deque()
+        try:
+            while True:
+                task = task_q.get()
+                if task is None: break
+                ext, f, sample_name, entry = task
+                future = executor.submit(
+                    _parse_file, f, ext, sample_name, project_name, pyramid)
+                pending.append((ext, future, entry))
+
+                if len(pending) >= self.queue_size:
+                    ext, future, entry = pending.popleft()
+                    doc_q.put((ext, _result(future), entry))
+
+            while len(pending):
+                ext, future, entry = pending.popleft()
+                doc_q.put((ext, _result(future), entry))
+        finally:
+            executor.shutdown(wait=True)
+            doc_q.put(None)
+
+    def _write_batch(self, batch:list):
+        """Store a batch of parsed documents"""
+        docs = [doc for ext, doc, _ in batch
+                if doc is not None and ext in ['xml', 'tiff']]
+        on_count = None
+        if self.samplelist is not None:
+            on_count = lambda deltas: inc_samplelist(self.samplelist, deltas)
+        try:
+            save_documents_bulk(
+                self.colCursor, self.fsCursor, docs, batch_size=self.batch_size,
+                on_overwrite=self.onOverwrite, count_by='project',
+                on_count=on_count)
+        finally:
+            if self.onWritten is not None:
+                self.onWritten()
+
+        for ext, doc, entry in batch:
+            # record it only when parsed, so that it is retried next time
+            if doc is not None and entry is not None:
+                self.manifest.update(entry)
+            self._update_progress(ext)
+
+    def _write(self, doc_q:Queue):
+        """Stage 3: store parsed documents in batches"""
+        def _flush(_batch):
+            # keep consuming on failure, otherwise upstream stages block
+            try:
+                self._write_batch(_batch)
+            except Exception as ex:
+                print('{:s} failed to write {:d} documents | {}'.format(
+                    self.name, len(_batch), ex))
+
+        batch = []
+        while True:
+            try:
+                item = doc_q.get(timeout=1.0)
+            except Empty:
+                # do not hold a partial batch while parsers are busy
+                if len(batch):
+                    _flush(batch)
+                    batch = []
+                continue
+
+            if item is None: break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                _flush(batch)
+                batch = []
+
+        if len(batch):
+            _flush(batch)
+        if self.manifest is not None:
+            self.manifest.flush()
+
+    def _process(self):
+        self.start_t = time.time()
+
+        data_root = self.project['path']
+        print('{:s} starts syncing under {:s}'.format(self.name, data_root))
+
         start_t = time.time()
-        for ext, files in zip(self.extensions, all_files):
-            print('{:s} starts syncing *.{:s} files'.format(self.name, ext))
-            count = 0
-            for f in files:
-                basename = os.path.basename(f)
-
-                # get sample name from the file name
-                sample_name = basename
-                for sep in separator:
-                    if len(sep) == 0: continue
-                    tmp = basename.split(sep)[0]
-                    if len(tmp) < len(sample_name):
-                        sample_name = tmp
-                #sample_name = basename.split(separator)[0]
-
-
-                # parsing
-                doc = self.parser.run(
-                    f,
-                    kind=ext,
-                    sample_name=sample_name,
-                    project_name=project_name
-                )
-                # update
-                if ext == 'xml':
-                    save_document(self.colCursor, doc)
-                elif ext == 'tiff':
-                    save_image_document(self.colCursor, self.fsCursor, doc, ext)
-                count = count + 1
-                # update progress
-                if count%self.interval == 0 or count == len(files):
-                    self.project[ext] = '{:d}/{:d}'.format(count, len(files))
-                    print('{:s} completed syncing *.{:s} files [{:s}]'.format(
-                        self.name, ext, self.project[ext]
-                    ))
+        task_q = Queue(maxsize=self.queue_size)
+        doc_q = Queue(maxsize=self.queue_size)
+
+        discoverer = threading.Thread(target=self._discover, args=(task_q,))
+        discoverer.daemon = True
+        writer = threading.Thread(target=self._write, args=(doc_q,))
+        writer.daemon = True
+
+        discoverer.start()
+        writer.start()
+        self._parse(task_q, doc_q)
+        discoverer.join()
+        writer.join()
 
         end_t = time.time()
         # update progress
         dateFormat = "%Y-%m-%d %H:%M:%S"
-        self.project['last_updated'] = datetime.now().strftime(dateFormat)
+        with self.progress_lock:
+            self.project['last_updated'] = datetime.now().strftime(dateFormat)
         print('{:s} finished syncing under {:s}, [{:3f} min]'.format(
             self.name, data_root, (end_t - start_t) / 60
         ))
@@ -1,4 +1,6 @@
+import os
 import json
+from model.walker import walk
 
 def load_json(filename):
     """Load a json file"""
@@ -11,3 +13,32 @@ def load_json(filename):
 
     return data
 
+
+def scan_files(root, extensions, num_workers=8):
+    """
+    Walk a directory tree once, yielding files with one of the extensions
+    as they are found (instead of a recursive glob per extension).
+    Hidden files and directories are skipped as glob does.
+    See model.walker for symbolic links and parallel listing.
+
+    Args:
+        root: top directory
+        extensions: extensions without the leading dot, e.g. ['xml', 'tiff']
+        num_workers: the number of threads listing directories
+
+    Yields:
+        (extension, path, os.DirEntry)
+    """
+    extensions = set(extensions)
+    for _, _, files in walk(root, num_workers):
+        for entry in files:
+            ext = os.path.splitext(entry.name)[1][1:]
+            if ext in extensions:
+                yield ext, entry.path, entry
+
+def count_files(root, extensions, num_workers=8):
+    """The number of files per extension under a directory (single walk)"""
+    counts = {ext: 0 for ext in extensions}
+    for ext, _, _ in scan_files(root, extensions, num_workers):
+        counts[ext] += 1
+    return counts
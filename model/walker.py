@@ -0,0 +1,148 @@
+"""
+Parallel directory walker
+
+On network filesystems a walk is bound by the latency of listing and
+stat-ing directories, not by cpu, so directories are listed with
+`os.scandir` on a bounded pool of threads: sub-directories found by one
+worker are listed by the others while it moves on.
+
+Symbolic links to directories are followed. A directory is listed only
+once, identified by (st_dev, st_ino), which stops symlink loops and
+directories reachable by more than one path. Links to directories inside
+the root are not followed, since the directory is walked by its own path;
+they are still reported as directories (see `walk_dirs()`).
+
+Hidden entries (names starting with '.') are skipped by default, as glob
+does for syncing files; `walk_dirs()` keeps them, as os.walk does for the
+fsmap.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def _list_dir(path, skip_hidden=True):
+    """
+    List a directory
+    Args:
+        path: directory
+        skip_hidden: True to skip names starting with '.'
+
+    Returns:
+        (sub-directories [(path, is symlink, (st_dev, st_ino))], files [os.DirEntry])
+    """
+    subdirs = []
+    files = []
+    try:
+        it = os.scandir(path)
+    except OSError as ex:
+        print('Failed to scan {:s} | {}'.format(path, ex))
+        return subdirs, files
+
+    with it:
+        for entry in it:
+            # skip hidden files and directories (as glob does)
+            if skip_hidden and entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    # follows symlinks, cached on most platforms except links
+                    st = entry.stat()
+                    subdirs.append((entry.path, entry.is_symlink(),
+                                    (st.st_dev, st.st_ino)))
+                elif entry.is_file():
+                    files.append(entry)
+            except OSError:
+                # broken link or removed while scanning
+                continue
+    return subdirs, files
+
+
+def walk(root, num_workers=8, skip_hidden=True):
+    """
+    Walk a directory tree, listing directories in parallel.
+    Directories are yielded as they are listed (not in a fixed order).
+
+    Args:
+        root: top directory
+        num_workers: the number of threads listing directories
+                     (0 or 1: walk in the calling thread)
+        skip_hidden: True to skip hidden files and directories
+
+    Yields:
+        (dirpath, sub-directories [path], files [os.DirEntry]) like os.walk.
+        Sub-directories include links which are not walked.
+    """
+    root_real = os.path.realpath(root)
+    try:
+        st = os.stat(root)
+    except OSError as ex:
+        print('Failed to scan {:s} | {}'.format(root, ex))
+        return
+
+    # (st_dev, st_ino) of directories already walked or queued
+    seen = {(st.st_dev, st.st_ino)}
+    seen_lock = threading.Lock()
+
+    def _to_walk(subdir):
+        path, is_link, key = subdir
+        if is_link:
+            real = os.path.realpath(path)
+            if real == root_real or real.startswith(root_real + os.sep):
+                # walked by its real path
+                return False
+        with seen_lock:
+            if key in seen:
+                return False
+            seen.add(key)
+            return True
+
+    if num_workers <= 1:
+        stack = [root]
+        while len(stack):
+            path = stack.pop()
+            subdirs, files = _list_dir(path, skip_hidden)
+            yield path, [s[0] for s in subdirs], files
+            stack.extend(reversed([s[0] for s in subdirs if _to_walk(s)]))
+        return
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    pending = {}
+    try:
+        pending[executor.submit(_list_dir, root, skip_hidden)] = root
+        while len(pending):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                subdirs, files = future.result()
+                for s in subdirs:
+                    if _to_walk(s):
+                        pending[executor.submit(_list_dir, s[0], skip_hidden)] = s[0]
+                yield path, [s[0] for s in subdirs], files
+    finally:
+        # the walk can be stopped early by the consumer
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def walk_dirs(root, num_workers=8, skip_hidden=False):
+    """
+    All directories under root (including root), in the top-down order of
+    os.walk with sub-directories sorted by name, so that a parent always
+    comes before its children. Hidden directories are included by default.
+
+    Returns:
+        [path to a directory]
+    """
+    children = {}
+    for dirpath, subdirs, _ in walk(root, num_workers, skip_hidden):
+        children[dirpath] = sorted(subdirs)
+
+    dirs = []
+    stack = [root]
+    while len(stack):
+        path = stack.pop()
+        dirs.append(path)
+        stack.extend(reversed(children.get(path, [])))
+    return dirs